@@ -24,6 +24,7 @@ try:
 
     oldScratchPath = os.path.join(luciSEEAPath, "LUCIscratch")
     scratchPath = os.path.join(basePath, "LUCIscratch")
+    factorCachePath = os.path.join(basePath, "LUCIcache") # Outside the scratch path, which is cleared on each run
 
     userSettingsFile = os.path.join(luciSEEAPath, "user_settings.xml")
     filenamesFile = os.path.join(luciSEEAPath, "filenames.xml")
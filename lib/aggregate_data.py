@@ -1,15 +1,354 @@
 import arcpy
 import sys
 import os
+import hashlib
+import multiprocessing
 import numpy as np
 import LUCI_SEEA.lib.log as log
 import LUCI_SEEA.lib.common as common
-from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
+import LUCI_SEEA.lib.diversity as diversity
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.raster_aggregation as raster_aggregation
+import LUCI_SEEA.lib.str_tree as str_tree
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules([log, common])
+refresh_modules([log, common, diversity, raster_blocks, raster_aggregation, str_tree])
 
-def function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSAM, studyAreaMask):
+maxWhereRanges = 1000 # Maximum number of object ID ranges in the where clause selecting candidate features
+
+
+def unitStatistics(unitIds, unitSizes, pieceUnits, pieceAreas, classUnits, classValues, classAreas):
+
+    '''
+    Diversity metrics of each aggregation unit (see diversity.diversityMetrics) from the data set within the units.
+    unitIds and unitSizes (in km2) describe the units. classUnits, classValues and classAreas (in ha) give the area of
+    each class in each unit, with overlapping features of the same class counted once. pieceUnits and pieceAreas give
+    the unit and area of each piece of a feature within a unit (patch), for the mean patch size. The metrics are in
+    the order of unitIds.
+    '''
+
+    unitIds = np.asarray(unitIds)
+    order = np.argsort(unitIds)
+
+    def indexOfUnits(units):
+        return order[np.searchsorted(unitIds[order], np.asarray(units))]
+
+    # An integer code for each class
+    classCodes = {}
+    classIndex = np.array([classCodes.setdefault(value, len(classCodes)) for value in classValues], dtype=np.int64)
+
+    areaMatrix = diversity.UnitClassMatrix.fromPairs(indexOfUnits(classUnits), classIndex, classAreas, len(unitIds),
+                                                     len(classCodes))
+
+    return diversity.diversityMetrics(areaMatrix, np.asarray(unitSizes, dtype=np.float64) * 100.0, # km2 to ha
+                                      indexOfUnits(pieceUnits), pieceAreas)
+
+
+def rasterUnitStatistics(dataSet, units, unitIdField, unitIds, unitSizes, unitRaster, workers=1):
+
+    '''
+    Diversity metrics of each aggregation unit from a classified raster (e.g. land cover), without a vector overlay.
+    The units are rasterised onto the grid of the raster on their unit ID field, and the cells of each unit and class,
+    and the patches, are counted tile by tile (see raster_aggregation). Returns the unit IDs in sorted order and the
+    metrics in that order.
+    '''
+
+    grid = raster_blocks.getGrid(dataSet)
+
+    # Cell areas are only meaningful in a projected coordinate system
+    if grid.spatialRef is None or grid.spatialRef.type != 'Projected':
+        log.error('Raster ' + str(dataSet) + ' is not in a projected coordinate system')
+        log.error('Please project the raster so that the areas of its cells can be calculated')
+        sys.exit()
+
+    # Rasterise the units on the grid of the classified raster, then restore the previous settings
+    envSettings = [arcpy.env.extent, arcpy.env.snapRaster]
+
+    try:
+        arcpy.env.extent = dataSet
+        arcpy.env.snapRaster = dataSet
+        arcpy.PolygonToRaster_conversion(units, unitIdField, unitRaster, "CELL_CENTER", "", grid.cellSize)
+
+    finally:
+        arcpy.env.extent, arcpy.env.snapRaster = envSettings
+
+    cellAreaHa = (grid.cellSize * grid.spatialRef.metersPerUnit) ** 2 / 10000.0
+
+    order = np.argsort(unitIds)
+    sortedIds = np.asarray(unitIds)[order]
+
+    areaMatrix, classValues, patchCounts = raster_aggregation.aggregateRaster(unitRaster, dataSet, sortedIds, grid,
+                                                                              cellAreaHa, workers=workers)
+
+    metrics = diversity.diversityMetrics(areaMatrix, np.asarray(unitSizes, dtype=np.float64)[order] * 100.0,
+                                         patchCounts=patchCounts)
+
+    return sortedIds, metrics
+
+
+def indexFile(dataSet):
+
+    ''' Path of the spatial index file of a data set, next to the data set (or next to its geodatabase) '''
+
+    dataSet = arcpy.Describe(dataSet).catalogPath
+    gdbEnd = dataSet.lower().find('.gdb')
+
+    if gdbEnd >= 0:
+        geodatabase = dataSet[:gdbEnd + 4]
+        folder = os.path.dirname(geodatabase)
+        name = os.path.basename(geodatabase)[:-4] + '_' + os.path.basename(dataSet)
+    else:
+        folder, name = os.path.split(dataSet)
+        name = os.path.splitext(name)[0]
+
+    return os.path.join(folder, name + '_strtree.npz')
+
+
+def featureDigest(dataSet):
+
+    ''' Digest of the object IDs and bounding boxes of the features of a data set '''
+
+    digest = hashlib.sha1()
+    for row in arcpy.da.SearchCursor(dataSet, ["OID@", "SHAPE@"]):
+        if row[1] is not None:
+            extent = row[1].extent
+            digest.update(repr((row[0], extent.XMin, extent.YMin, extent.XMax, extent.YMax)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def dataSetSignature(dataSet):
+
+    '''
+    String which changes when the features of a data set change: their number and extent, and the modification time
+    of the data set's file (or of the newest file of its file geodatabase). If the data set is not held in files
+    (e.g. in an enterprise geodatabase), a digest of the bounding boxes of its features is used instead.
+    '''
+
+    desc = arcpy.Describe(dataSet)
+    extent = desc.extent
+    count = int(arcpy.GetCount_management(dataSet).getOutput(0))
+
+    catalogPath = desc.catalogPath
+    gdbEnd = catalogPath.lower().find('.gdb')
+
+    if os.path.isfile(catalogPath):
+        modified = str(os.path.getmtime(catalogPath))
+
+    elif gdbEnd >= 0 and os.path.isdir(catalogPath[:gdbEnd + 4]):
+        # Lock files are written whenever the geodatabase is opened, so they are left out
+        geodatabase = catalogPath[:gdbEnd + 4]
+        modified = str(max([0.0] + [os.path.getmtime(os.path.join(geodatabase, name))
+                                    for name in os.listdir(geodatabase) if not name.lower().endswith('.lock')]))
+
+    else:
+        modified = featureDigest(dataSet)
+
+    return ','.join([str(count), str(extent.XMin), str(extent.YMin), str(extent.XMax), str(extent.YMax), modified])
+
+
+def spatialIndex(dataSet):
+
+    '''
+    STR-tree index of the bounding boxes of the features of a data set, keyed on their object IDs. The index is saved
+    next to the data set and reused while the data set is unchanged (or saved to the scratch folder if it cannot be
+    saved next to the data set). Returns the index and the path of its file.
+    '''
+
+    indexPath = indexFile(dataSet)
+    signature = dataSetSignature(dataSet)
+
+    if os.path.exists(indexPath):
+        try:
+            index = str_tree.STRTree.load(indexPath)
+            if index.signature == signature:
+                return index, indexPath
+        except Exception:
+            pass # If the index cannot be read, build it again
+
+    log.info("Building spatial index of " + str(dataSet))
+
+    ids = []
+    boxes = []
+    for row in arcpy.da.SearchCursor(dataSet, ["OID@", "SHAPE@"]):
+        if row[1] is not None:
+            extent = row[1].extent
+            ids.append(row[0])
+            boxes.append((extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+
+    index = str_tree.STRTree(boxes, ids, signature=signature)
+
+    try:
+        index.save(indexPath)
+    except Exception:
+        log.warning("Could not save spatial index to " + str(indexPath))
+        indexPath = os.path.join(arcpy.env.scratchFolder, os.path.basename(indexPath))
+        index.save(indexPath)
+
+    return index, indexPath
+
+
+def oidRanges(oids):
+
+    ''' Runs of consecutive object IDs in a set of IDs, as arrays of the first and last ID of each run '''
+
+    oids = np.unique(np.asarray(oids, dtype=np.int64))
+    breaks = np.flatnonzero(np.diff(oids) != 1) + 1
+    starts = np.concatenate([oids[:1], oids[breaks]])
+    ends = np.concatenate([oids[breaks - 1], oids[-1:]])
+
+    return starts, ends
+
+
+def oidWhereClause(oidField, oids):
+
+    ''' SQL where clause selecting a set of object IDs, as ranges of consecutive IDs '''
+
+    starts, ends = oidRanges(oids)
+
+    clauses = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if start == end:
+            clauses.append(oidField + ' = ' + str(start))
+        else:
+            clauses.append('(' + oidField + ' >= ' + str(start) + ' AND ' + oidField + ' <= ' + str(end) + ')')
+
+    return ' OR '.join(clauses)
+
+
+def featureBoxes(featureClass, spatialRef):
+
+    ''' Bounding boxes (xMin, yMin, xMax, yMax rows) of the features of a feature class, in a spatial reference '''
+
+    boxes = []
+    for row in arcpy.da.SearchCursor(featureClass, ["SHAPE@"], spatial_reference=spatialRef):
+        extent = row[0].extent
+        boxes.append((extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+
+    return np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def candidateLayer(dataSet, index, units, layerName):
+
+    '''
+    Feature layer of the features of a data set whose bounding boxes overlap the bounding box of at least one unit,
+    found with the spatial index. Returns None if there are none, or the data set itself if all features are
+    candidates (or if the candidates are too scattered to select with a where clause).
+    '''
+
+    unitBoxes = featureBoxes(units, arcpy.Describe(dataSet).spatialReference)
+    unitIndex, candidates = index.query(unitBoxes)
+    candidates = np.unique(candidates)
+
+    if len(candidates) == 0:
+        return None
+
+    # Very scattered candidates would give a very long where clause, so all features are used instead
+    if len(candidates) == index.size or len(oidRanges(candidates)[0]) > maxWhereRanges:
+        return dataSet
+
+    oidField = arcpy.Describe(dataSet).OIDFieldName
+    arcpy.MakeFeatureLayer_management(dataSet, layerName, oidWhereClause(oidField, candidates))
+
+    return layerName
+
+
+def addAreaField(featureClass, fieldName, units):
+
+    ''' Adds a field holding the area of each feature in the given units (e.g. HECTARES), unless it already exists '''
+
+    if fieldName not in [field.name for field in arcpy.ListFields(featureClass)]:
+        arcpy.AddField_management(featureClass, fieldName, "DOUBLE")
+
+    arcpy.CalculateField_management(featureClass, fieldName, "!SHAPE.AREA@" + units + "!", "PYTHON_9.3")
+
+
+def unitChunks(units, unitIdField, spatialRef, nChunks):
+
+    '''
+    Splits the aggregation units into about nChunks spatially coherent chunks of equal size: the units are sorted into
+    vertical slices by the x of the centres of their bounding boxes, and each slice into blocks by the y (as the leaves
+    of an STR-tree). Returns a list of (chunk number, sorted unit IDs).
+    '''
+
+    unitIds = []
+    boxes = []
+    for row in arcpy.da.SearchCursor(units, [unitIdField, "SHAPE@"], spatial_reference=spatialRef):
+        extent = row[1].extent
+        unitIds.append(row[0])
+        boxes.append((extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+
+    unitIds = np.asarray(unitIds, dtype=np.int64)
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+    chunkSize = max(int(np.ceil(len(unitIds) / float(max(nChunks, 1)))), 1)
+    unitIds = unitIds[str_tree.packOrder(boxes, chunkSize)]
+
+    return [(number, np.sort(unitIds[start:start + chunkSize]))
+            for number, start in enumerate(range(0, len(unitIds), chunkSize))]
+
+
+def overlayChunk(chunk, dataSet, indexPath, units, unitIdField, linkCode, workspace):
+
+    '''
+    Overlays a data set with a chunk of aggregation units, given as (chunk number, unit IDs, or None for all units).
+    Only features whose bounding boxes overlap a unit of the chunk are overlaid, found with the spatial index saved at
+    indexPath, and the overlay is written to workspace. Returns the unit and area (in ha) of each piece, and the unit,
+    class and area of each class in each unit, from the overlay dissolved on the unit and class.
+    Defined at module level so that chunks can be processed in worker processes.
+    '''
+
+    number, chunkIds = chunk
+    unitLayer = "ChunkUnits" + str(number)
+    candidateLayerName = "ChunkCandidates" + str(number)
+    dataInUnits = os.path.join(workspace, "aggdata_dataInUnits" + str(number))
+    classesInUnits = os.path.join(workspace, "aggdata_classesInUnits" + str(number))
+
+    pieceUnits = []
+    pieceAreas = []
+    classUnits = []
+    classValues = []
+    classAreas = []
+
+    try:
+        if chunkIds is None:
+            arcpy.MakeFeatureLayer_management(units, unitLayer)
+        else:
+            arcpy.MakeFeatureLayer_management(units, unitLayer, oidWhereClause(unitIdField, chunkIds))
+
+        index = str_tree.STRTree.load(indexPath)
+        candidates = candidateLayer(dataSet, index, unitLayer, candidateLayerName)
+
+        if candidates is not None:
+            arcpy.Intersect_analysis([candidates, unitLayer], dataInUnits, "ALL")
+            addAreaField(dataInUnits, "AREA_HA", "HECTARES")
+
+            for row in arcpy.da.SearchCursor(dataInUnits, [unitIdField, "AREA_HA"]):
+                pieceUnits.append(row[0])
+                pieceAreas.append(row[1])
+
+            # Features of the same class may overlap (e.g. species ranges), so the area of each class in each unit is
+            # taken from the overlay dissolved on the unit and class
+            arcpy.Dissolve_management(dataInUnits, classesInUnits, [unitIdField, linkCode])
+            addAreaField(classesInUnits, "AREA_HA", "HECTARES")
+
+            for row in arcpy.da.SearchCursor(classesInUnits, [unitIdField, linkCode, "AREA_HA"]):
+                classUnits.append(row[0])
+                classValues.append(row[1])
+                classAreas.append(row[2])
+
+            arcpy.Delete_management(dataInUnits)
+            arcpy.Delete_management(classesInUnits)
+
+    finally:
+        for layer in [unitLayer, candidateLayerName]:
+            if arcpy.Exists(layer):
+                arcpy.Delete_management(layer)
+
+    return pieceUnits, pieceAreas, classUnits, classValues, classAreas
+
+
+def function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSAM, studyAreaMask, workers=1):
 
     try:
         # Set temporary variables
@@ -17,22 +356,28 @@ def function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSA
         
         studyAreaMaskDissolved = prefix + "studyAreaMaskDissolved"
         aggregateMaskClipped = prefix + "aggregateMaskClipped"
+        unitRaster = prefix + "unitRaster"
 
-        if six.PY2:
-            memoryPrefix = 'in_memory'
-        else:
-            memoryPrefix = 'memory'
-
-        singleAggUnit = os.path.join(memoryPrefix, "singleAggUnit")
-        dataClippedToUnit = os.path.join(memoryPrefix, "dataClippedToUnit")
-        dataInUnitDissolved = os.path.join(memoryPrefix, "dataInUnitDissolved")
-        
         tempLayer = "MaskLayer"
-        unitMaskLayer = "UnitMaskLayer"
+        unitIdField = "AGG_UNIT"
+
+        # Several chunks of units per worker process, to balance the load between the workers
+        chunksPerWorker = 4
+        if workers is None or workers < 1:
+            workers = multiprocessing.cpu_count()
 
-        # Clip aggregation mask to extent of study area
+        # Clip aggregation mask to extent of study area. If the study area is a raster (e.g. the classified raster
+        # being aggregated), the study area is the extent of the raster.
         tmpLyr1 = arcpy.MakeFeatureLayer_management(aggregateMask, tempLayer).getOutput(0)
-        arcpy.Dissolve_management(studyAreaMask, studyAreaMaskDissolved)
+
+        studyAreaDesc = arcpy.Describe(studyAreaMask)
+        if studyAreaDesc.dataType in ['RasterDataset', 'RasterLayer']:
+            extent = studyAreaDesc.extent
+            corners = [extent.lowerLeft, extent.upperLeft, extent.upperRight, extent.lowerRight, extent.lowerLeft]
+            arcpy.CopyFeatures_management([arcpy.Polygon(arcpy.Array(corners), studyAreaDesc.spatialReference)],
+                                          studyAreaMaskDissolved)
+        else:
+            arcpy.Dissolve_management(studyAreaMask, studyAreaMaskDissolved)
 
         if maskFullyWithinSAM:
             arcpy.SelectLayerByLocation_management(tempLayer, "COMPLETELY_WITHIN", studyAreaMaskDissolved)
@@ -47,6 +392,19 @@ def function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSA
             log.error('Aggregation unit feature class does not have any aggregation units intersecting the study area')
             sys.exit()
 
+        # Calculate size of each aggregation unit, and give each unit an ID which is carried through the overlay
+        addAreaField(aggregateMaskClipped, "AREA_SQKM", "SQUAREKILOMETERS")
+
+        OID = str(arcpy.Describe(aggregateMaskClipped).oidFieldName)
+        arcpy.AddField_management(aggregateMaskClipped, unitIdField, "LONG")
+        arcpy.CalculateField_management(aggregateMaskClipped, unitIdField, "!" + OID + "!", "PYTHON_9.3")
+
+        unitIds = []
+        unitSizes = []
+        for row in arcpy.da.SearchCursor(aggregateMaskClipped, [unitIdField, "AREA_SQKM"]):
+            unitIds.append(row[0])
+            unitSizes.append(row[1])
+
         outputStats = []
 
         for dataToAggregate in dataSetsToAggregate:
@@ -54,77 +412,59 @@ def function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSA
             dataSet = dataToAggregate.dataSet
             linkCode = dataToAggregate.linkCode
 
-            # Calculate size of each aggregation unit
-            arcpy.AddField_management(aggregateMaskClipped, "AREA_SQKM", "DOUBLE")
-            arcpy.CalculateField_management(aggregateMaskClipped, "AREA_SQKM", "!SHAPE.AREA@SQUAREKILOMETERS!", "PYTHON_9.3")
-
-            # Productivity metrics
-            tmpLyr2 = arcpy.MakeFeatureLayer_management(aggregateMaskClipped, unitMaskLayer).getOutput(0)
-            OID = str(arcpy.Describe(aggregateMaskClipped).oidFieldName)
+            if arcpy.Describe(dataSet).dataType in ['RasterDataset', 'RasterLayer']:
 
-            # Initialise variables
-            unitNo = 0
-            numCovers = []
-            shannonIndex = []
-            inverseSimpsonsIndex = []
-            meanPatchAreas = []
+                # Classified rasters are aggregated on their own grid, with the cell values as the classes
+                log.info("Aggregating raster " + str(dataSet) + " over " + str(numRecords) + " aggregation units")
+                metricIds, metrics = rasterUnitStatistics(dataSet, aggregateMaskClipped, unitIdField, unitIds,
+                                                          unitSizes, unitRaster, workers)
 
-            with arcpy.da.SearchCursor(unitMaskLayer, OID) as gridCursor:
-
-                # Loop through each aggregation unit
-                for gridRow in gridCursor:
-
-                    unitNo = unitNo + 1
-                    log.info("Aggregating data from unit " + str(unitNo) + " of " + str(numRecords))
-
-                    expression = OID + "=%s" % gridRow[0]
-                    arcpy.SelectLayerByAttribute_management(unitMaskLayer, "NEW_SELECTION", expression)
-                    arcpy.CopyFeatures_management(unitMaskLayer, singleAggUnit)
-
-                    # Find aggregation unit size
-                    for row in arcpy.da.SearchCursor(singleAggUnit, "AREA_SQKM"):
-                        unitSize = row[0]
-
-                    # Clip data to unit and calculate area
-                    arcpy.Clip_analysis(dataSet, singleAggUnit, dataClippedToUnit)
-                    arcpy.AddField_management(dataClippedToUnit, "AREA_HA", "DOUBLE")
-                    arcpy.CalculateField_management(dataClippedToUnit, "AREA_HA", "!SHAPE.AREA@HECTARES!", "PYTHON_9.3")
-
-                    # Dissolve clipped data and calculate area
-                    arcpy.Dissolve_management(dataClippedToUnit, dataInUnitDissolved, linkCode)
-                    arcpy.AddField_management(dataInUnitDissolved, "AREA_SQKM", "DOUBLE")
-                    arcpy.CalculateField_management(dataInUnitDissolved, "AREA_SQKM", "!SHAPE.AREA@SQUAREKILOMETERS!", "PYTHON_9.3")
-
-                    classificationsCount = 0
-                    probOcc = [] # list which will hold probability of occurence of each type
-
-                    for row in arcpy.da.SearchCursor(dataInUnitDissolved, [linkCode, "AREA_SQKM"]):
-                        classificationsCount += 1
-                        probOcc.append(row[1] / unitSize)
-
-                    if len(probOcc) == 0:
-                        shannon = -1
-                        inverseSimpsons = -1
-                    else:
-                        shannon = -sum(probOcc * np.log(probOcc))
-                        inverseSimpsons = 1 / sum(np.array(probOcc) * np.array(probOcc))
-
-                    shannonIndex.append(shannon)
-                    inverseSimpsonsIndex.append(inverseSimpsons)
-                    numCovers.append(classificationsCount)
-
-                    patchAreas = []
-                    for row in arcpy.da.SearchCursor(dataClippedToUnit, [linkCode, "AREA_HA"]):
-                        patchAreas.append(row[1])
-
-                    if len(patchAreas) == 0:
-                        meanPatchArea = 0
-                    else:
-                        meanPatchArea = np.mean(patchAreas)
-
-                    meanPatchAreas.append(meanPatchArea)
-
-            log.info("Completed iteration through aggregation units for " + str(dataSet))
+            else:
+                if not linkCode:
+                    log.error('No classification column given for ' + str(dataSet))
+                    log.error('Please give the column holding the class of each feature')
+                    sys.exit()
+
+                # Only features whose bounding boxes overlap a unit are overlaid, found with the spatial index
+                # of the data set. Each output feature of the overlay is the part of one data feature (patch) which
+                # lies in one unit. With several workers, the units are overlaid in spatial chunks in worker
+                # processes, each writing to its own in-memory workspace, and the pieces are joined in chunk order
+                # so that the results do not depend on the order in which the chunks complete.
+                indexPath = spatialIndex(dataSet)[1]
+
+                if workers == 1:
+                    chunks = [(0, None)]
+                    workspace = arcpy.env.scratchGDB
+                else:
+                    chunks = unitChunks(aggregateMaskClipped, unitIdField, arcpy.Describe(dataSet).spatialReference,
+                                        workers * chunksPerWorker)
+                    workspace = "in_memory"
+
+                log.info("Overlaying " + str(dataSet) + " with " + str(numRecords) + " aggregation units in "
+                         + str(len(chunks)) + " chunk(s)")
+
+                chunkResults = {}
+                for chunk, pieces in raster_blocks.processBlocks(overlayChunk, chunks,
+                                                                 (dataSet, indexPath, aggregateMaskClipped,
+                                                                  unitIdField, linkCode, workspace),
+                                                                 workers):
+                    chunkResults[chunk[0]] = pieces
+
+                # Pieces and class areas of all chunks, in chunk order
+                overlay = [[], [], [], [], []]
+
+                for number in sorted(chunkResults):
+                    for values, chunkValues in zip(overlay, chunkResults[number]):
+                        values.extend(chunkValues)
+
+                # Productivity metrics for all units
+                metricIds = unitIds
+                metrics = unitStatistics(unitIds, unitSizes, *overlay)
+
+            metricNames = ['richness', 'shannon', 'inverseSimpson', 'evenness', 'meanPatch']
+            unitStats = dict(zip(np.asarray(metricIds).tolist(), zip(*[metrics[name].tolist() for name in metricNames])))
+
+            log.info("Completed aggregation of " + str(dataSet))
 
             # Determine output file name for data set statistics
             baseDataSetName = os.path.basename(dataSet).replace('-', '')
@@ -139,19 +479,17 @@ def function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSA
             arcpy.AddField_management(aggregateStats, "NUM_COVERS", "SHORT")
             arcpy.AddField_management(aggregateStats, "SHANNON", "DOUBLE", 6, 2)
             arcpy.AddField_management(aggregateStats, "INVSIMPSON", "DOUBLE", 6, 2)
+            arcpy.AddField_management(aggregateStats, "EVENNESS", "DOUBLE", 6, 2)
             arcpy.AddField_management(aggregateStats, "MEANPATCH", "DOUBLE", 6, 2)
 
-            unitNo = 0
-            with arcpy.da.UpdateCursor(aggregateStats, ['NUM_COVERS', 'SHANNON', 'INVSIMPSON', 'MEANPATCH']) as cursor:
+            with arcpy.da.UpdateCursor(aggregateStats, [unitIdField, 'NUM_COVERS', 'SHANNON', 'INVSIMPSON', 'EVENNESS',
+                                                       'MEANPATCH']) as cursor:
                 for row in cursor:
 
-                    row[0] = numCovers[unitNo]
-                    row[1] = shannonIndex[unitNo]
-                    row[2] = inverseSimpsonsIndex[unitNo]
-                    row[3] = meanPatchAreas[unitNo]
-
+                    row[1:] = unitStats[row[0]]
                     cursor.updateRow(row)
-                    unitNo = unitNo + 1
+
+            arcpy.DeleteField_management(aggregateStats, unitIdField)
 
             outputStats.append(aggregateStats)
 
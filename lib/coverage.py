@@ -0,0 +1,178 @@
+'''
+Coverage checks of input data against the study area, carried out on rasters rather than polygons.
+
+The study area mask is rasterised once to a bitmask on the cell grid of a reference raster (normally the DEM). Each
+input is then compared with it tile by tile: the cells in one mask but not the other are found with boolean
+operations on the packed bits and counted with a popcount lookup table. This needs no polygon overlay, so it works
+with any ArcGIS licence level.
+'''
+
+import os
+import numpy as np
+
+import LUCI_SEEA.lib.log as log
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+
+coverageThreshold = 2.5 # Percentage of the study area which may differ from the input data coverage
+
+bitCounts = np.unpackbits(np.arange(256, dtype=np.uint8).reshape(-1, 1), axis=1).sum(axis=1)
+
+
+def popcount(bits):
+
+    ''' Number of set bits in an array of packed bits '''
+
+    return int(bitCounts[bits].sum())
+
+
+def packMask(array):
+
+    ''' Packs the cells with data (not NaN) in a block into bits, one row at a time '''
+
+    return np.packbits(~np.isnan(array), axis=-1)
+
+
+class CoverageMask(object):
+
+    '''
+    Study area mask as a bitmask on the cell grid of the reference raster. The study area mask can be a polygon
+    feature class or a raster.
+    '''
+
+    def __init__(self, studyMask, referenceRaster, tileSize=None):
+
+        self.referenceRaster = referenceRaster
+        self.grid = raster_blocks.getGrid(referenceRaster)
+        self.tileSize = tileSize
+        self.tempRasters = []
+
+        maskRaster = self.onGrid(studyMask, "studyMask")
+
+        self.bits = {}
+        self.studyCount = 0
+
+        for block in raster_blocks.iterBlocks(self.grid, self.tileSize):
+            bits = packMask(raster_blocks.readBlock(maskRaster, self.grid, block))
+
+            self.bits[block.key()] = bits
+            self.studyCount += popcount(bits)
+
+        self.deleteTempRasters()
+
+    def onGrid(self, data, name):
+
+        '''
+        Returns a raster on the cell grid of the reference raster with data where the input has data.
+        Polygon inputs are rasterised, and rasters with a different cell grid are resampled.
+        '''
+
+        if raster_blocks.isNumpySource(data):
+            return data
+
+        import arcpy
+
+        dataType = arcpy.Describe(data).dataType
+        if dataType not in ['ShapeFile', 'FeatureClass', 'FeatureLayer'] and self.sameGrid(data):
+            return data
+
+        outRaster = os.path.join(arcpy.env.scratchGDB, "cover_" + name)
+
+        # Set the environment to the reference raster, then restore the previous settings
+        envSettings = [arcpy.env.extent, arcpy.env.snapRaster, arcpy.env.cellSize, arcpy.env.mask]
+
+        try:
+            arcpy.env.extent = self.referenceRaster
+            arcpy.env.snapRaster = self.referenceRaster
+            arcpy.env.cellSize = self.referenceRaster
+            arcpy.env.mask = None
+
+            if dataType in ['ShapeFile', 'FeatureClass', 'FeatureLayer']:
+                oidField = arcpy.Describe(data).OIDFieldName
+                arcpy.PolygonToRaster_conversion(data, oidField, outRaster, "CELL_CENTER", "", self.grid.cellSize)
+
+            else:
+                resampledTemp = arcpy.sa.ApplyEnvironment(data)
+                resampledTemp.save(outRaster)
+
+        finally:
+            arcpy.env.extent, arcpy.env.snapRaster, arcpy.env.cellSize, arcpy.env.mask = envSettings
+
+        self.tempRasters.append(outRaster)
+
+        return outRaster
+
+    def sameGrid(self, raster):
+
+        ''' Checks if a raster has the same cell size as the reference raster and is aligned with it '''
+
+        grid = raster_blocks.getGrid(raster)
+        tolerance = 0.001 * self.grid.cellSize
+
+        colOffset = (grid.xMin - self.grid.xMin) / self.grid.cellSize
+        rowOffset = (self.grid.yMax - grid.yMax) / self.grid.cellSize
+
+        return (abs(grid.cellSize - self.grid.cellSize) < tolerance
+                and abs(colOffset - round(colOffset)) * self.grid.cellSize < tolerance
+                and abs(rowOffset - round(rowOffset)) * self.grid.cellSize < tolerance)
+
+    def deleteTempRasters(self):
+
+        if len(self.tempRasters) == 0:
+            return
+
+        import arcpy
+
+        for raster in self.tempRasters:
+            try:
+                arcpy.Delete_management(raster)
+            except Exception:
+                pass
+
+        self.tempRasters = []
+
+    def discrepancy(self, data):
+
+        '''
+        Returns the number of study area cells without data, and the number of cells with data outside the study
+        area (together, the symmetric difference of the two masks).
+        '''
+
+        dataRaster = self.onGrid(data, "data")
+
+        missing = 0
+        extra = 0
+
+        for block in raster_blocks.iterBlocks(self.grid, self.tileSize):
+            studyBits = self.bits[block.key()]
+            dataBits = packMask(raster_blocks.readBlock(dataRaster, self.grid, block))
+
+            missing += popcount(studyBits & ~dataBits)
+            extra += popcount(dataBits & ~studyBits)
+
+        self.deleteTempRasters()
+
+        return missing, extra
+
+    def percentOut(self, data):
+
+        ''' Percentage of the study area which differs from the coverage of the input data '''
+
+        if self.studyCount == 0:
+            return 0.0
+
+        missing, extra = self.discrepancy(data)
+
+        return 100.0 * (missing + extra) / self.studyCount
+
+    def check(self, data, inputFile=None):
+
+        ''' Warns if the input data coverage differs from the study area by more than the threshold percentage '''
+
+        percOut = self.percentOut(data)
+
+        if percOut > coverageThreshold:
+            log.warning('Input data coverage is less than ' + str(100.0 - coverageThreshold) + ' percent of the study area')
+            log.warning('This may cause discrepancies in later calculations')
+            log.warning('Please check this input: ' + str(inputFile))
+
+        return percOut
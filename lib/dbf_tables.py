@@ -0,0 +1,223 @@
+'''
+Reads dBASE (.dbf) tables, such as the RUSLE lookup tables in the tables folder, into NumPy structured arrays
+without using arcpy.
+
+Parsed tables are cached for the lifetime of the process, keyed on the file path, modification time and size, so
+repeated runs (e.g. batch runs over many catchments) only parse each table once. A .npz sidecar can also be written
+to the user's cache folder (LUCIcache, as for the RUSLE factor cache) so that other processes can reload the table
+without parsing the .dbf file. Sidecars are never written next to the tables, which may be in a read-only folder
+shared between users.
+'''
+
+import os
+import struct
+import hashlib
+import numpy as np
+
+tableCache = {}
+
+
+def getEncoding(dbfFile):
+
+    ''' Returns the text encoding of a table from its .cpg file, defaulting to latin-1 '''
+
+    cpgFile = os.path.splitext(dbfFile)[0] + '.cpg'
+    encoding = 'latin-1'
+
+    try:
+        if os.path.exists(cpgFile):
+            with open(cpgFile, 'r') as f:
+                codePage = f.read().strip()
+
+            if codePage.isdigit():
+                codePage = 'cp' + codePage
+
+            if codePage:
+                ''.encode(codePage) # Check Python knows the encoding
+                encoding = codePage
+
+    except Exception:
+        pass # If any errors occur, ignore them. Just use the default encoding.
+
+    return encoding
+
+
+def convertColumn(column, fieldType, decimals, encoding):
+
+    ''' Converts a column of raw field bytes to a typed NumPy array '''
+
+    if fieldType in ['N', 'F']:
+        stripped = np.char.strip(column)
+        blank = (stripped == b'') | (np.char.count(stripped, b'*') > 0)
+        stripped[blank] = b'nan'
+        values = stripped.astype(np.float64)
+
+        # Whole numbers are returned as integers, unless there are blank values
+        if fieldType == 'N' and decimals == 0 and not blank.any():
+            values = values.astype(np.int64)
+
+        return values
+
+    elif fieldType == 'I':
+        return np.frombuffer(column.tobytes(), dtype='<i4').astype(np.int64)
+
+    elif fieldType in ['B', 'O']:
+        return np.frombuffer(column.tobytes(), dtype='<f8').copy()
+
+    elif fieldType == 'L':
+        return np.isin(column, [b'Y', b'y', b'T', b't'])
+
+    else:
+        # Character, date and any other field types are returned as text
+        return np.char.decode(np.char.rstrip(column), encoding)
+
+
+def readDBF(dbfFile):
+
+    ''' Parses a .dbf file into a NumPy structured array, with one field per table column. Deleted records are skipped. '''
+
+    with open(dbfFile, 'rb') as f:
+        data = f.read()
+
+    nRecords, headerLength, recordLength = struct.unpack('<IHH', data[4:12])
+
+    # Field descriptors are 32 bytes each and are terminated by a carriage return
+    fields = []
+    offset = 1 # First byte of each record is the deletion flag
+    pos = 32
+    while pos + 32 <= headerLength and data[pos:pos + 1] != b'\r':
+
+        name, fieldType, length, decimals = struct.unpack('<11sc4xBB14x', data[pos:pos + 32])
+        name = name.split(b'\x00')[0].decode('ascii')
+        fieldType = fieldType.decode('ascii')
+
+        fields.append((name, fieldType, length, decimals, offset))
+        offset += length
+        pos += 32
+
+    rawDtype = np.dtype({'names': ['deletionFlag'] + [field[0] for field in fields],
+                         'formats': ['S1'] + ['S' + str(field[2]) for field in fields],
+                         'offsets': [0] + [field[4] for field in fields],
+                         'itemsize': recordLength})
+
+    records = np.frombuffer(data, dtype=rawDtype, count=nRecords, offset=headerLength)
+    records = records[records['deletionFlag'] != b'*']
+
+    encoding = getEncoding(dbfFile)
+    columns = []
+    for name, fieldType, length, decimals, offset in fields:
+        columns.append(convertColumn(records[name], fieldType, decimals, encoding))
+
+    table = np.empty(len(records), dtype=[(str(field[0]), column.dtype) for field, column in zip(fields, columns)])
+    for field, column in zip(fields, columns):
+        table[str(field[0])] = column
+
+    return table
+
+
+def getSidecarFolder():
+
+    ''' Folder for table sidecars, in the cache folder from the configuration file or in the user's home directory '''
+
+    try:
+        import configuration
+        cacheFolder = configuration.factorCachePath
+
+    except Exception:
+        cacheFolder = os.path.join(os.path.expanduser('~'), 'LUCIcache')
+
+    return os.path.join(cacheFolder, 'tables')
+
+
+def getSidecarFile(dbfFile):
+
+    ''' Sidecar of a table, named after the table and a digest of its full path '''
+
+    pathDigest = hashlib.sha1(os.path.abspath(dbfFile).encode('utf-8')).hexdigest()[:16]
+
+    return os.path.join(getSidecarFolder(), os.path.basename(dbfFile) + '_' + pathDigest + '.npz')
+
+
+def readSidecar(dbfFile, fileStat):
+
+    ''' Returns the table from the .npz sidecar, or None if there is no sidecar or it is out of date '''
+
+    sidecarFile = getSidecarFile(dbfFile)
+
+    try:
+        if os.path.exists(sidecarFile):
+            with np.load(sidecarFile, allow_pickle=False) as sidecar:
+                if float(sidecar['mtime']) == fileStat.st_mtime and int(sidecar['size']) == fileStat.st_size:
+                    return sidecar['table']
+
+    except Exception:
+        pass # If the sidecar cannot be read, parse the table instead
+
+    return None
+
+
+def writeSidecar(dbfFile, fileStat, table):
+
+    sidecarFile = getSidecarFile(dbfFile)
+    tempFile = sidecarFile + '.' + str(os.getpid()) + '.tmp'
+
+    try:
+        if not os.path.exists(os.path.dirname(sidecarFile)):
+            os.makedirs(os.path.dirname(sidecarFile))
+
+        with open(tempFile, 'wb') as f:
+            np.savez(f, table=table, mtime=fileStat.st_mtime, size=fileStat.st_size)
+
+        if os.path.exists(sidecarFile):
+            os.remove(sidecarFile)
+        os.rename(tempFile, sidecarFile)
+
+    except Exception:
+        pass # The sidecar is only an optimisation, so ignore errors (e.g. if the cache folder cannot be written)
+
+
+def readTable(dbfFile, useSidecar=True):
+
+    '''
+    Returns the contents of a .dbf file as a read-only NumPy structured array.
+    The parsed table is cached for the process and, if useSidecar is True, in a .npz file in the cache folder.
+    '''
+
+    dbfFile = os.path.abspath(dbfFile)
+    fileStat = os.stat(dbfFile)
+    key = (dbfFile, fileStat.st_mtime, fileStat.st_size)
+
+    if key in tableCache:
+        return tableCache[key]
+
+    table = None
+    if useSidecar:
+        table = readSidecar(dbfFile, fileStat)
+
+    if table is None:
+        table = readDBF(dbfFile)
+
+        if useSidecar:
+            writeSidecar(dbfFile, fileStat, table)
+
+    table.flags.writeable = False
+
+    # Remove cached versions of the table from before it was modified
+    for cachedKey in list(tableCache):
+        if cachedKey[0] == dbfFile:
+            del tableCache[cachedKey]
+
+    tableCache[key] = table
+
+    return table
+
+
+def getField(table, fieldName):
+
+    ''' Returns a field of a table, matching the field name case-insensitively as ArcGIS does '''
+
+    for name in table.dtype.names:
+        if name.lower() == fieldName.lower():
+            return table[name]
+
+    raise KeyError('Field ' + str(fieldName) + ' not found in table')
@@ -0,0 +1,123 @@
+'''
+Exact Euclidean distance transform of NumPy masks, following the separable method of Meijster et al. (2000).
+
+The first phase finds the distance from each cell to the nearest feature cell in its own column, with one scan down
+and one scan up the rows. The second phase combines these along each row: the squared distance to the nearest feature
+is the minimum over the cells of the row of the squared column distance plus the squared horizontal offset. This
+minimum is found in linear time from the lower envelope of the parabolas rooted at the cells of the row (Felzenszwalb
+and Huttenlocher, 2012).
+
+The distance is only needed up to a maximum (e.g. a buffer distance), so the second phase only covers the rows and
+columns within that distance of a feature cell. The rows of this band are processed together, one column at a time,
+with each row keeping its own envelope.
+'''
+
+import numpy as np
+
+
+def columnDistances(features, maxDistance):
+
+    '''
+    Distance (in cells) from each cell to the nearest feature cell in the same column, or inf if it is further than
+    maxDistance
+    '''
+
+    nRows = features.shape[0]
+    distance = np.where(features, 0.0, np.inf)
+
+    for row in range(1, nRows):
+        np.minimum(distance[row], distance[row - 1] + 1.0, out=distance[row])
+
+    for row in range(nRows - 2, -1, -1):
+        np.minimum(distance[row], distance[row + 1] + 1.0, out=distance[row])
+
+    distance[distance > maxDistance] = np.inf
+
+    return distance
+
+
+def lowerEnvelope(f):
+
+    '''
+    Squared distance transform of each row of f (squared column distances, inf for none): the minimum over the
+    columns p of the row of f[p] + (q - p) ** 2, for each column q. The envelope of each row holds the columns of the
+    parabolas which form it (roots) and the columns where each starts to be the lowest (starts).
+    '''
+
+    nRows, nCols = f.shape
+    rows = np.arange(nRows)
+
+    roots = np.zeros((nRows, nCols), dtype=np.int64)
+    starts = np.full((nRows, nCols + 1), np.inf)
+    top = np.full(nRows, -1, dtype=np.int64)
+
+    def intersection(rowIndex, q):
+        p = roots[rowIndex, top[rowIndex]]
+        return ((f[rowIndex, q] + q * q) - (f[rowIndex, p] + p * p)) / (2.0 * (q - p))
+
+    for q in range(nCols):
+        active = rows[np.isfinite(f[:, q])]
+
+        # Remove the parabolas which the parabola rooted at q hides, row by row
+        popping = active[top[active] >= 0]
+        while len(popping) > 0:
+            hidden = intersection(popping, q) <= starts[popping, top[popping]]
+            popping = popping[hidden]
+            top[popping] -= 1
+            popping = popping[top[popping] >= 0]
+
+        first = active[top[active] < 0]
+        after = active[top[active] >= 0]
+        crossing = intersection(after, q)
+
+        top[active] += 1
+        roots[active, top[active]] = q
+        starts[first, 0] = -np.inf
+        starts[after, top[after]] = crossing
+        starts[active, top[active] + 1] = np.inf
+
+    # Read the envelope of each row from left to right
+    distanceSq = np.full((nRows, nCols), np.inf)
+    filled = rows[top >= 0]
+    current = np.zeros(nRows, dtype=np.int64)
+
+    for q in range(nCols):
+        advancing = filled[starts[filled, current[filled] + 1] < q]
+        while len(advancing) > 0:
+            current[advancing] += 1
+            advancing = advancing[starts[advancing, current[advancing] + 1] < q]
+
+        p = roots[filled, current[filled]]
+        distanceSq[filled, q] = f[filled, p] + (q - p) ** 2
+
+    return distanceSq
+
+
+def distanceTransform(features, maxDistance):
+
+    '''
+    Exact Euclidean distance (in cells) from each cell to the nearest cell of the boolean features mask. Cells further
+    than maxDistance cells from all features have a distance of inf.
+    '''
+
+    features = np.asarray(features, dtype=bool)
+    maxOffset = int(np.floor(maxDistance))
+
+    columnSq = columnDistances(features, maxOffset) ** 2
+    distance = np.full(features.shape, np.inf)
+
+    # Only the rows with a feature within maxDistance in their columns, and the columns within maxDistance of them
+    bandRows = np.flatnonzero(np.isfinite(columnSq).any(axis=1))
+    if len(bandRows) == 0:
+        return distance
+
+    bandCols = np.flatnonzero(features.any(axis=0))
+    firstCol = max(bandCols[0] - maxOffset, 0)
+    lastCol = min(bandCols[-1] + maxOffset, features.shape[1] - 1)
+
+    distanceSq = lowerEnvelope(columnSq[bandRows, firstCol:lastCol + 1])
+
+    distance[bandRows, firstCol:lastCol + 1] = np.sqrt(distanceSq)
+    distance[distance > maxDistance] = np.inf
+
+    return distance
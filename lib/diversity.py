@@ -0,0 +1,156 @@
+'''
+Diversity metrics of aggregation units, calculated for all units at once from a sparse unit x class area matrix.
+
+The matrix is held in compressed sparse row (CSR) form: for each unit (row), the classes present in it and their
+areas. Each metric is then a single array operation over the non-zero entries, grouped by unit with np.bincount,
+so millions of units can be handled without looping over them in Python.
+'''
+
+import numpy as np
+
+
+class UnitClassMatrix(object):
+
+    '''
+    Sparse matrix of the area of each class in each unit, in CSR form. The classes of unit i are
+    indices[indptr[i]:indptr[i + 1]], with their areas in the same positions of data.
+    '''
+
+    def __init__(self, indptr, indices, data, nClasses):
+
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.float64)
+        self.nUnits = len(self.indptr) - 1
+        self.nClasses = nClasses
+
+    @classmethod
+    def fromPairs(cls, unitIndex, classIndex, areas, nUnits, nClasses=None):
+
+        '''
+        Builds the matrix from (unit, class, area) triples, e.g. one per patch, summing the areas of repeated pairs.
+        Units and classes are given as indices from 0.
+        '''
+
+        unitIndex = np.asarray(unitIndex, dtype=np.int64)
+        classIndex = np.asarray(classIndex, dtype=np.int64)
+
+        if nClasses is None:
+            nClasses = int(classIndex.max()) + 1 if len(classIndex) > 0 else 0
+
+        # Group on a combined unit and class code, which also sorts the pairs by unit
+        pairs, pairIndex = np.unique(unitIndex * max(nClasses, 1) + classIndex, return_inverse=True)
+        data = np.bincount(pairIndex, weights=areas, minlength=len(pairs))
+
+        pairUnits = pairs // max(nClasses, 1)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(pairUnits, minlength=nUnits))])
+
+        return cls(indptr, pairs % max(nClasses, 1), data, nClasses)
+
+    def rowOf(self):
+
+        ''' Unit of each non-zero entry '''
+
+        return np.repeat(np.arange(self.nUnits), np.diff(self.indptr))
+
+    def rowSums(self):
+
+        return np.bincount(self.rowOf(), weights=self.data, minlength=self.nUnits)
+
+
+def proportions(matrix, unitSizes=None):
+
+    '''
+    Proportion of each unit covered by each class, for the non-zero entries of the matrix. The proportions are of
+    unitSizes (in the same units as the areas) if given, or of the total area of the classes in each unit.
+    '''
+
+    if unitSizes is None:
+        unitSizes = matrix.rowSums()
+
+    return matrix.data / np.asarray(unitSizes, dtype=np.float64)[matrix.rowOf()]
+
+
+def richness(matrix):
+
+    ''' Number of classes present in each unit '''
+
+    return np.diff(matrix.indptr)
+
+
+def shannon(matrix, unitSizes=None):
+
+    ''' Shannon index of each unit (-1 for units with no classes) '''
+
+    p = proportions(matrix, unitSizes)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = -np.bincount(matrix.rowOf(), weights=p * np.log(p), minlength=matrix.nUnits)
+
+    index[richness(matrix) == 0] = -1
+
+    return index
+
+
+def inverseSimpson(matrix, unitSizes=None):
+
+    ''' Inverse Simpson index of each unit (-1 for units with no classes) '''
+
+    p = proportions(matrix, unitSizes)
+
+    with np.errstate(divide='ignore'):
+        index = 1.0 / np.bincount(matrix.rowOf(), weights=p * p, minlength=matrix.nUnits)
+
+    index[richness(matrix) == 0] = -1
+
+    return index
+
+
+def evenness(matrix, unitSizes=None):
+
+    '''
+    Pielou's evenness of each unit: the Shannon index over its maximum, the log of the richness (-1 for units with
+    fewer than two classes)
+    '''
+
+    counts = richness(matrix)
+    index = np.full(matrix.nUnits, -1.0)
+
+    several = counts >= 2
+    index[several] = shannon(matrix, unitSizes)[several] / np.log(counts[several])
+
+    return index
+
+
+def meanPatchSize(unitIndex, patchAreas, nUnits):
+
+    ''' Mean area of the patches in each unit, given the unit and area of each patch (0 for units with no patches) '''
+
+    unitIndex = np.asarray(unitIndex, dtype=np.int64)
+
+    patchCounts = np.bincount(unitIndex, minlength=nUnits)
+    totals = np.bincount(unitIndex, weights=patchAreas, minlength=nUnits)
+
+    return np.where(patchCounts > 0, totals / np.maximum(patchCounts, 1), 0.0)
+
+
+def diversityMetrics(matrix, unitSizes=None, patchUnits=None, patchAreas=None, patchCounts=None):
+
+    '''
+    All of the diversity metrics of each unit, as a dictionary of arrays: 'richness', 'shannon', 'inverseSimpson',
+    'evenness' and (if the patches are given) 'meanPatch'. Patches can be given either as the unit and area of each
+    patch, or as the number of patches in each unit (the mean patch size is then the total area over the count).
+    '''
+
+    metrics = {'richness': richness(matrix),
+               'shannon': shannon(matrix, unitSizes),
+               'inverseSimpson': inverseSimpson(matrix, unitSizes),
+               'evenness': evenness(matrix, unitSizes)}
+
+    if patchUnits is not None:
+        metrics['meanPatch'] = meanPatchSize(patchUnits, patchAreas, matrix.nUnits)
+
+    elif patchCounts is not None:
+        metrics['meanPatch'] = np.where(patchCounts > 0, matrix.rowSums() / np.maximum(patchCounts, 1), 0.0)
+
+    return metrics
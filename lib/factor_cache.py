@@ -0,0 +1,550 @@
+'''
+Persistent, content-addressed cache of RUSLE factor rasters.
+
+Factors which depend only on the preprocessed data (the LS-factor from the slope and flow accumulation, and the
+K-factor looked up from the preprocessed soil) are stored as .npy files covering the DEM grid. Each entry is keyed on a
+hash of the input data, the factor options, the grid and the version of the RUSLE engine code, so reruns and accounts
+runs which use the same preprocessing folder reuse the stored factors rather than recalculating them.
+
+Input rasters are hashed from their files on disk. The digests are memoised in the cache index against the file
+modification times and sizes, so unchanged inputs are not read again. The cache is bounded in size, with the least
+recently used entries removed first.
+
+Several runs can share the cache folder. The index is only changed under a lock file: each run merges its changes with
+the index on disk before removing entries or writing the index, so entries added by other runs are kept.
+'''
+
+import os
+import json
+import time
+import hashlib
+import inspect
+import numpy as np
+import xml.etree.ElementTree as ET
+
+import LUCI_SEEA.lib.log as log
+import LUCI_SEEA.lib.rusle_engine as rusle_engine
+from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
+
+defaultMaxSizeGb = 10.0
+cacheFormat = 1 # Increase if the layout of cache entries changes
+lockTimeout = 60.0 # Seconds to wait for the index lock
+staleLockAge = 600.0 # Seconds after which a lock left by a run which stopped is removed
+
+
+def getCacheFolder():
+
+    ''' Returns the factor cache folder from the configuration file, or a folder in the user's home directory '''
+
+    try:
+        import configuration
+        return configuration.factorCachePath
+
+    except Exception:
+        return os.path.join(os.path.expanduser('~'), 'LUCIcache')
+
+
+def getMaxSizeGb():
+
+    ''' Returns the maximum cache size (in Gb) from the user settings file, or the default size if it is not set '''
+
+    try:
+        import configuration
+
+        if os.path.exists(configuration.userSettingsFile):
+
+            tree = ET.parse(configuration.userSettingsFile)
+            node = tree.getroot().find("factorCacheSize")
+
+            if node is not None and node.text:
+                return float(node.text)
+
+    except Exception:
+        pass # If any errors occur, ignore them. Just use the default size.
+
+    return defaultMaxSizeGb
+
+
+def getCodeVersion():
+
+    ''' Hash of the RUSLE engine source code, so that cached factors are not reused if the equations change '''
+
+    try:
+        source = inspect.getsource(rusle_engine)
+    except Exception:
+        source = ''
+
+    return hashlib.sha1((str(cacheFormat) + source).encode('utf-8')).hexdigest()
+
+
+def hashArray(array, digest=None):
+
+    if digest is None:
+        digest = hashlib.sha1()
+
+    array = np.ascontiguousarray(array)
+    digest.update(str(array.dtype).encode('utf-8'))
+    digest.update(str(array.shape).encode('utf-8'))
+    digest.update(array.tobytes())
+
+    return digest
+
+
+def lookupDigest(lookup):
+
+    ''' Digest of the code to factor mapping of a FactorLookup '''
+
+    digest = hashlib.sha1()
+
+    if lookup.dense:
+        hashArray(lookup.table, digest)
+        hashArray(lookup.known, digest)
+    else:
+        hashArray(lookup.keys, digest)
+        hashArray(lookup.values, digest)
+
+    return digest.hexdigest()
+
+
+class SourceDigests(object):
+
+    '''
+    Digests of raster sources, for comparing inputs between runs. File digests are memoised on their modification
+    times and sizes for the life of the object.
+    '''
+
+    def __init__(self):
+
+        self.codeVersion = getCodeVersion()
+        self.memo = {}
+
+    def digestMemo(self):
+
+        return self.memo
+
+    def fileDigest(self, path):
+
+        ''' Digest of a file's contents, memoised on its modification time and size '''
+
+        path = os.path.abspath(path)
+        fileStat = os.stat(path)
+
+        memo = self.digestMemo().get(path)
+        if memo is not None and memo[0] == fileStat.st_mtime and memo[1] == fileStat.st_size:
+            return memo[2]
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+
+        self.digestMemo()[path] = [fileStat.st_mtime, fileStat.st_size, digest.hexdigest()]
+
+        return digest.hexdigest()
+
+    def sourceDigest(self, source):
+
+        '''
+        Digest of a raster source: a NumPy array, or a raster file or folder (e.g. an ESRI grid) on disk.
+        Returns None if the source cannot be hashed, e.g. a raster inside a geodatabase.
+        '''
+
+        if isinstance(source, np.ndarray):
+            return hashArray(source).hexdigest()
+
+        if not isinstance(source, six.string_types):
+            return None
+
+        if os.path.isfile(source):
+            return self.fileDigest(source)
+
+        if os.path.isdir(source):
+            digest = hashlib.sha1()
+
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    digest.update(os.path.relpath(path, source).encode('utf-8'))
+                    digest.update(self.fileDigest(path).encode('utf-8'))
+
+            return digest.hexdigest()
+
+        return None
+
+
+class FactorCache(SourceDigests):
+
+    ''' Cache of factor rasters, stored as .npy files in the cache folder with a JSON index '''
+
+    def __init__(self, folder=None, maxSizeGb=None):
+
+        if folder is None:
+            folder = getCacheFolder()
+
+        if maxSizeGb is None:
+            maxSizeGb = getMaxSizeGb()
+
+        self.folder = folder
+        self.maxSize = int(maxSizeGb * 1024 ** 3)
+        self.indexFile = os.path.join(folder, 'index.json')
+        self.codeVersion = getCodeVersion()
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.lockFile = os.path.join(folder, 'index.lock')
+        self.index = self.readIndex()
+
+        # Keys removed by this run, and lookups since the index was last written, for merging with the index on disk
+        self.removed = set()
+        self.hits = 0
+        self.misses = 0
+
+    def digestMemo(self):
+
+        # File digests are kept in the index, so they are memoised between runs
+        return self.index['digests']
+
+    def readIndex(self):
+
+        index = {'entries': {}, 'digests': {}, 'hits': 0, 'misses': 0}
+
+        try:
+            if os.path.exists(self.indexFile):
+                with open(self.indexFile, 'r') as f:
+                    index.update(json.load(f))
+
+        except Exception:
+            pass # If the index cannot be read, start a new one
+
+        return index
+
+    def writeIndex(self):
+
+        tempFile = self.indexFile + '.tmp'
+
+        with open(tempFile, 'w') as f:
+            json.dump(self.index, f)
+
+        if os.path.exists(self.indexFile):
+            os.remove(self.indexFile)
+        os.rename(tempFile, self.indexFile)
+
+    def lock(self):
+
+        ''' Takes the index lock, waiting for other runs to release it. Returns False if it cannot be taken. '''
+
+        start = time.time()
+
+        while True:
+            try:
+                os.close(os.open(self.lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+
+            except OSError:
+                try:
+                    if time.time() - os.path.getmtime(self.lockFile) > staleLockAge:
+                        os.remove(self.lockFile)
+                        continue
+                except OSError:
+                    pass
+
+            if time.time() - start > lockTimeout:
+                return False
+
+            time.sleep(0.1)
+
+    def unlock(self):
+
+        try:
+            os.remove(self.lockFile)
+        except OSError:
+            pass
+
+    def mergeIndex(self):
+
+        '''
+        Merges this run's index with the index on disk: entries added by either are kept (with the latest use of
+        each), except entries removed by this run, and the hit and miss counts of this run are added.
+        '''
+
+        index = self.readIndex()
+        entries = index['entries']
+
+        for key, entry in self.index['entries'].items():
+            if key in entries:
+                entries[key]['lastUsed'] = max(entries[key]['lastUsed'], entry['lastUsed'])
+            else:
+                entries[key] = entry
+
+        for key in self.removed:
+            entries.pop(key, None)
+
+        index['digests'].update(self.index['digests'])
+        index['hits'] += self.hits
+        index['misses'] += self.misses
+
+        self.index = index
+        self.removed = set()
+        self.hits = 0
+        self.misses = 0
+
+    def sync(self):
+
+        '''
+        Merges the index with the index on disk, removes old entries if the cache is too large and writes the index,
+        under the index lock. The cache is only an optimisation, so if the lock cannot be taken the index is left to
+        be written later.
+        '''
+
+        if not self.lock():
+            log.warning('Factor cache index is locked by another run: ' + str(self.lockFile))
+            return
+
+        try:
+            self.mergeIndex()
+            self.evict()
+            self.writeIndex()
+
+        except Exception:
+            log.warning('Factor cache index could not be written: ' + str(self.indexFile))
+
+        finally:
+            self.unlock()
+
+    def key(self, factor, sources, options, grid):
+
+        '''
+        Cache key for a factor calculated from the given sources (a list of rasters) and options (a list of strings
+        and numbers, e.g. the LS option and cell size). Returns None if any of the sources cannot be hashed.
+        '''
+
+        digest = hashlib.sha1()
+        digest.update(self.codeVersion.encode('utf-8'))
+        digest.update(str(factor).encode('utf-8'))
+
+        for source in sources:
+            sourceDigest = self.sourceDigest(source)
+            if sourceDigest is None:
+                return None
+
+            digest.update(sourceDigest.encode('utf-8'))
+
+        gridValues = [grid.xMin, grid.yMax, grid.cellSize, grid.nRows, grid.nCols]
+        for value in list(options) + gridValues:
+            digest.update(repr(value).encode('utf-8'))
+
+        return factor + '_' + digest.hexdigest()
+
+    def entryFile(self, key):
+
+        return os.path.join(self.folder, key + '.npy')
+
+    def tempFile(self, key):
+
+        ''' File to write a new entry to, before it is added with store() '''
+
+        return os.path.join(self.folder, key + '.tmp.npy')
+
+    def get(self, key):
+
+        ''' Returns the cached entry (a dictionary including its 'file') for a key, or None if it is not cached '''
+
+        entry = self.index['entries'].get(key)
+
+        if entry is None:
+            # The entry may have been added by another run since the index was read
+            entry = self.readIndex()['entries'].get(key)
+
+        if entry is None or not os.path.exists(self.entryFile(key)):
+            self.index['entries'].pop(key, None)
+            self.misses += 1
+            return None
+
+        entry['lastUsed'] = time.time()
+        self.index['entries'][key] = entry
+        self.hits += 1
+
+        # Record the use on disk straight away, so that other runs do not remove the entry while it is being read
+        self.sync()
+
+        return dict(entry, file=self.entryFile(key))
+
+    def store(self, key, tempFile, metadata=None):
+
+        ''' Adds a file written with tempFile() to the cache, then removes old entries if the cache is too large '''
+
+        entryFile = self.entryFile(key)
+
+        if os.path.exists(entryFile):
+            os.remove(entryFile)
+        os.rename(tempFile, entryFile)
+
+        entry = {'size': os.path.getsize(entryFile), 'created': time.time(), 'lastUsed': time.time()}
+        if metadata is not None:
+            entry.update(metadata)
+
+        self.index['entries'][key] = entry
+        self.sync()
+
+    def evict(self):
+
+        '''
+        Removes the least recently used entries until the cache is within its maximum size. Only entries in the index
+        are removed, so this should be called on the index merged with the index on disk.
+        '''
+
+        entries = self.index['entries']
+
+        for key in sorted(entries, key=lambda key: entries[key]['lastUsed']):
+            if self.totalSize() <= self.maxSize:
+                break
+
+            try:
+                if os.path.exists(self.entryFile(key)):
+                    os.remove(self.entryFile(key))
+            except Exception:
+                continue # File in use (e.g. memory mapped by another run). Try again next time.
+
+            del entries[key]
+
+        # Remove digests of files which no longer exist
+        for path in list(self.index['digests']):
+            if not os.path.exists(path):
+                del self.index['digests'][path]
+
+    def totalSize(self):
+
+        return sum([entry['size'] for entry in self.index['entries'].values()])
+
+    def close(self):
+
+        ''' Writes the cache index, merged with the index on disk '''
+
+        self.sync()
+
+    def stats(self):
+
+        ''' Number of entries, total size, maximum size, hits and misses of the cache '''
+
+        return {'entries': len(self.index['entries']),
+                'size': self.totalSize(),
+                'maxSize': self.maxSize,
+                'hits': self.index['hits'] + self.hits,
+                'misses': self.index['misses'] + self.misses}
+
+    def report(self):
+
+        ''' Cache statistics as a list of lines of text '''
+
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+
+        lines = ['Factor cache: ' + self.folder,
+                 'Entries: ' + str(stats['entries']),
+                 'Size: ' + str(round(stats['size'] / 1024.0 ** 2, 1)) + ' Mb of ' +
+                 str(round(stats['maxSize'] / 1024.0 ** 3, 1)) + ' Gb']
+
+        if lookups > 0:
+            lines.append('Hits: ' + str(stats['hits']) + ' of ' + str(lookups) + ' (' +
+                         str(round(100.0 * stats['hits'] / lookups, 1)) + '%)')
+
+        return lines
+
+
+def cachedFactors(cache, sources, lookups, lsOption, soilOption, cellSize, grid, lsExponents=None, checked=None):
+
+    '''
+    Replaces the LS- and K-factor inputs of a RUSLE run with cached factors where they are available.
+
+    Returns the updated sources and lookups, a dictionary of the keys of factors which are not cached (so they can be
+    written to the cache during the run) and the unmatched K-factor codes of cached entries.
+    checked is an optional dictionary of the entries already found for a run, so that scenarios which share factors
+    only look them up once.
+    '''
+
+    if lsExponents is None:
+        lsExponents = rusle_engine.defaultExponents
+
+    if checked is None:
+        checked = {}
+
+    sources = dict(sources)
+    lookups = dict(lookups)
+    misses = {}
+    unmatched = {}
+
+    keys = {}
+
+    if lsOption == 'SlopeLength':
+        keys['LS'] = cache.key('LS', [sources['slope']], [lsOption, cellSize, float(lsExponents[0])], grid)
+
+    elif lsOption == 'UpslopeArea':
+        keys['LS'] = cache.key('LS', [sources['slope'], sources['flowAcc']],
+                               [lsOption, cellSize, float(lsExponents[0]), float(lsExponents[1])], grid)
+
+    # Only the K-factor looked up from the preprocessed soil is cached. Local K-factor data is used directly.
+    if 'K' in lookups:
+        keys['K'] = cache.key('K', [sources['K']], [soilOption, lookupDigest(lookups['K'])], grid)
+
+    for factor, key in keys.items():
+        if key is None:
+            continue
+
+        if key not in checked:
+            checked[key] = cache.get(key)
+
+            if checked[key] is not None:
+                log.info(factor + '-factor read from the factor cache')
+
+        entry = checked[key]
+
+        if entry is None:
+            misses[factor] = key
+
+        else:
+            sources[factor] = entry['file']
+            lookups.pop(factor, None)
+
+            if entry.get('unmatched'):
+                unmatched[factor] = np.array(entry['unmatched'])
+
+    return sources, lookups, misses, unmatched
+
+
+def openCache():
+
+    ''' Returns the factor cache, or None if it cannot be opened, in which case all factors are calculated '''
+
+    try:
+        return FactorCache()
+
+    except Exception:
+        log.warning('Factor cache could not be opened. RUSLE factors will be calculated rather than reused.')
+        return None
+
+
+def storeFactor(cache, key, writer, unmatched=None):
+
+    ''' Closes a writer created on cache.tempFile(key) and adds the factor it has written to the cache '''
+
+    metadata = {}
+    if unmatched is not None:
+        metadata['unmatched'] = sorted([int(code) for code in unmatched])
+
+    try:
+        cache.store(key, writer.close(), metadata)
+
+    except Exception:
+        log.warning('Factor could not be added to the factor cache: ' + str(key))
+
+
+def logReport(cache):
+
+    ''' Writes the cache index and logs the cache statistics '''
+
+    cache.close()
+
+    for line in cache.report():
+        log.info(line)
@@ -0,0 +1,92 @@
+'''
+Lookup of factor values (e.g. K-factor from soil codes, C-factor from land cover codes) for blocks of categorical rasters.
+
+The code to factor mapping is held as a dense NumPy array indexed by code when the codes are small non-negative
+integers, or as sorted key/value arrays for sparse codes (such as the HWSD MU_GLOBAL codes). Each block is then mapped
+with a single vectorised gather rather than joining the lookup table onto the raster.
+'''
+
+import numpy as np
+
+import LUCI_SEEA.lib.dbf_tables as dbf_tables
+
+maxDenseSize = 1000000 # Largest code for which a dense lookup array is used
+
+
+class FactorLookup(object):
+
+    ''' Maps integer codes to factor values '''
+
+    def __init__(self, codes, values):
+
+        codes = np.asarray(codes, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+
+        self.dense = codes.size > 0 and codes.min() >= 0 and codes.max() < maxDenseSize
+
+        if self.dense:
+            self.table = np.full(codes.max() + 1, np.nan)
+            self.table[codes] = values
+            self.known = np.zeros(codes.max() + 1, dtype=bool)
+            self.known[codes] = True
+
+        else:
+            order = np.argsort(codes, kind='mergesort')
+            self.keys = codes[order]
+            self.values = values[order]
+
+    def lookup(self, codeBlock):
+
+        '''
+        Maps a block of codes (float array with NoData as NaN) to factor values.
+        Returns the factor block and the unique codes which are not in the lookup table.
+        Cells with NoData or unmatched codes are NoData (NaN) in the factor block.
+        '''
+
+        factorBlock = np.full(codeBlock.shape, np.nan)
+
+        hasData = ~np.isnan(codeBlock)
+        codes = codeBlock[hasData].astype(np.int64)
+        factors = np.full(codes.shape, np.nan)
+
+        if self.dense:
+            found = (codes >= 0) & (codes < len(self.table))
+            found[found] = self.known[codes[found]]
+            factors[found] = self.table[codes[found]]
+
+        elif len(self.keys) > 0:
+            positions = np.searchsorted(self.keys, codes)
+            positions = np.minimum(positions, len(self.keys) - 1)
+            found = self.keys[positions] == codes
+            factors[found] = self.values[positions[found]]
+
+        else:
+            found = np.zeros(codes.shape, dtype=bool)
+
+        factorBlock[hasData] = factors
+
+        return factorBlock, np.unique(codes[~found])
+
+
+def loadLookup(table, codeField, factorField):
+
+    '''
+    Reads the code and factor fields of a table into a FactorLookup.
+    .dbf tables are read with the cached dbf_tables reader; other tables are read through arcpy.
+    '''
+
+    if table.lower().endswith('.dbf'):
+        array = dbf_tables.readTable(table)
+        codes = dbf_tables.getField(array, codeField)
+        factors = dbf_tables.getField(array, factorField).astype(np.float64)
+
+        # Skip rows with blank codes or factors
+        valid = ~(np.isnan(codes.astype(np.float64)) | np.isnan(factors))
+
+        return FactorLookup(codes[valid], factors[valid])
+
+    import arcpy
+
+    array = arcpy.da.TableToNumPyArray(table, [codeField, factorField], skip_nulls=True)
+
+    return FactorLookup(array[codeField], array[factorField])
@@ -0,0 +1,378 @@
+'''
+Depression (sink) filling of DEMs on NumPy arrays, with the method of Planchon and Darboux (2002).
+
+Every cell is raised to the lowest level at which water can drain from it to an outlet of the DEM (a cell on its edge
+or next to NoData). The water levels start at infinity away from the outlets and are lowered by sweeping the DEM a
+whole row or column at a time from each side in turn, until they no longer change, so no Python loop runs per cell.
+With an epsilon, filled areas are given a small gradient towards their outlet rather than being left flat.
+
+fillSinksTiled fills rasters larger than memory tile by tile, following Barnes (2016). Each tile is first filled from
+its own edges, with each edge cell labelling the cells it fills. The lowest spill elevations between labels, within
+tiles and across tile edges, form a small graph covering the whole DEM, from which the water level of each tile edge
+cell is found. A second pass then fills each tile from its edge cells raised to these levels. Only the tile edges and
+the graph are kept between passes, so memory is bounded by the tile size.
+'''
+
+import heapq
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+
+oceanLabel = 0 # Label of cells which drain to an outlet of the DEM
+noLabel = -1
+
+
+def outletCells(padded):
+
+    '''
+    Flat indices of the outlet cells of a DEM padded with a ring of extra cells: cells inside the ring which have data
+    and have a NoData (NaN) neighbour. The ring itself is only used as the neighbours of the cells next to it.
+    '''
+
+    noData = np.isnan(padded)
+    nRows, nCols = padded.shape
+
+    nearNoData = np.zeros(padded.shape, dtype=bool)
+    inner = nearNoData[1:-1, 1:-1]
+
+    for dRow in [-1, 0, 1]:
+        for dCol in [-1, 0, 1]:
+            if dRow != 0 or dCol != 0:
+                inner |= noData[1 + dRow:nRows - 1 + dRow, 1 + dCol:nCols - 1 + dCol]
+
+    nearNoData[1:-1, 1:-1] &= ~noData[1:-1, 1:-1]
+
+    return np.flatnonzero(nearNoData)
+
+
+def addEdge(edges, labelA, labelB, spill):
+
+    ''' Records the spill elevation between two labels, keeping the lowest '''
+
+    key = (labelA, labelB) if labelA < labelB else (labelB, labelA)
+
+    if spill < edges.get(key, np.inf):
+        edges[key] = spill
+
+
+def sweep(dem, filled, fixed, epsilon, labels, stamps, crossStamps, since, tick):
+
+    '''
+    Lowers the water levels of one array from its first row to its last, in place: each cell not fixed is lowered to
+    the lowest level of its three neighbours in the row above plus epsilon, but not below its own elevation.
+    The rows are processed in turn, so a level can be carried the whole way down in a single sweep.
+    If labels is given, lowered cells take the label of the neighbour they are lowered from.
+
+    stamps and crossStamps hold the last sweep (tick) in which each row and each column was lowered. Rows below a row
+    which has not been lowered since this sweep last ran cannot be lowered, and are skipped.
+    Returns whether any cell was lowered.
+    '''
+
+    nRows, nCols = dem.shape
+    above = np.full(nCols + 2, np.inf)
+    changed = False
+
+    for row in range(1, nRows):
+        if stamps[row - 1] <= since:
+            continue
+
+        above[1:-1] = filled[row - 1]
+        lowest = np.minimum(above[:-2], above[1:-1])
+        np.minimum(lowest, above[2:], out=lowest)
+
+        level = np.maximum(dem[row], lowest + epsilon)
+        lowered = level < filled[row]
+        lowered &= ~fixed[row]
+
+        if lowered.any():
+            changed = True
+            columns = np.flatnonzero(lowered)
+            current = filled[row]
+            current[columns] = level[columns]
+            stamps[row] = tick
+            crossStamps[columns] = tick
+
+            if labels is not None:
+                nearest = np.argmin([above[columns], above[columns + 1], above[columns + 2]], axis=0)
+                labels[row][columns] = labels[row - 1][columns + nearest - 1]
+
+    return changed
+
+
+def flood(padded, seeds, seedValues, epsilon=0.0, labels=None):
+
+    '''
+    Fills a DEM padded with a ring of NoData (NaN) cells from the seed cells (flat indices), which are held at the
+    water levels seedValues. Returns the filled DEM, with the shape of padded.
+
+    This is the method of Planchon and Darboux (2002), with the water level of every other cell starting at infinity
+    and lowered towards the seeds by sweeping the array from each side in turn, until the levels no longer change.
+    Each sweep works on a whole row (or column) at a time, so the loop over cells is done by NumPy.
+
+    labels is an optional array of labels shaped like padded, with the labels of the seeds set and noLabel elsewhere.
+    Each cell is then given the label of a seed it is filled from, in place.
+    '''
+
+    noData = np.isnan(padded)
+    dem = np.where(noData, np.inf, padded)
+
+    filled = np.full(padded.shape, np.inf)
+    filled.ravel()[seeds] = seedValues
+
+    fixed = noData.copy()
+    fixed.ravel()[seeds] = True
+
+    rowStamps = np.ones(padded.shape[0], dtype=np.int64)
+    colStamps = np.ones(padded.shape[1], dtype=np.int64)
+
+    # Top to bottom, bottom to top, left to right and right to left, with the stamps of their rows and columns
+    views = [(lambda array: array, rowStamps, colStamps),
+             (lambda array: array[::-1], rowStamps[::-1], colStamps),
+             (lambda array: array.T, colStamps, rowStamps),
+             (lambda array: array.T[::-1], colStamps[::-1], rowStamps)]
+    lastSweeps = [0] * len(views)
+    tick = 1
+
+    changed = True
+    while changed:
+        changed = False
+
+        for i, (view, stamps, crossStamps) in enumerate(views):
+            tick += 1
+            viewLabels = None if labels is None else view(labels)
+            changed |= sweep(view(dem), view(filled), view(fixed), epsilon, viewLabels, stamps, crossStamps,
+                             lastSweeps[i], tick)
+            lastSweeps[i] = tick
+
+    filled[noData] = np.nan
+
+    return filled
+
+
+def spillEdges(filled, labels, edges):
+
+    '''
+    Records in the edges dictionary the lowest spill elevation between each pair of adjacent labels: the higher water
+    level of the two cells, over all pairs of neighbouring cells with these labels.
+    '''
+
+    nRows, nCols = labels.shape
+    pairs = []
+
+    for dRow, dCol in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        rows = slice(0, nRows - dRow)
+        neighbourRows = slice(dRow, nRows)
+        cols = slice(max(0, -dCol), nCols - max(0, dCol))
+        neighbourCols = slice(max(0, dCol), nCols + min(0, dCol))
+
+        labelsA = labels[rows, cols]
+        labelsB = labels[neighbourRows, neighbourCols]
+
+        adjacent = (labelsA != labelsB) & (labelsA != noLabel) & (labelsB != noLabel)
+        labelsA = labelsA[adjacent]
+        labelsB = labelsB[adjacent]
+
+        pairs.append((np.minimum(labelsA, labelsB), np.maximum(labelsA, labelsB),
+                      np.maximum(filled[rows, cols][adjacent], filled[neighbourRows, neighbourCols][adjacent])))
+
+    low = np.concatenate([pair[0] for pair in pairs])
+    high = np.concatenate([pair[1] for pair in pairs])
+    spills = np.concatenate([pair[2] for pair in pairs])
+
+    # Keep the lowest spill of each pair of labels
+    order = np.lexsort((spills, high, low))
+    low, high, spills = low[order], high[order], spills[order]
+    first = np.ones(len(low), dtype=bool)
+    first[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+
+    for labelA, labelB, spill in zip(low[first].tolist(), high[first].tolist(), spills[first].tolist()):
+        addEdge(edges, labelA, labelB, spill)
+
+
+def fillSinks(dem, epsilon=0.0):
+
+    '''
+    Fills the sinks of a DEM array (NoData as NaN). Water drains from the edges of the DEM and from cells next to NoData.
+    If epsilon is greater than zero, each filled cell is at least epsilon higher than the cell it drains to, so that
+    filled areas slope towards their outlets. The epsilon should be large enough to be kept when the DEM is stored
+    (e.g. as 32 bit floats). Returns the filled DEM as a float64 array.
+    '''
+
+    dem = np.asarray(dem, dtype=np.float64)
+    padded = np.pad(dem, 1, mode='constant', constant_values=np.nan)
+
+    seeds = outletCells(padded)
+    filled = flood(padded, seeds, padded.ravel()[seeds], epsilon)
+
+    return filled[1:-1, 1:-1]
+
+
+def tileSeeds(dem, grid, block):
+
+    '''
+    Reads a tile with a halo of one cell and finds the cells a flood of the tile starts from: the outlets of the DEM
+    within the tile, and the other cells on the edge of the tile. Returns the tile padded with NaN (the halo is only
+    used to find the outlets), the outlet cells and the other edge cells (flat indices of the padded tile).
+    '''
+
+    padded = raster_blocks.readBlock(dem, grid, block)
+    outlets = outletCells(padded)
+
+    padded[0, :] = np.nan
+    padded[-1, :] = np.nan
+    padded[:, 0] = np.nan
+    padded[:, -1] = np.nan
+
+    edge = np.zeros(padded.shape, dtype=bool)
+    edge[1, 1:-1] = True
+    edge[-2, 1:-1] = True
+    edge[1:-1, 1] = True
+    edge[1:-1, -2] = True
+
+    edge &= ~np.isnan(padded)
+    edge.ravel()[outlets] = False
+
+    return padded, outlets, np.flatnonzero(edge)
+
+
+def tileSides(padded, values):
+
+    ''' The top, bottom, left and right edge cells of a padded tile, as lists, for joining adjacent tiles '''
+
+
+    return {'top': values[1, 1:-1].tolist(),
+            'bottom': values[-2, 1:-1].tolist(),
+            'left': values[1:-1, 1].tolist(),
+            'right': values[1:-1, -2].tolist()}
+
+
+def joinSides(edges, labelsA, levelsA, labelsB, levelsB, diagonal=True):
+
+    '''
+    Records the spill elevations between the edge cells of two adjacent tiles, given as lists of labels and filled
+    levels along the shared edge. Each cell is joined to the cells opposite it, and to their neighbours if diagonal.
+    '''
+
+    shifts = [-1, 0, 1] if diagonal else [0]
+
+    for shift in shifts:
+        for i in range(max(0, -shift), min(len(labelsA), len(labelsB) - shift)):
+            labelA = labelsA[i]
+            labelB = labelsB[i + shift]
+
+            if labelA != noLabel and labelB != noLabel and labelA != labelB:
+                addEdge(edges, labelA, labelB, max(levelsA[i], levelsB[i + shift]))
+
+
+def labelLevels(edges):
+
+    '''
+    Water level of each label: the lowest elevation at which water can spill from it to the outlets of the DEM,
+    found with a priority flood of the label graph from the ocean label.
+    '''
+
+    graph = {}
+    for (labelA, labelB), spill in edges.items():
+        graph.setdefault(labelA, []).append((labelB, spill))
+        graph.setdefault(labelB, []).append((labelA, spill))
+
+    levels = {oceanLabel: -np.inf}
+    heap = [(-np.inf, oceanLabel)]
+
+    while heap:
+        level, label = heapq.heappop(heap)
+
+        if level > levels[label]:
+            continue
+
+        for neighbour, spill in graph.get(label, []):
+            neighbourLevel = max(level, spill)
+
+            if neighbourLevel < levels.get(neighbour, np.inf):
+                levels[neighbour] = neighbourLevel
+                heapq.heappush(heap, (neighbourLevel, neighbour))
+
+    return levels
+
+
+def fillSinksTiled(dem, outputRaster, grid=None, epsilon=0.0, tileSize=None):
+
+    '''
+    Fills the sinks of a raster (or .npy file or array) tile by tile, and writes the filled DEM to outputRaster.
+    The result is the same as fillSinks on the whole DEM. With an epsilon, filled areas slope towards their outlets
+    within each tile, but filled flats which cross tile edges may be left flat along the tile edge.
+    Returns the output raster.
+    '''
+
+    if grid is None:
+        grid = raster_blocks.getGrid(dem)
+
+    # First pass: fill each tile from its edges, labelling the cells filled from each edge cell
+    blocks = {}
+    sides = {}
+    seedLabels = {}
+    edges = {}
+    nextLabel = oceanLabel + 1
+
+    for block in raster_blocks.iterBlocks(grid, tileSize, halo=1):
+        padded, outlets, edgeCells = tileSeeds(dem, grid, block)
+
+        labels = np.full(padded.shape, noLabel, dtype=np.int64)
+        labels.ravel()[outlets] = oceanLabel
+        labels.ravel()[edgeCells] = np.arange(nextLabel, nextLabel + len(edgeCells))
+        nextLabel += len(edgeCells)
+
+        seeds = np.concatenate([outlets, edgeCells])
+        filled = flood(padded, seeds, padded.ravel()[seeds], 0.0, labels)
+        spillEdges(filled, labels, edges)
+
+        key = (block.row, block.col)
+        blocks[key] = block
+        sides[key] = (tileSides(padded, labels), tileSides(padded, filled))
+        seedLabels[key] = labels.ravel()[edgeCells]
+
+    # Join the edges of adjacent tiles
+    rowStarts = sorted(set([key[0] for key in blocks]))
+    colStarts = sorted(set([key[1] for key in blocks]))
+
+    for i, row in enumerate(rowStarts):
+        for j, col in enumerate(colStarts):
+            labels, levels = sides[(row, col)]
+
+            if j + 1 < len(colStarts):
+                rightLabels, rightLevels = sides[(row, colStarts[j + 1])]
+                joinSides(edges, labels['right'], levels['right'], rightLabels['left'], rightLevels['left'])
+
+            if i + 1 < len(rowStarts):
+                belowLabels, belowLevels = sides[(rowStarts[i + 1], col)]
+                joinSides(edges, labels['bottom'], levels['bottom'], belowLabels['top'], belowLevels['top'])
+
+                # Corner cells of diagonally adjacent tiles
+                if j + 1 < len(colStarts):
+                    cornerLabels, cornerLevels = sides[(rowStarts[i + 1], colStarts[j + 1])]
+                    joinSides(edges, labels['bottom'][-1:], levels['bottom'][-1:],
+                              cornerLabels['top'][:1], cornerLevels['top'][:1], False)
+
+                if j > 0:
+                    cornerLabels, cornerLevels = sides[(rowStarts[i + 1], colStarts[j - 1])]
+                    joinSides(edges, labels['bottom'][:1], levels['bottom'][:1],
+                              cornerLabels['top'][-1:], cornerLevels['top'][-1:], False)
+
+    levels = labelLevels(edges)
+
+    # Second pass: fill each tile from its outlets and its edge cells raised to their water levels
+    writer = raster_blocks.createWriter(outputRaster, grid)
+
+    for key, block in blocks.items():
+        padded, outlets, edgeCells = tileSeeds(dem, grid, block)
+
+        edgeLevels = np.array([levels.get(label, -np.inf) for label in seedLabels[key].tolist()])
+        edgeValues = np.maximum(padded.ravel()[edgeCells], edgeLevels)
+
+        seeds = np.concatenate([outlets, edgeCells])
+        seedValues = np.concatenate([padded.ravel()[outlets], edgeValues])
+
+        filled = flood(padded, seeds, seedValues, epsilon)
+        writer.write(block, filled[1:-1, 1:-1])
+
+    return writer.close()
@@ -0,0 +1,331 @@
+'''
+Flow accumulation over a D8 flow direction grid in linear time.
+
+Each cell's downstream neighbour is held as a flat int32 index, and the number of cells flowing into each cell (its
+in-degree) is counted. Cells are then processed in topological order (Kahn's algorithm): starting from the cells with
+no inflow, each cell whose inflows are all known passes its accumulation on to its downstream cell. The cells of each
+step are handled together as arrays, so every cell is visited once.
+
+Several weights (e.g. cell area, or soil loss for sediment routing) can be accumulated in the same traversal.
+As with arcpy.sa.FlowAccumulation, the accumulation of a cell is the total weight of the cells upstream of it,
+not including the cell itself.
+
+flowAccumulationTiled accumulates rasters larger than memory tile by tile, following Barnes (2017). In a first pass,
+each tile is accumulated on its own, and each cell on the perimeter of the tile is linked to the cell in the next tile
+which its flow enters. These links, with the flow leaving each tile, form a small graph of the perimeter cells, which
+is accumulated in the same way to give the inflow from other tiles into each perimeter cell. A second pass then
+accumulates each tile again with these inflows added. Only the perimeter graph is kept between passes, and the tiles
+of both passes can be processed in parallel worker processes.
+'''
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.flow_direction as flow_direction
+
+
+def downstreamIndex(fdr):
+
+    '''
+    Flat index of the cell each cell flows to, from ESRI flow direction codes (NoData as NaN).
+    Cells which flow off the grid or into NoData, and NoData cells, have an index of -1.
+    '''
+
+    nRows, nCols = fdr.shape
+    valid = ~np.isnan(fdr)
+
+    codes = np.zeros(fdr.shape, dtype=np.int64)
+    codes[valid] = fdr[valid]
+
+    # Neighbour index (0 to 7) of each ESRI code
+    codeIndex = np.full(129, -1, dtype=np.int64)
+    codeIndex[flow_direction.esriCodes] = np.arange(8)
+
+    direction = codeIndex[np.clip(codes, 0, 128)]
+    valid &= direction >= 0
+
+    rows, cols = np.indices(fdr.shape)
+    downRows = rows + np.array(flow_direction.neighbourRows)[direction]
+    downCols = cols + np.array(flow_direction.neighbourCols)[direction]
+
+    valid &= (downRows >= 0) & (downRows < nRows) & (downCols >= 0) & (downCols < nCols)
+
+    down = np.full(fdr.size, -1, dtype=np.int32)
+    down[valid.ravel()] = (downRows * nCols + downCols)[valid].astype(np.int32)
+
+    # Flow into NoData cells leaves the grid
+    noData = np.isnan(fdr).ravel()
+    into = down >= 0
+    into[into] = noData[down[into]]
+    down[into] = -1
+
+    return down
+
+
+def accumulate(down, weights, initial=None):
+
+    '''
+    Accumulates the weights (an array with one row per weight and one column per cell) down the flow network given by
+    downstream indices. initial optionally gives inflows from outside the grid to add to each cell, as for weights.
+    Returns the accumulations (the same shape as weights) and a mask of the cells which could not be ordered because
+    they are on a loop in the flow directions (their accumulations are incomplete).
+    '''
+
+    nCells = len(down)
+    accumulation = np.zeros(weights.shape) if initial is None else np.array(initial, dtype=np.float64)
+
+    flows = np.flatnonzero(down >= 0).astype(np.int32)
+    inDegree = np.bincount(down[flows], minlength=nCells).astype(np.int32)
+
+    frontier = np.flatnonzero(inDegree == 0).astype(np.int32)
+    ordered = np.zeros(nCells, dtype=bool)
+
+    while len(frontier) > 0:
+        ordered[frontier] = True
+
+        frontier = frontier[down[frontier] >= 0]
+        targets = down[frontier]
+
+        # Pass the accumulation of each cell and its own weight on to its downstream cell
+        np.add.at(accumulation.T, targets, (accumulation[:, frontier] + weights[:, frontier]).T)
+        np.subtract.at(inDegree, targets, 1)
+
+        targets = np.unique(targets)
+        frontier = targets[inDegree[targets] == 0]
+
+    return accumulation, ~ordered
+
+
+def flowAccumulation(fdr, weights=None):
+
+    '''
+    Flow accumulation of an array of ESRI flow direction codes (NoData as NaN).
+    weights is an optional list of weight arrays on the same grid. A weight of None counts cells, and NoData weights
+    count as zero. Returns a list of accumulation arrays, one per weight (or a single cell count), with NoData as NaN.
+    '''
+
+    if weights is None:
+        weights = [None]
+
+    fdr = np.asarray(fdr, dtype=np.float64)
+    noData = np.isnan(fdr).ravel()
+
+    weightStack = np.ones((len(weights), fdr.size))
+    for i, weight in enumerate(weights):
+        if weight is not None:
+            weight = np.asarray(weight, dtype=np.float64).ravel()
+            weightStack[i] = np.where(np.isnan(weight), 0.0, weight)
+
+    weightStack[:, noData] = 0.0
+
+    accumulation, loops = accumulate(downstreamIndex(fdr), weightStack)
+    accumulation[:, noData] = np.nan
+
+    return [layer.reshape(fdr.shape) for layer in accumulation]
+
+
+def exitCells(down):
+
+    '''
+    Flat index of the last cell on the flow path of each cell within a network of downstream indices (the cell itself
+    if it has no downstream cell), found by pointer jumping. Cells on loops have an index of -1.
+    '''
+
+    nCells = len(down)
+    ptr = np.where(down >= 0, down, np.arange(nCells))
+
+    # After k jumps each cell points 2^k cells down its path, so every path is covered after log2(nCells) jumps
+    for _ in range(int(np.ceil(np.log2(max(nCells, 2)))) + 1):
+        ptr = ptr[ptr]
+
+    return np.where(down[ptr] < 0, ptr, -1)
+
+
+def readTile(block, grid, fdrRaster, weightRasters):
+
+    '''
+    Reads a tile of the flow direction raster with a halo of one cell (block.halo must be 1) and the weight rasters
+    (None counts cells). Returns the downstream index of each cell of the tile within the tile (-1 if its flow leaves
+    the tile), the global flat index of the cell outside the tile which its flow enters (-1 if none), the weights and
+    a mask of the NoData cells (all flattened).
+    '''
+
+    padded = raster_blocks.readBlock(fdrRaster, grid, block)
+    paddedCols = block.nCols + 2
+
+    down = downstreamIndex(padded).reshape(padded.shape)[1:-1, 1:-1].ravel()
+    noData = np.isnan(padded[1:-1, 1:-1]).ravel()
+
+    # Row and column of the downstream cell within the tile
+    flows = down >= 0
+    downRows = down // paddedCols - 1
+    downCols = down % paddedCols - 1
+
+    inside = flows & (downRows >= 0) & (downRows < block.nRows) & (downCols >= 0) & (downCols < block.nCols)
+    leaving = flows & ~inside
+
+    localDown = np.full(down.shape, -1, dtype=np.int32)
+    localDown[inside] = (downRows * block.nCols + downCols)[inside]
+
+    outCell = np.full(down.shape, -1, dtype=np.int64)
+    outCell[leaving] = ((block.row + downRows[leaving]).astype(np.int64) * grid.nCols
+                        + block.col + downCols[leaving])
+
+    innerBlock = raster_blocks.Block(block.row, block.col, block.nRows, block.nCols)
+
+    weights = np.ones((len(weightRasters), down.size))
+    for i, weightRaster in enumerate(weightRasters):
+        if weightRaster is not None:
+            weight = raster_blocks.readBlock(weightRaster, grid, innerBlock).ravel()
+            weights[i] = np.where(np.isnan(weight), 0.0, weight)
+
+    weights[:, noData] = 0.0
+
+    return localDown, outCell, weights, noData
+
+
+def perimeterCells(block, grid, noData):
+
+    ''' Flat indices within the tile, and global flat indices, of the cells with data on the perimeter of a tile '''
+
+    perimeter = np.zeros((block.nRows, block.nCols), dtype=bool)
+    perimeter[0, :] = True
+    perimeter[-1, :] = True
+    perimeter[:, 0] = True
+    perimeter[:, -1] = True
+
+    cells = np.flatnonzero(perimeter.ravel() & ~noData)
+    globalCells = (block.row + cells // block.nCols).astype(np.int64) * grid.nCols + block.col + cells % block.nCols
+
+    return cells, globalCells
+
+
+def tileBoundary(block, grid, fdrRaster, weightRasters):
+
+    '''
+    First pass over a tile: accumulates the tile on its own and returns its part of the perimeter graph, as the global
+    indices of its perimeter cells, the cell in another tile which the flow through each perimeter cell enters (-1
+    if none), the cells in other tiles which flow from the tile enters, and the accumulated flow (one row per weight)
+    entering each of them from the tile.
+    Defined at module level so that tiles can be processed in worker processes.
+    '''
+
+    localDown, outCell, weights, noData = readTile(block, grid, fdrRaster, weightRasters)
+    accumulation, loops = accumulate(localDown, weights)
+
+    cells, globalCells = perimeterCells(block, grid, noData)
+
+    exits = exitCells(localDown)[cells]
+    links = np.where(exits >= 0, outCell[np.maximum(exits, 0)], -1)
+
+    leaving = np.flatnonzero(outCell >= 0)
+    outflows = accumulation[:, leaving] + weights[:, leaving]
+
+    return globalCells, links, outCell[leaving], outflows
+
+
+def tileAccumulation(block, grid, fdrRaster, weightRasters, nodesFile, inflowsFile):
+
+    '''
+    Second pass over a tile: accumulates the tile with the inflows from other tiles (read from the perimeter graph
+    files) added at its perimeter cells. Returns the accumulation arrays of the tile, one per weight.
+    Defined at module level so that tiles can be processed in worker processes.
+    '''
+
+    localDown, outCell, weights, noData = readTile(block, grid, fdrRaster, weightRasters)
+    cells, globalCells = perimeterCells(block, grid, noData)
+
+    nodes = np.load(nodesFile, mmap_mode='r')
+    inflows = np.load(inflowsFile, mmap_mode='r')
+
+    initial = np.zeros(weights.shape)
+    initial[:, cells] = inflows[:, np.searchsorted(nodes, globalCells)]
+
+    accumulation, loops = accumulate(localDown, weights, initial)
+    accumulation[:, noData] = np.nan
+
+    return [layer.reshape(block.nRows, block.nCols) for layer in accumulation]
+
+
+def perimeterInflows(boundaries, nWeights):
+
+    '''
+    Solves the perimeter graph given by the tileBoundary results of all tiles. Returns the sorted global indices of the
+    perimeter cells, and the inflow from other tiles into each of them (one row per weight).
+    '''
+
+    nodes = np.concatenate([boundary[0] for boundary in boundaries])
+    links = np.concatenate([boundary[1] for boundary in boundaries])
+
+    order = np.argsort(nodes)
+    nodes = nodes[order]
+    links = links[order]
+
+    down = np.full(len(nodes), -1, dtype=np.int64)
+    linked = links >= 0
+    down[linked] = np.searchsorted(nodes, links[linked])
+
+    # Flow leaving each tile enters the graph at the perimeter cell it flows into
+    initial = np.zeros((nWeights, len(nodes)))
+    for boundary in boundaries:
+        outCells, outflows = boundary[2:]
+        np.add.at(initial.T, np.searchsorted(nodes, outCells), outflows.T)
+
+    inflows, loops = accumulate(down, np.zeros(initial.shape), initial)
+
+    return nodes, inflows
+
+
+def flowAccumulationTiled(fdrRaster, outputRasters, weightRasters=None, grid=None, tileSize=None, workers=1):
+
+    '''
+    Flow accumulation of a flow direction raster (or .npy file or array) tile by tile, with each of a list of weight
+    rasters (None counts cells), written to the matching output rasters. The result is the same as flowAccumulation
+    on the whole grid. Returns the output rasters.
+    '''
+
+    if grid is None:
+        grid = raster_blocks.getGrid(fdrRaster)
+
+    if weightRasters is None:
+        weightRasters = [None] * len(outputRasters)
+
+    blocks = list(raster_blocks.iterBlocks(grid, tileSize, halo=1))
+
+    # First pass: accumulate each tile on its own, keeping the perimeter graph
+    boundaries = [boundary for block, boundary in raster_blocks.processBlocks(tileBoundary, blocks,
+                                                                              (grid, fdrRaster, weightRasters),
+                                                                              workers)]
+
+    nodes, inflows = perimeterInflows(boundaries, len(weightRasters))
+    del boundaries
+
+    # The solved graph is passed to the workers as memory mapped files rather than being copied to every tile
+    graphFolder = tempfile.mkdtemp()
+
+    try:
+        nodesFile = os.path.join(graphFolder, 'nodes.npy')
+        inflowsFile = os.path.join(graphFolder, 'inflows.npy')
+        np.save(nodesFile, nodes)
+        np.save(inflowsFile, inflows)
+        del nodes, inflows
+
+        # Second pass: accumulate each tile with the inflows from other tiles
+        writers = [raster_blocks.createWriter(outputRaster, grid) for outputRaster in outputRasters]
+
+        for block, accumulations in raster_blocks.processBlocks(tileAccumulation, blocks,
+                                                                (grid, fdrRaster, weightRasters,
+                                                                 nodesFile, inflowsFile),
+                                                                workers):
+            for writer, accumulation in zip(writers, accumulations):
+                writer.write(block, accumulation)
+
+        outputRasters = [writer.close() for writer in writers]
+
+    finally:
+        shutil.rmtree(graphFolder, ignore_errors=True)
+
+    return outputRasters
@@ -0,0 +1,456 @@
+'''
+D8 flow direction of DEMs on NumPy tiles.
+
+The drop to each of the 8 neighbours of every cell in a tile is found with shifted array comparisons, and each cell
+flows to the neighbour with the steepest drop. Flow directions are given both as the ESRI power of two codes
+(1 = east, 2 = south east, ... 128 = north east) and in degrees clockwise from north, from the same pass.
+
+As with arcpy.sa.FlowDirection, cells on the edge of the data with no lower neighbour flow out of the DEM, and cells
+lower than all of their neighbours flow to their lowest neighbour. Flat areas (e.g. filled sinks) are drained along
+the shortest path to the edge of the flat (Jenson and Domingue, 1988): each flat cell flows to a neighbour of the
+same elevation which is one step closer to a cell that can drain, so flow on flats never loops.
+
+The distances across flats are found by sweeping each tile a whole row or column at a time, as in fill_sinks, and
+tiles whose flats do not cross their edges are done in a single read of the DEM. In tiles with flats crossing their
+edges, the flat cells next to other tiles are nodes of a graph of flats, and each flat cell is labelled with the node
+or draining cell it is nearest to. The shortest paths between adjacent labels form the edges of the graph, which is
+solved once for the whole DEM, and a second pass drains each of these tiles towards its nodes. Flow on flats crossing
+tile edges never loops, but its path may be a little longer than the shortest path across the whole flat.
+'''
+
+import os
+import heapq
+import shutil
+import tempfile
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+
+# Neighbours in the order of the ESRI codes: east, south east, south, south west, west, north west, north, north east
+neighbourRows = [0, 1, 1, 1, 0, -1, -1, -1]
+neighbourCols = [1, 1, 0, -1, -1, -1, 0, 1]
+esriCodes = np.array([1, 2, 4, 8, 16, 32, 64, 128])
+degrees = np.array([90, 135, 180, 225, 270, 315, 0, 45])
+distances = np.array([1.0, np.sqrt(2.0), 1.0, np.sqrt(2.0), 1.0, np.sqrt(2.0), 1.0, np.sqrt(2.0)])
+
+outletLabel = -1 # Label of flat cells nearest to a cell which can drain, in the graph of flats
+noLabel = -2
+
+
+def neighbours(padded):
+
+    ''' Stack of the 8 neighbours of each inner cell of an array padded with a ring of one cell '''
+
+    nRows, nCols = padded.shape
+
+    return np.array([padded[1 + dRow:nRows - 1 + dRow, 1 + dCol:nCols - 1 + dCol]
+                     for dRow, dCol in zip(neighbourRows, neighbourCols)])
+
+
+def steepestDescent(padded):
+
+    '''
+    D8 flow direction of the inner cells of an array padded with a ring of one cell (NoData as NaN), except on flats.
+    Returns the index of the neighbour each cell flows to (see neighbourRows and neighbourCols, -1 for NoData and flat
+    cells), a mask of the flat cells, and the drop to each neighbour.
+    '''
+
+    dem = padded[1:-1, 1:-1]
+    valid = ~np.isnan(dem)
+
+    neighbourDem = neighbours(padded)
+    noDataNeighbour = np.isnan(neighbourDem)
+
+    drops = (dem[np.newaxis] - neighbourDem) / distances[:, np.newaxis, np.newaxis]
+    drops[noDataNeighbour] = -np.inf
+
+    # Steepest drop. Ties go to the first neighbour in the order of the ESRI codes.
+    steepest = np.argmax(drops, axis=0)
+    maxDrop = np.max(drops, axis=0)
+
+    direction = np.where(maxDrop > 0, steepest, -1)
+
+    # Edge cells with no lower neighbour flow out of the DEM
+    edge = noDataNeighbour.any(axis=0)
+    outward = (maxDrop <= 0) & edge
+    direction[outward] = np.argmax(noDataNeighbour, axis=0)[outward]
+
+    # Cells lower than all their neighbours flow to the lowest neighbour
+    sink = (maxDrop < 0) & ~edge
+    direction[sink] = np.argmin(np.where(noDataNeighbour, np.inf, neighbourDem), axis=0)[sink]
+
+    direction[~valid] = -1
+    flat = (maxDrop == 0) & ~edge & valid
+
+    return direction, flat, drops
+
+
+def sameElevationNeighbour(elevation, mask):
+
+    ''' Cells of an array which have a neighbour in mask with the same elevation '''
+
+    padded = np.pad(np.where(mask, elevation, np.nan), 1, mode='constant', constant_values=np.nan)
+
+    return (neighbours(padded) == elevation[np.newaxis]).any(axis=0)
+
+
+def sweepFlats(elevation, distance, passable, labels, stamps, crossStamps, since, tick):
+
+    '''
+    Lowers the distances across flats of one array from its first row to its last, in place: each passable cell is
+    lowered to one more than the lowest distance of its neighbours in the row above with the same elevation.
+    If labels is given, lowered cells take the label of the neighbour they are lowered from.
+
+    stamps and crossStamps hold the last sweep (tick) in which each row and each column was lowered. Rows below a row
+    which has not been lowered since this sweep last ran cannot be lowered, and are skipped.
+    Returns whether any cell was lowered.
+    '''
+
+    nRows, nCols = elevation.shape
+    above = np.full(nCols + 2, np.inf)
+    aboveElevation = np.full(nCols + 2, np.nan)
+    changed = False
+
+    for row in range(1, nRows):
+        if stamps[row - 1] <= since:
+            continue
+
+        above[1:-1] = distance[row - 1]
+        aboveElevation[1:-1] = elevation[row - 1]
+        here = elevation[row]
+
+        candidates = np.array([np.where(aboveElevation[:-2] == here, above[:-2], np.inf),
+                               np.where(aboveElevation[1:-1] == here, above[1:-1], np.inf),
+                               np.where(aboveElevation[2:] == here, above[2:], np.inf)])
+        lowest = candidates.min(axis=0) + 1
+
+        lowered = lowest < distance[row]
+        lowered &= passable[row]
+
+        if lowered.any():
+            changed = True
+            columns = np.flatnonzero(lowered)
+            current = distance[row]
+            current[columns] = lowest[columns]
+            stamps[row] = tick
+            crossStamps[columns] = tick
+
+            if labels is not None:
+                labels[row][columns] = labels[row - 1][columns + candidates[:, columns].argmin(axis=0) - 1]
+
+    return changed
+
+
+def flatDistance(elevation, distance, passable, labels=None):
+
+    '''
+    Distances across flats (Jenson and Domingue, 1988): the number of steps over cells of the same elevation from each
+    passable cell to a cell with a known distance. distance holds the known distances (infinity elsewhere) and is
+    lowered in place, by sweeping the array from each side in turn until the distances no longer change, as in
+    fill_sinks.flood. If labels is given, each cell is given the label of a cell it is reached from, in place.
+    '''
+
+    rowStamps = np.ones(elevation.shape[0], dtype=np.int64)
+    colStamps = np.ones(elevation.shape[1], dtype=np.int64)
+
+    # Top to bottom, bottom to top, left to right and right to left, with the stamps of their rows and columns
+    views = [(lambda array: array, rowStamps, colStamps),
+             (lambda array: array[::-1], rowStamps[::-1], colStamps),
+             (lambda array: array.T, colStamps, rowStamps),
+             (lambda array: array.T[::-1], colStamps[::-1], rowStamps)]
+    lastSweeps = [0] * len(views)
+    tick = 1
+
+    changed = True
+    while changed:
+        changed = False
+
+        for i, (view, stamps, crossStamps) in enumerate(views):
+            tick += 1
+            viewLabels = None if labels is None else view(labels)
+            changed |= sweepFlats(view(elevation), view(distance), view(passable), viewLabels, stamps, crossStamps,
+                                  lastSweeps[i], tick)
+            lastSweeps[i] = tick
+
+
+def drainFlats(elevation, direction, distance, flat, drops):
+
+    '''
+    Gives flow directions to the flat cells inside the ring of an array, towards the neighbour of the same elevation
+    with the lowest distance across flats, if it is lower than their own (ties go to the first neighbour in the order
+    of the ESRI codes). Closed flats (e.g. in unfilled DEMs) flow to the first neighbour of the same elevation.
+    Returns the directions of the cells inside the ring.
+    '''
+
+    inner = direction[1:-1, 1:-1]
+    innerFlat = flat[1:-1, 1:-1]
+
+    candidates = np.where(neighbours(elevation) == elevation[1:-1, 1:-1], neighbours(distance), np.inf)
+    nearest = np.argmin(candidates, axis=0)
+
+    drained = innerFlat & (np.min(candidates, axis=0) < distance[1:-1, 1:-1])
+    inner[drained] = nearest[drained]
+
+    closed = innerFlat & ~drained
+    inner[closed] = np.argmax(drops[:, 1:-1, 1:-1] == 0, axis=0)[closed]
+
+    return inner
+
+
+def flatEdges(elevation, distance, labels):
+
+    '''
+    Edges of the graph of flats between each pair of adjacent labels, as arrays of the two labels and the length of
+    the shortest path between them through the cells of the two labels: the distances of two neighbouring cells of
+    the same elevation plus one step between them.
+    '''
+
+    nRows, nCols = labels.shape
+    pairs = []
+
+    for dRow, dCol in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        rows = slice(0, nRows - dRow)
+        neighbourRows = slice(dRow, nRows)
+        cols = slice(max(0, -dCol), nCols - max(0, dCol))
+        neighbourCols = slice(max(0, dCol), nCols + min(0, dCol))
+
+        labelsA = labels[rows, cols]
+        labelsB = labels[neighbourRows, neighbourCols]
+
+        adjacent = ((labelsA != labelsB) & (labelsA != noLabel) & (labelsB != noLabel)
+                    & (elevation[rows, cols] == elevation[neighbourRows, neighbourCols]))
+
+        labelsA = labelsA[adjacent]
+        labelsB = labelsB[adjacent]
+
+        pairs.append((np.minimum(labelsA, labelsB), np.maximum(labelsA, labelsB),
+                      distance[rows, cols][adjacent] + distance[neighbourRows, neighbourCols][adjacent] + 1))
+
+    low = np.concatenate([pair[0] for pair in pairs])
+    high = np.concatenate([pair[1] for pair in pairs])
+    lengths = np.concatenate([pair[2] for pair in pairs])
+
+    # Keep the shortest path between each pair of labels
+    order = np.lexsort((lengths, high, low))
+    low, high, lengths = low[order], high[order], lengths[order]
+    first = np.ones(len(low), dtype=bool)
+    first[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+
+    return low[first], high[first], lengths[first]
+
+
+def tileDirections(block, grid, dem, nodes=None, potentials=None):
+
+    '''
+    D8 flow direction of a tile, read with a halo of two cells (block.halo must be 2).
+
+    Flat cells on the edge of the tile next to flat cells of the same elevation in other tiles are the tile's nodes
+    of the graph of flats, labelled with their global flat index. Without nodes, this is the first pass: if the tile
+    has no such cells, returns its directions and None. Otherwise the flats of the tile are labelled with the node
+    or outlet they are nearest to, and None and the tile's edges of the graph of flats are returned.
+    With the sorted global indices of the nodes and their distances across flats (potentials), from the solved graph,
+    returns the directions of the tile, drained towards the nodes.
+    '''
+
+    padded = raster_blocks.readBlock(dem, grid, block)
+
+    # Directions of the tile and of the ring of cells around it
+    direction, flat, drops = steepestDescent(padded)
+    elevation = padded[1:-1, 1:-1]
+
+    inner = np.zeros(direction.shape, dtype=bool)
+    inner[1:-1, 1:-1] = True
+
+    innerFlat = flat & inner
+    outerFlat = flat & ~inner
+
+    # Nodes of the graph of flats: flat cells of the tile and of the ring which are next to each other
+    tileNodes = innerFlat & sameElevationNeighbour(elevation, outerFlat)
+    tileNodes |= outerFlat & sameElevationNeighbour(elevation, innerFlat)
+
+    drain = (direction >= 0) & ~flat
+    distance = np.where(drain, 0.0, np.inf)
+
+    if nodes is None and not tileNodes.any():
+        if innerFlat.any():
+            flatDistance(elevation, distance, innerFlat)
+            drainFlats(elevation, direction, distance, flat, drops)
+
+        return direction[1:-1, 1:-1], None
+
+    rows, cols = np.nonzero(tileNodes)
+    globalCells = (block.row - 1 + rows).astype(np.int64) * grid.nCols + block.col - 1 + cols
+
+    if nodes is None:
+        labels = np.full(direction.shape, noLabel, dtype=np.int64)
+        labels[drain] = outletLabel
+        labels[rows, cols] = globalCells
+        distance[rows, cols] = 0.0
+
+        flatDistance(elevation, distance, innerFlat & ~tileNodes, labels)
+
+        return None, flatEdges(elevation, distance, labels)
+
+    found = np.minimum(np.searchsorted(nodes, globalCells), len(nodes) - 1)
+    distance[rows, cols] = np.where(nodes[found] == globalCells, potentials[found], np.inf)
+
+    flatDistance(elevation, distance, innerFlat & ~tileNodes)
+
+    return drainFlats(elevation, direction, distance, flat, drops)
+
+
+def encode(direction, values):
+
+    ''' Converts neighbour indices to codes or degrees (NaN for NoData) '''
+
+    encoded = np.full(direction.shape, np.nan)
+    valid = direction >= 0
+    encoded[valid] = values[direction[valid]]
+
+    return encoded
+
+
+def flowDirectionBlock(block, grid, dem):
+
+    '''
+    First pass over a tile. Returns the neighbour index each cell flows to and None if the flats of the tile do not
+    cross its edges, and otherwise None and the tile's edges of the graph of flats.
+    Defined at module level so that tiles can be processed in worker processes.
+    '''
+
+    direction, edges = tileDirections(block, grid, dem)
+
+    if direction is not None:
+        direction = direction.astype(np.int8)
+
+    return direction, edges
+
+
+def tileFlowDirection(block, grid, dem, nodesFile, potentialsFile):
+
+    '''
+    Second pass over a tile whose flats cross its edges, with the distances across flats of the nodes of the graph of
+    flats read from the solved graph files. Returns the neighbour index each cell of the tile flows to.
+    Defined at module level so that tiles can be processed in worker processes.
+    '''
+
+    nodes = np.load(nodesFile, mmap_mode='r')
+    potentials = np.load(potentialsFile, mmap_mode='r')
+
+    return tileDirections(block, grid, dem, nodes, potentials).astype(np.int8)
+
+
+def flatPotentials(edges):
+
+    '''
+    Solves the graph of flats given by the flatEdges of all tiles whose flats cross their edges, with Dijkstra's
+    algorithm from the outlet label. Returns the sorted global indices of the nodes and the distance across flats of
+    each of them (infinity for nodes on closed flats).
+    '''
+
+    labelsA = np.concatenate([edge[0] for edge in edges])
+    labelsB = np.concatenate([edge[1] for edge in edges])
+    lengths = np.concatenate([edge[2] for edge in edges])
+
+    labels, indices = np.unique(np.concatenate([labelsA, labelsB]), return_inverse=True)
+    nEdges = len(labelsA)
+
+    # Each edge in both directions, grouped by the node it starts from
+    starts = np.concatenate([indices[:nEdges], indices[nEdges:]])
+    ends = np.concatenate([indices[nEdges:], indices[:nEdges]])
+    lengths = np.concatenate([lengths, lengths])
+
+    order = np.argsort(starts, kind='mergesort')
+    ends = ends[order].tolist()
+    lengths = lengths[order].tolist()
+    offsets = np.searchsorted(starts[order], np.arange(len(labels) + 1)).tolist()
+
+    potentials = [np.inf] * len(labels)
+    heap = []
+
+    if labels[0] == outletLabel:
+        potentials[0] = 0.0
+        heap.append((0.0, 0))
+
+    while heap:
+        potential, node = heapq.heappop(heap)
+
+        if potential > potentials[node]:
+            continue
+
+        for i in range(offsets[node], offsets[node + 1]):
+            neighbourPotential = potential + lengths[i]
+
+            if neighbourPotential < potentials[ends[i]]:
+                potentials[ends[i]] = neighbourPotential
+                heapq.heappush(heap, (neighbourPotential, ends[i]))
+
+    nodes = labels >= 0
+
+    return labels[nodes], np.array(potentials)[nodes]
+
+
+def flowDirection(dem, fdrRaster, degreesRaster=None, grid=None, tileSize=None, workers=1):
+
+    '''
+    Calculates the D8 flow direction of a DEM tile by tile, and writes the ESRI codes to fdrRaster and (optionally)
+    the directions in degrees to degreesRaster in the same pass. Returns the output rasters.
+    '''
+
+    if grid is None:
+        grid = raster_blocks.getGrid(dem)
+
+    blocks = list(raster_blocks.iterBlocks(grid, tileSize, halo=2))
+
+    fdrWriter = raster_blocks.createWriter(fdrRaster, grid, "8_BIT_UNSIGNED")
+
+    degreesWriter = None
+    if degreesRaster is not None:
+        degreesWriter = raster_blocks.createWriter(degreesRaster, grid, "16_BIT_UNSIGNED")
+
+    def write(block, direction):
+        fdrWriter.write(block, encode(direction, esriCodes))
+
+        if degreesWriter is not None:
+            degreesWriter.write(block, encode(direction, degrees))
+
+    # First pass: tiles whose flats do not cross their edges are written straight away, and the others only keep
+    # their edges of the graph of flats
+    edges = []
+    pending = []
+
+    for block, (direction, tileEdges) in raster_blocks.processBlocks(flowDirectionBlock, blocks, (grid, dem), workers):
+        if direction is not None:
+            write(block, direction)
+        else:
+            edges.append(tileEdges)
+            pending.append(block)
+
+    # Second pass over the tiles with flats crossing their edges, drained along the solved graph of flats
+    if len(pending) > 0:
+        nodes, potentials = flatPotentials(edges)
+        del edges
+
+        # The solved graph is passed to the workers as memory mapped files rather than being copied to every tile
+        graphFolder = tempfile.mkdtemp()
+
+        try:
+            nodesFile = os.path.join(graphFolder, 'nodes.npy')
+            potentialsFile = os.path.join(graphFolder, 'potentials.npy')
+            np.save(nodesFile, nodes)
+            np.save(potentialsFile, potentials)
+            del nodes, potentials
+
+            for block, direction in raster_blocks.processBlocks(tileFlowDirection, pending,
+                                                                (grid, dem, nodesFile, potentialsFile), workers):
+                write(block, direction)
+
+        finally:
+            shutil.rmtree(graphFolder, ignore_errors=True)
+
+    fdrRaster = fdrWriter.close()
+
+    if degreesWriter is not None:
+        degreesRaster = degreesWriter.close()
+
+    return fdrRaster, degreesRaster
@@ -0,0 +1,197 @@
+'''
+Aggregation of a classified raster (e.g. land cover) over aggregation units, on NumPy tiles.
+
+The units are rasterised onto the grid of the classified raster, so that each cell has a unit and a class. In each
+tile, the pair is encoded as a single code (unit * number of classes + class) and the cells of every unit and class
+are counted with one np.bincount. The counts of all tiles form the unit x class matrix used for the diversity metrics.
+
+Patches are the 4-connected groups of cells with the same unit and class. They are labelled in each tile with a
+vectorised union-find (hooking the larger root of each pair of joined cells onto the smaller, then pointer jumping),
+and patches which cross tile edges are joined by the same union-find over the cells along the tile edges.
+'''
+
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.diversity as diversity
+
+
+def unionPairs(nNodes, nodesA, nodesB):
+
+    ''' Root (smallest member) of the set of each node, after joining each pair of nodes nodesA[i] and nodesB[i] '''
+
+    parent = np.arange(nNodes)
+
+    while True:
+        rootsA = parent[nodesA]
+        rootsB = parent[nodesB]
+
+        unjoined = rootsA != rootsB
+        if not unjoined.any():
+            return parent
+
+        nodesA = nodesA[unjoined]
+        nodesB = nodesB[unjoined]
+
+        # Hook the larger root onto the smaller, then point every node at its root
+        np.minimum.at(parent, np.maximum(rootsA[unjoined], rootsB[unjoined]),
+                      np.minimum(rootsA[unjoined], rootsB[unjoined]))
+
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def labelComponents(codes):
+
+    '''
+    Labels the 4-connected groups of cells with the same code (cells with negative codes are not labelled). Returns
+    the flat index of the root cell of each cell's group (-1 for cells which are not labelled).
+    '''
+
+    nRows, nCols = codes.shape
+    flatCodes = codes.ravel()
+    cells = np.arange(codes.size).reshape(codes.shape)
+
+    nodesA = np.concatenate([cells[:, :-1].ravel(), cells[:-1, :].ravel()])
+    nodesB = np.concatenate([cells[:, 1:].ravel(), cells[1:, :].ravel()])
+
+    joined = (flatCodes[nodesA] >= 0) & (flatCodes[nodesA] == flatCodes[nodesB])
+
+    roots = unionPairs(codes.size, nodesA[joined], nodesB[joined])
+
+    return np.where(flatCodes >= 0, roots, -1)
+
+
+def tileCounts(block, grid, unitRaster, classRaster, unitIds):
+
+    '''
+    Counts the cells of each unit and class in a tile, and labels its patches. Returns the (unit index, class value,
+    count) of each pair in the tile, the unit index of each patch in the tile, and the unit index, class value and
+    global patch label of the cells along each edge of the tile (for joining patches across tile edges).
+    Defined at module level so that tiles can be processed in worker processes.
+    '''
+
+    units = raster_blocks.readBlock(unitRaster, grid, block)
+    classes = raster_blocks.readBlock(classRaster, grid, block)
+
+    valid = ~(np.isnan(units) | np.isnan(classes))
+
+    # Index of the unit of each cell (units not in unitIds are ignored)
+    unitIndex = np.full(units.shape, -1, dtype=np.int64)
+    position = np.minimum(np.searchsorted(unitIds, units[valid]), len(unitIds) - 1)
+    unitIndex[valid] = np.where(unitIds[position] == units[valid], position, -1)
+    valid &= unitIndex >= 0
+
+    classValues, classIndex = np.unique(classes[valid], return_inverse=True)
+    nClasses = max(len(classValues), 1)
+
+    codes = np.full(units.shape, -1, dtype=np.int64)
+    codes[valid] = unitIndex[valid] * nClasses + classIndex
+
+    # Cell counts of each unit and class in one bincount, over the range of units in the tile
+    pairUnits = np.zeros(0, dtype=np.int64)
+    pairClasses = np.zeros(0)
+    pairCounts = np.zeros(0, dtype=np.int64)
+
+    if valid.any():
+        firstCode = codes[valid].min() - codes[valid].min() % nClasses
+        counts = np.bincount(codes[valid] - firstCode)
+
+        pairs = np.flatnonzero(counts)
+        pairUnits = (pairs + firstCode) // nClasses
+        pairClasses = classValues[pairs % nClasses]
+        pairCounts = counts[pairs]
+
+    # Patches, labelled by the global flat index of their root cell
+    roots = labelComponents(codes).reshape(codes.shape)
+    patchUnits = unitIndex.ravel()[np.flatnonzero(roots.ravel() == np.arange(roots.size))]
+
+    rootRows = roots // block.nCols
+    labels = np.where(roots >= 0, (block.row + rootRows) * grid.nCols + block.col + roots % block.nCols, -1)
+
+    cellClasses = np.where(valid, classes, np.nan)
+    edges = {}
+    for side, index in [('top', (0, slice(None))), ('bottom', (-1, slice(None))),
+                        ('left', (slice(None), 0)), ('right', (slice(None), -1))]:
+        edges[side] = (unitIndex[index], cellClasses[index], labels[index])
+
+    return (pairUnits, pairClasses, pairCounts), patchUnits, edges
+
+
+def seamPairs(edgeA, edgeB):
+
+    ''' Patch labels of the cells along a shared tile edge which are in the same unit and class, and their unit '''
+
+    unitsA, classesA, labelsA = edgeA
+    unitsB, classesB, labelsB = edgeB
+
+    same = (labelsA >= 0) & (labelsB >= 0) & (unitsA == unitsB) & (classesA == classesB)
+
+    return labelsA[same], labelsB[same], unitsA[same]
+
+
+def aggregateRaster(unitRaster, classRaster, unitIds, grid=None, cellArea=1.0, tileSize=None, workers=1):
+
+    '''
+    Aggregates a classified raster over the units of a unit raster on the same grid (cell values are the unit ids).
+    Returns the unit x class area matrix (a diversity.UnitClassMatrix, with units in the order of the sorted unit ids
+    and areas in cell counts times cellArea), the class values of its columns, and the number of patches in each unit.
+    '''
+
+    if grid is None:
+        grid = raster_blocks.getGrid(classRaster)
+
+    unitIds = np.sort(np.asarray(unitIds, dtype=np.float64))
+    nUnits = len(unitIds)
+
+    pairs = []
+    patchUnits = []
+    edges = {}
+
+    blocks = raster_blocks.iterBlocks(grid, tileSize)
+    for block, result in raster_blocks.processBlocks(tileCounts, blocks, (grid, unitRaster, classRaster, unitIds),
+                                                     workers):
+        pairs.append(result[0])
+        patchUnits.append(result[1])
+        edges[(block.row, block.col)] = result[2]
+
+    pairUnits = np.concatenate([np.zeros(0, dtype=np.int64)] + [pair[0] for pair in pairs])
+    pairClasses = np.concatenate([np.zeros(0)] + [pair[1] for pair in pairs])
+    pairCounts = np.concatenate([np.zeros(0, dtype=np.int64)] + [pair[2] for pair in pairs])
+
+    classValues, classIndex = np.unique(pairClasses, return_inverse=True)
+    matrix = diversity.UnitClassMatrix.fromPairs(pairUnits, classIndex, pairCounts * float(cellArea), nUnits,
+                                                 len(classValues))
+
+    patchCounts = np.bincount(np.concatenate([np.zeros(0, dtype=np.int64)] + patchUnits), minlength=nUnits)
+
+    # Join patches across tile edges. Each join of two separate patches removes one patch from the unit.
+    seams = []
+    for (row, col), tileEdges in edges.items():
+
+        right = edges.get((row, col + (len(tileEdges['top'][0]))))
+        if right is not None:
+            seams.append(seamPairs(tileEdges['right'], right['left']))
+
+        below = edges.get((row + len(tileEdges['left'][0]), col))
+        if below is not None:
+            seams.append(seamPairs(tileEdges['bottom'], below['top']))
+
+    if len(seams) > 0:
+        labelsA = np.concatenate([seam[0] for seam in seams])
+        labelsB = np.concatenate([seam[1] for seam in seams])
+        seamUnits = np.concatenate([seam[2] for seam in seams])
+
+        nodes, nodeIndex = np.unique(np.concatenate([labelsA, labelsB]), return_inverse=True)
+        nodeUnits = np.zeros(len(nodes), dtype=np.int64)
+        nodeUnits[nodeIndex] = np.concatenate([seamUnits, seamUnits])
+
+        roots = unionPairs(len(nodes), nodeIndex[:len(labelsA)], nodeIndex[len(labelsA):])
+
+        merged = np.bincount(nodeUnits, minlength=nUnits) - np.bincount(nodeUnits[np.unique(roots)], minlength=nUnits)
+        patchCounts -= merged
+
+    return matrix, classValues, patchCounts
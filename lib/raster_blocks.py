@@ -0,0 +1,394 @@
+'''
+Block-wise reading and writing of rasters, so that tools can work on NumPy tiles rather than on whole rasters.
+Peak memory is then bounded by the tile size rather than by the size of the raster.
+
+Blocks are addressed on the cell grid of a reference raster (normally the DEM). Any raster on the same cell grid
+can be read for a block, even if its extent differs from the reference raster - cells outside its extent are NoData.
+Blocks can have a halo of extra cells around them for neighbourhood operations; halo cells beyond the edge of the
+grid are NoData.
+
+Rasters can be ArcGIS rasters, NumPy arrays or .npy files. The NumPy backends do not need arcpy, so that the
+block-based calculations can be run and checked without ArcGIS.
+'''
+
+import os
+import sys
+import platform
+import multiprocessing
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
+
+defaultTileSize = 2048
+noDataValue = -3.4028235e+38 # Float32 NoData value used when writing blocks
+
+
+class Grid(object):
+    ''' Cell grid of a raster: top left corner, cell size and number of rows and columns '''
+
+    def __init__(self, xMin, yMax, cellSize, nRows, nCols, spatialRef=None):
+
+        self.xMin = float(xMin)
+        self.yMax = float(yMax)
+        self.cellSize = float(cellSize)
+        self.nRows = int(nRows)
+        self.nCols = int(nCols)
+        self.spatialRef = spatialRef
+
+    def __getstate__(self):
+
+        # Spatial references cannot be pickled, and are not needed for reading blocks in worker processes
+        state = self.__dict__.copy()
+        state['spatialRef'] = None
+
+        return state
+
+
+class Block(object):
+
+    '''
+    A rectangular window of a grid, in row/column coordinates.
+    row, col, nRows and nCols describe the block itself. The block is read with halo extra cells on each side.
+    '''
+
+    def __init__(self, row, col, nRows, nCols, halo=0):
+
+        self.row = row
+        self.col = col
+        self.nRows = nRows
+        self.nCols = nCols
+        self.halo = halo
+
+    def lowerLeft(self, grid):
+        ''' Returns the map coordinates of the lower left corner of the block (excluding the halo) '''
+
+        x = grid.xMin + self.col * grid.cellSize
+        y = grid.yMax - (self.row + self.nRows) * grid.cellSize
+
+        return x, y
+
+    def inner(self, array):
+        ''' Removes the halo from an array read for this block '''
+
+        if self.halo == 0:
+            return array
+
+        return array[..., self.halo:self.halo + self.nRows, self.halo:self.halo + self.nCols]
+
+    def key(self):
+        ''' Identifier of the block, unique within its grid '''
+
+        return str(self.row) + '_' + str(self.col)
+
+
+class ArcpyRaster(object):
+    ''' Reads windows of an ArcGIS raster on the cell grid of the grid object '''
+
+    def __init__(self, raster):
+
+        self.raster = raster
+
+    def read(self, grid, row, col, nRows, nCols):
+
+        import arcpy
+
+        x = grid.xMin + col * grid.cellSize
+        y = grid.yMax - (row + nRows) * grid.cellSize
+
+        ras = arcpy.Raster(self.raster)
+        array = arcpy.RasterToNumPyArray(ras, arcpy.Point(x, y), nCols, nRows)
+
+        return toFloat(array, ras.noDataValue)
+
+
+class NumpyRaster(object):
+
+    '''
+    Reads windows of a NumPy array or a .npy file covering the whole grid.
+    .npy files are memory mapped, so only the window being read is loaded.
+    '''
+
+    def __init__(self, source, noData=None):
+
+        if isinstance(source, np.ndarray):
+            self.array = source
+        else:
+            self.array = np.load(source, mmap_mode='r')
+
+        self.noData = noData
+
+    def read(self, grid, row, col, nRows, nCols):
+
+        return toFloat(np.array(self.array[row:row + nRows, col:col + nCols]), self.noData)
+
+
+def toFloat(array, noData):
+
+    ''' Converts an array to float64, with NoData cells set to NaN '''
+
+    if noData is not None:
+        isNoData = array == np.asarray(noData, dtype=array.dtype)
+        array = array.astype(np.float64)
+        array[isNoData] = np.nan
+    else:
+        array = array.astype(np.float64)
+
+    return array
+
+
+def isNumpySource(source):
+
+    return isinstance(source, np.ndarray) or (isinstance(source, six.string_types) and source.lower().endswith('.npy'))
+
+
+def openRaster(source):
+
+    ''' Returns the reader for a raster, which can be an ArcGIS raster, a NumPy array or a .npy file '''
+
+    if isinstance(source, (ArcpyRaster, NumpyRaster)):
+        return source
+    elif isNumpySource(source):
+        return NumpyRaster(source)
+    else:
+        return ArcpyRaster(source)
+
+
+def getGrid(raster):
+
+    '''
+    Returns the cell grid of a raster.
+    NumPy arrays and .npy files have no georeferencing, so they are given a grid with unit cell size.
+    '''
+
+    if isNumpySource(raster):
+        shape = openRaster(raster).array.shape
+        return Grid(0.0, shape[0], 1.0, shape[0], shape[1])
+
+    import arcpy
+
+    desc = arcpy.Describe(raster)
+    extent = desc.extent
+
+    return Grid(extent.XMin, extent.YMax, desc.meanCellWidth, desc.height, desc.width, desc.spatialReference)
+
+
+def getTileSize():
+
+    ''' Returns the tile size (in cells) from the user settings file, or the default tile size if it is not set '''
+
+    try:
+        import configuration
+
+        if os.path.exists(configuration.userSettingsFile):
+
+            tree = ET.parse(configuration.userSettingsFile)
+            node = tree.getroot().find("tileSize")
+
+            if node is not None and node.text:
+                return int(node.text)
+
+    except Exception:
+        pass # If any errors occur, ignore them. Just use the default tile size.
+
+    return defaultTileSize
+
+
+def iterBlocks(grid, tileSize=None, halo=0):
+
+    ''' Yields the blocks covering the grid, row by row '''
+
+    if tileSize is None:
+        tileSize = getTileSize()
+
+    for row in range(0, grid.nRows, tileSize):
+        for col in range(0, grid.nCols, tileSize):
+            yield Block(row, col, min(tileSize, grid.nRows - row), min(tileSize, grid.nCols - col), halo)
+
+
+def runBlock(job):
+
+    ''' Runs the block function of a job from processBlocks. Defined at module level so it can be used by worker processes. '''
+
+    function, block, args = job
+
+    return block, function(block, *args)
+
+
+def processBlocks(function, blocks, args=(), workers=1):
+
+    '''
+    Calls function(block, *args) for each block, yielding (block, result) pairs.
+
+    With more than one worker, blocks are processed in a pool of worker processes and results are yielded in the order
+    they complete. The function must then be defined at module level, and the arguments must be picklable
+    (e.g. raster paths rather than raster objects). Results should be written by the caller in the main process.
+    '''
+
+    if workers is None or workers < 1:
+        workers = multiprocessing.cpu_count()
+
+    if workers == 1:
+        for block in blocks:
+            yield block, function(block, *args)
+
+    else:
+        # Inside ArcGIS, sys.executable is the ArcGIS application rather than Python
+        if platform.system() == 'Windows':
+            multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+
+        jobs = [(function, block, args) for block in blocks]
+        pool = multiprocessing.Pool(min(workers, len(jobs)) or 1)
+        completed = False
+
+        try:
+            for block, result in pool.imap_unordered(runBlock, jobs):
+                yield block, result
+
+            pool.close()
+            completed = True
+
+        finally:
+            # Workers are stopped on errors, interrupts and when the caller stops reading the results early
+            if not completed:
+                pool.terminate()
+
+            pool.join()
+
+
+def readBlock(source, grid, block):
+
+    '''
+    Reads a block (including its halo) of a raster as a float64 array, with NoData cells set to NaN.
+    The raster must share the cell grid of the grid object.
+    '''
+
+    reader = openRaster(source)
+    halo = block.halo
+
+    # Part of the window (including the halo) which lies within the grid
+    top = max(block.row - halo, 0)
+    left = max(block.col - halo, 0)
+    bottom = min(block.row + block.nRows + halo, grid.nRows)
+    right = min(block.col + block.nCols + halo, grid.nCols)
+
+    array = reader.read(grid, top, left, bottom - top, right - left)
+
+    if halo == 0:
+        return array
+
+    # Pad with NoData where the halo extends beyond the grid
+    padded = np.full((block.nRows + 2 * halo, block.nCols + 2 * halo), np.nan)
+    padTop = top - (block.row - halo)
+    padLeft = left - (block.col - halo)
+    padded[padTop:padTop + array.shape[0], padLeft:padLeft + array.shape[1]] = array
+
+    return padded
+
+
+class BlockWriter(object):
+
+    '''
+    Writes blocks of an ArcGIS raster on the given grid.
+
+    Each block is written to a temporary file in the scratch folder. These are mosaicked into the output raster
+    when the writer is closed.
+    '''
+
+    def __init__(self, outputRaster, grid, pixelType="32_BIT_FLOAT"):
+
+        import arcpy
+
+        self.outputRaster = outputRaster
+        self.grid = grid
+        self.pixelType = pixelType
+        self.blockFiles = []
+
+        name = os.path.basename(outputRaster).split('.')[0]
+        self.prefix = os.path.join(arcpy.env.scratchFolder, "blk_" + name + "_")
+
+    def write(self, block, array):
+
+        import arcpy
+
+        x, y = block.lowerLeft(self.grid)
+
+        array = np.where(np.isnan(array), noDataValue, array).astype(np.float32)
+        blockRas = arcpy.NumPyArrayToRaster(array, arcpy.Point(x, y), self.grid.cellSize, self.grid.cellSize, noDataValue)
+
+        blockFile = self.prefix + str(len(self.blockFiles)) + ".tif"
+        blockRas.save(blockFile)
+        self.blockFiles.append(blockFile)
+
+        if self.grid.spatialRef is not None:
+            arcpy.DefineProjection_management(blockFile, self.grid.spatialRef)
+
+    def close(self):
+
+        import arcpy
+
+        if len(self.blockFiles) == 1:
+            arcpy.CopyRaster_management(self.blockFiles[0], self.outputRaster, pixel_type=self.pixelType)
+        else:
+            arcpy.MosaicToNewRaster_management(self.blockFiles, os.path.dirname(self.outputRaster),
+                                               os.path.basename(self.outputRaster), self.grid.spatialRef,
+                                               self.pixelType, self.grid.cellSize, 1, "FIRST")
+
+        for blockFile in self.blockFiles:
+            arcpy.Delete_management(blockFile)
+
+        self.blockFiles = []
+
+        return self.outputRaster
+
+
+class NumpyBlockWriter(object):
+
+    '''
+    Writes blocks into a NumPy array covering the whole grid, with NoData held as NaN.
+    If an output .npy file is given, the array is memory mapped to that file so it does not have to fit in memory.
+    '''
+
+    def __init__(self, outputRaster, grid, dtype=np.float32):
+
+        self.outputRaster = outputRaster
+        self.grid = grid
+
+        shape = (grid.nRows, grid.nCols)
+
+        if outputRaster is None:
+            self.array = np.full(shape, np.nan, dtype=dtype)
+        else:
+            self.array = np.lib.format.open_memmap(outputRaster, mode='w+', dtype=dtype, shape=shape)
+            self.array[:] = np.nan
+
+    def write(self, block, array):
+
+        self.array[block.row:block.row + block.nRows, block.col:block.col + block.nCols] = array
+
+    def close(self):
+
+        if self.outputRaster is None:
+            return self.array
+
+        self.array.flush()
+        del self.array
+
+        return self.outputRaster
+
+
+def createWriter(outputRaster, grid, pixelType="32_BIT_FLOAT"):
+
+    '''
+    Returns a block writer for the output raster. Outputs ending in .npy are written as memory mapped .npy files,
+    outputs ending in .npz as sparse rasters (see sparse_raster) and None gives an in-memory array (returned when the
+    writer is closed). Anything else is written as an ArcGIS raster with the given pixel type.
+    '''
+
+    if outputRaster is None or isNumpySource(outputRaster):
+        return NumpyBlockWriter(outputRaster, grid)
+    elif outputRaster.lower().endswith('.npz'):
+        import LUCI_SEEA.lib.sparse_raster as sparse_raster
+        return sparse_raster.SparseBlockWriter(outputRaster, grid)
+    else:
+        return BlockWriter(outputRaster, grid, pixelType)
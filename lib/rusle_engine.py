@@ -0,0 +1,391 @@
+'''
+NumPy implementation of the RUSLE factor and soil loss equations. Functions work on blocks (tiles) of rasters,
+with NoData cells held as NaN so that NoData propagates through the calculations as it does with map algebra.
+'''
+
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.tile_manifest as tile_manifest
+import LUCI_SEEA.lib.zonal_stats as zonal_stats
+
+cutoffPercent = 50.0 # Hardcoded for now (approx 45 degrees)
+cutoffAngle = 45.0
+
+
+defaultExponents = (0.5, 1.2) # Default (m, n) exponents of the LS-factor equations
+
+
+def lsSine(slopeDeg):
+
+    ''' Sine term of the LS-factor including upslope contributing area, from the slope in degrees '''
+
+    return np.sin(np.minimum(slopeDeg, cutoffAngle) * 0.01745)
+
+
+def lsVariants(lsOption, slope, flowAcc, cellSize, exponents, slopeSin=None):
+
+    '''
+    LS-factor for each of a list of (m, n) exponent pairs, calculated in one pass. Returns an array with one layer
+    per pair. The terms which do not depend on the exponents are only calculated once.
+
+    For the SlopeLength option, slope is in percent rise and only the slope length exponent m is used.
+    For the UpslopeArea option, slope is in degrees and flowAcc is the flow accumulation in cells. If the sine term
+    (see lsSine) has already been calculated, it can be given as slopeSin instead of the slope.
+    '''
+
+    exponents = np.asarray(exponents, dtype=np.float64).reshape(-1, 2)
+    m = exponents[:, 0].reshape(-1, 1, 1)
+    n = exponents[:, 1].reshape(-1, 1, 1)
+
+    if lsOption == 'SlopeLength':
+        slopeCut = np.minimum(slope, cutoffPercent)
+
+        lsCalcA = (cellSize / 22.0) ** m
+        lsCalcB = 0.065 + (0.045 * slopeCut) + (0.0065 * slopeCut ** 2.0)
+
+        return lsCalcA * lsCalcB
+
+    elif lsOption == 'UpslopeArea':
+        if slopeSin is None:
+            slopeSin = lsSine(slope)
+
+        upslopeArea = flowAcc * float(cellSize)
+
+        return (m + 1) * (upslopeArea / 22.1) ** m * (slopeSin / 0.09) ** n
+
+    raise ValueError('Invalid LS-factor option: ' + str(lsOption))
+
+
+def lsSlopeLength(slopePerc, cellSize, m=0.5):
+
+    ''' LS-factor based on slope length and steepness only. Slope is in percent rise. '''
+
+    return lsVariants('SlopeLength', slopePerc, None, cellSize, [(m, 0.0)])[0]
+
+
+def lsUpslopeArea(slopeDeg, flowAcc, cellSize, m=0.5, n=1.2):
+
+    ''' LS-factor including upslope contributing area. Slope is in degrees, flowAcc is the flow accumulation in cells. '''
+
+    return lsVariants('UpslopeArea', slopeDeg, flowAcc, cellSize, [(m, n)])[0]
+
+
+def soilLoss(rFactor, lsFactor, kFactor, cFactor, pFactor=None, streamInv=None):
+
+    ''' Soil loss (A = R * LS * K * C * P), optionally removing stream cells using the inverse stream raster '''
+
+    loss = rFactor * lsFactor
+    loss *= kFactor
+    loss *= cFactor
+
+    if pFactor is not None:
+        loss *= pFactor
+
+    if streamInv is not None:
+        loss *= streamInv
+
+    return loss
+
+
+def sourceKey(source):
+
+    ''' Hashable identifier of a raster source (arrays are identified by object) '''
+
+    if isinstance(source, np.ndarray):
+        return id(source)
+
+    return source
+
+
+def memoised(memo, key, calculate):
+
+    if key not in memo:
+        memo[key] = calculate()
+
+    return memo[key]
+
+
+def readMemoised(source, grid, block, memo):
+
+    ''' Reads a block of a raster, unless it has already been read into memo '''
+
+    if source is None:
+        return None
+
+    return memoised(memo, ('read', sourceKey(source)), lambda: raster_blocks.readBlock(source, grid, block))
+
+
+def lsKey(lsOption, sources, exponents):
+
+    ''' Memo key of the LS-factor calculated from the slope sources with the given exponents '''
+
+    return ('LS', lsOption, sourceKey(sources['slope']), sourceKey(sources.get('slopeSin')),
+            sourceKey(sources.get('flowAcc')), tuple(exponents))
+
+
+def readLSVariants(block, grid, sources, lsOption, cellSize, exponentList, memo):
+
+    ''' Calculates the LS-factor for each of a list of exponent pairs in one pass, and adds them to memo '''
+
+    exponentList = [tuple(exponents) for exponents in exponentList
+                    if lsKey(lsOption, sources, exponents) not in memo]
+
+    if len(exponentList) == 0:
+        return
+
+    slope = None
+    slopeSin = None
+    flowAcc = None
+
+    if lsOption == 'UpslopeArea':
+        flowAcc = readMemoised(sources['flowAcc'], grid, block, memo)
+
+        # Use the sine term saved by preprocessing if it is available, rather than calculating it from the slope
+        slopeSin = readMemoised(sources.get('slopeSin'), grid, block, memo)
+
+    if slopeSin is None:
+        slope = readMemoised(sources['slope'], grid, block, memo)
+
+    variants = lsVariants(lsOption, slope, flowAcc, cellSize, exponentList, slopeSin)
+
+    for exponents, variant in zip(exponentList, variants):
+        memo[lsKey(lsOption, sources, exponents)] = variant
+
+
+def readFactors(block, grid, sources, lsOption, cellSize, lookups=None, memo=None, exponents=None):
+
+    '''
+    Reads the R, LS, K, C and P factors (and the inverse stream raster) for a block. If sources includes 'LS', the
+    LS-factor is read from it rather than calculated from the slope with the (m, n) exponents.
+    Returns a dictionary of factor blocks (P and streamInv are None if they have no source) and a dictionary of the
+    codes not found for each lookup.
+
+    memo is an optional dictionary of factor blocks already calculated for this block, keyed on the factor and its
+    sources. Scenarios which share inputs (e.g. the same rainfall or DEM) then only read and calculate them once.
+    '''
+
+    if lookups is None:
+        lookups = {}
+
+    if memo is None:
+        memo = {}
+
+    if exponents is None:
+        exponents = defaultExponents
+
+    def getFactor(key, calculate):
+        return memoised(memo, key, calculate)
+
+    def readSource(name):
+        return readMemoised(sources.get(name), grid, block, memo)
+
+    factors = {}
+    unmatched = {}
+
+    factors['R'] = readSource('R')
+
+    if sources.get('LS') is not None:
+        # Precalculated LS-factor (e.g. from the factor cache)
+        factors['LS'] = readSource('LS')
+
+    else:
+        readLSVariants(block, grid, sources, lsOption, cellSize, [exponents], memo)
+        factors['LS'] = memo[lsKey(lsOption, sources, exponents)]
+
+    for factor in ['K', 'C']:
+
+        if factor in lookups:
+            lookup = lookups[factor]
+            key = (factor, sourceKey(sources[factor]), id(lookup))
+            factors[factor], unmatched[factor] = getFactor(key, lambda: lookup.lookup(readSource(factor)))
+
+        else:
+            factors[factor] = readSource(factor)
+
+    factors['P'] = readSource('P')
+    factors['streamInv'] = readSource('streamInv')
+
+    return factors, unmatched
+
+
+def blockZoneStats(zones, loss):
+
+    ''' Zone statistics of the soil loss of a block, returned from worker processes and merged in the main process '''
+
+    stats = zonal_stats.ZonalAccumulator()
+    stats.add(zones, loss)
+
+    return stats
+
+
+def soilLossBlock(block, grid, sources, lsOption, cellSize, saveFactors=False, lookups=None, exponents=None,
+                  zones=None):
+
+    '''
+    Reads the inputs for a block and calculates soil loss. Returns a dictionary containing the soil loss ('soilLoss'),
+    the codes not found for each lookup ('unmatched') and, if saveFactors is True, the R, LS, K, C and P factors.
+    saveFactors can also be a list of the factors to return.
+
+    sources is a dictionary of input rasters (paths or arrays on the grid): 'R', 'slope', 'K' and 'C', plus 'flowAcc'
+    for the UpslopeArea LS option. 'P', 'streamInv' and 'slopeSin' (the sine term of the UpslopeArea LS-factor) are
+    optional.
+    lookups is an optional dictionary of FactorLookup objects keyed by factor ('K' or 'C'). If a factor has a lookup,
+    its source raster holds codes which are mapped to factor values.
+    exponents is the (m, n) pair of the LS-factor equation, defaulting to (0.5, 1.2).
+    zones is an optional raster of zone ids. If it is given, the zone statistics of the soil loss of the block are
+    returned ('zoneStats'), so totals per zone are found without reading the soil loss raster again.
+    Defined at module level so that blocks can be processed in worker processes.
+    '''
+
+    factors, unmatched = readFactors(block, grid, sources, lsOption, cellSize, lookups, exponents=exponents)
+
+    if saveFactors is True:
+        saveFactors = ['R', 'LS', 'K', 'C', 'P']
+    elif not saveFactors:
+        saveFactors = []
+
+    results = {'unmatched': unmatched}
+    for factor in saveFactors:
+        if factors[factor] is not None:
+            results[factor] = factors[factor]
+
+    results['soilLoss'] = soilLoss(factors['R'], factors['LS'], factors['K'], factors['C'], factors['P'],
+                                   factors['streamInv'])
+
+    if zones is not None:
+        results['zoneStats'] = blockZoneStats(raster_blocks.readBlock(zones, grid, block), results['soilLoss'])
+
+    return results
+
+
+def lossDifference(lossA, lossB):
+
+    ''' Change in soil loss from A to B. Cells with no change are NoData, as in the soil loss accounts. '''
+
+    difference = lossB - lossA
+    difference[difference == 0] = np.nan
+
+    return difference
+
+
+def scenarioLossBlock(block, grid, scenarios, lsOption, cellSize, diffPairs=None, returnFactors=None, incremental=None,
+                      zones=None):
+
+    '''
+    Calculates soil loss for a block under each of a set of scenarios, reading the inputs they share only once.
+    scenarios is a list of (sources, lookups, exponents) tuples, as for soilLossBlock. The LS-factors of scenarios
+    which share the same slope data are calculated for all of their exponents in one pass.
+    diffPairs is an optional list of (i, j) scenario index pairs, for which the change in soil loss from scenario i
+    to scenario j is calculated.
+
+    returnFactors is an optional list of (i, factor) pairs of factors to return for scenario i.
+
+    incremental is an optional list with, for each scenario, None or a (tileNames, prior, priorTiles) tuple.
+    tileNames are the sources whose blocks are hashed for the tile manifest, prior is the soil loss raster of a
+    previous run and priorTiles the tiles of its manifest. Where the hashed inputs of the block match the previous
+    run, its soil loss is read from the previous output rather than recalculated.
+
+    zones is an optional raster of zone ids, for which the zone statistics of the soil loss of each scenario are
+    returned ('zoneStats').
+
+    Returns a dictionary containing the soil loss for each scenario ('soilLoss'), the differences for each pair
+    ('difference'), the factors for each of returnFactors ('factors'), and for each scenario the codes not found for
+    each lookup ('unmatched'), the manifest entry of the tile ('tiles') and whether the previous soil loss was reused
+    ('reused').
+    '''
+
+    if diffPairs is None:
+        diffPairs = []
+
+    if returnFactors is None:
+        returnFactors = []
+
+    if incremental is None:
+        incremental = [None] * len(scenarios)
+
+    needFactors = set([i for i, factor in returnFactors])
+
+    memo = {}
+    losses = [None] * len(scenarios)
+    unmatched = [{} for scenario in scenarios]
+    tiles = [None] * len(scenarios)
+    reused = [False] * len(scenarios)
+
+    # Reuse the soil loss of the previous run where the inputs of the tile have not changed
+    for i, (sources, lookups, exponents) in enumerate(scenarios):
+        if incremental[i] is None:
+            continue
+
+        tileNames, prior, priorTiles = incremental[i]
+        digest = tile_manifest.tileDigest(tileNames, [readMemoised(sources.get(name), grid, block, memo)
+                                                      for name in tileNames])
+        tiles[i] = [digest, {}]
+
+        priorTile = None
+        if priorTiles is not None:
+            priorTile = priorTiles.get(block.key())
+
+        if priorTile is not None and priorTile[0] == digest:
+            losses[i] = raster_blocks.readBlock(prior, grid, block)
+            reused[i] = True
+
+            for factor, codes in priorTile[1].items():
+                unmatched[i][factor] = np.array(codes, dtype=np.int64)
+
+            tiles[i] = priorTile
+
+    calculate = [i for i in range(len(scenarios)) if not reused[i] or i in needFactors]
+
+    lsGroups = {}
+    for i in calculate:
+        sources, lookups, exponents = scenarios[i]
+
+        if sources.get('LS') is None:
+            groupKey = lsKey(lsOption, sources, ())
+            lsGroups.setdefault(groupKey, (sources, []))[1].append(exponents or defaultExponents)
+
+    for sources, exponentList in lsGroups.values():
+        readLSVariants(block, grid, sources, lsOption, cellSize, exponentList, memo)
+
+    scenarioFactors = {}
+    for i in calculate:
+        sources, lookups, exponents = scenarios[i]
+
+        factors, scenarioUnmatched = readFactors(block, grid, sources, lsOption, cellSize, lookups, memo, exponents)
+        scenarioFactors[i] = factors
+
+        if not reused[i]:
+            unmatched[i] = scenarioUnmatched
+            losses[i] = soilLoss(factors['R'], factors['LS'], factors['K'], factors['C'], factors['P'],
+                                 factors['streamInv'])
+
+            if tiles[i] is not None:
+                for factor, codes in scenarioUnmatched.items():
+                    if len(codes) > 0:
+                        tiles[i][1][factor] = codes.tolist()
+
+    differences = [lossDifference(losses[i], losses[j]) for i, j in diffPairs]
+
+    factors = [scenarioFactors[i][factor] for i, factor in returnFactors]
+
+    zoneStats = None
+    if zones is not None:
+        zoneBlock = readMemoised(zones, grid, block, memo)
+        zoneStats = [blockZoneStats(zoneBlock, loss) for loss in losses]
+
+    return {'soilLoss': losses, 'difference': differences, 'factors': factors, 'unmatched': unmatched,
+            'tiles': tiles, 'reused': reused, 'zoneStats': zoneStats}
+
+
+def lsVariantsBlock(block, grid, sources, lsOption, cellSize, exponentList):
+
+    '''
+    Calculates the LS-factor of a block for each of a list of (m, n) exponent pairs, e.g. for calibration sweeps.
+    sources is as for soilLossBlock (only 'slope' and 'flowAcc' are used). Returns an array with one layer per pair.
+    '''
+
+    memo = {}
+    readLSVariants(block, grid, sources, lsOption, cellSize, exponentList, memo)
+
+    return np.array([memo[lsKey(lsOption, sources, exponents)] for exponents in exponentList])
@@ -0,0 +1,101 @@
+'''
+Slope of DEMs on NumPy tiles, with several measures of slope from a single neighbourhood pass.
+
+The gradient of each cell is found once per tile with Horn's (1981) method, as used by arcpy.sa.Slope: a weighted
+3x3 difference in each direction. NoData neighbours take the value of the centre cell, so that slope is also found
+for cells on the edge of the data. The slope in degrees, percent rise and radians, and the sine term of the RUSLE
+LS-factor, are then all derived from the same gradient arrays.
+'''
+
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+
+measures = ['degrees', 'percent', 'radians', 'lsSine']
+
+
+def hornGradient(padded, cellSize):
+
+    '''
+    Rise over run (the magnitude of the gradient) of the inner cells of a DEM padded with a ring of one cell, with
+    NoData as NaN
+    '''
+
+    centre = padded[1:-1, 1:-1]
+    nRows, nCols = padded.shape
+
+    def neighbour(dRow, dCol):
+        values = padded[1 + dRow:nRows - 1 + dRow, 1 + dCol:nCols - 1 + dCol]
+        return np.where(np.isnan(values), centre, values)
+
+    a, b, c = neighbour(-1, -1), neighbour(-1, 0), neighbour(-1, 1)
+    d, f = neighbour(0, -1), neighbour(0, 1)
+    g, h, i = neighbour(1, -1), neighbour(1, 0), neighbour(1, 1)
+
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8.0 * cellSize)
+    dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8.0 * cellSize)
+
+    return np.sqrt(dzdx * dzdx + dzdy * dzdy)
+
+
+def slopeMeasures(rise, outputMeasures):
+
+    ''' Derives each of the requested measures (see measures) from the rise over run. Returns a dictionary. '''
+
+    import LUCI_SEEA.lib.rusle_engine as rusle_engine
+
+    results = {}
+    radians = np.arctan(rise)
+
+    for measure in outputMeasures:
+
+        if measure == 'degrees':
+            results[measure] = np.degrees(radians)
+
+        elif measure == 'percent':
+            results[measure] = rise * 100.0
+
+        elif measure == 'radians':
+            results[measure] = radians
+
+        elif measure == 'lsSine':
+            results[measure] = rusle_engine.lsSine(np.degrees(radians))
+
+        else:
+            raise ValueError('Invalid slope measure: ' + str(measure))
+
+    return results
+
+
+def slopeBlock(block, grid, dem, outputMeasures):
+
+    '''
+    Returns a dictionary of the requested slope measures of a tile.
+    Defined at module level so that tiles can be processed in worker processes.
+    '''
+
+    padded = raster_blocks.readBlock(dem, grid, block)
+
+    return slopeMeasures(hornGradient(padded, grid.cellSize), outputMeasures)
+
+
+def calculateSlope(dem, outputs, grid=None, tileSize=None, workers=1):
+
+    '''
+    Calculates the slope of a DEM tile by tile, and writes each measure in the dictionary outputs (keyed on the
+    measure, see measures) to its output raster, all from the same pass. Returns a dictionary of the output rasters.
+    '''
+
+    if grid is None:
+        grid = raster_blocks.getGrid(dem)
+
+    outputMeasures = sorted(outputs)
+    writers = dict([(measure, raster_blocks.createWriter(outputs[measure], grid)) for measure in outputMeasures])
+
+    blocks = raster_blocks.iterBlocks(grid, tileSize, halo=1)
+    for block, results in raster_blocks.processBlocks(slopeBlock, blocks, (grid, dem, outputMeasures), workers):
+
+        for measure in outputMeasures:
+            writers[measure].write(block, results[measure])
+
+    return dict([(measure, writers[measure].close()) for measure in outputMeasures])
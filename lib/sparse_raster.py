@@ -0,0 +1,238 @@
+'''
+Sparse storage of rasters in which most cells are NoData or zero, such as soil loss difference rasters.
+
+Only the changed cells (non-zero values which are not NoData) are stored, in a compressed .npz file holding a CSR
+style row pointer, the column of each cell and its value, plus the cell grid. Storage therefore scales with the
+number of changed cells rather than the extent of the raster. Totals, per-class sums and histograms are calculated
+from the sparse form in chunks of rows, and the raster can be exported to a dense raster for display.
+'''
+
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+
+
+class SparseBlockWriter(object):
+
+    '''
+    Writes blocks of a raster on the given grid to a sparse .npz file. Cells which are NoData (NaN) or zero are
+    not stored. Blocks can be written in any order.
+    '''
+
+    def __init__(self, outputFile, grid):
+
+        self.outputFile = outputFile
+        self.grid = grid
+        self.rows = []
+        self.cols = []
+        self.values = []
+
+    def write(self, block, array):
+
+        changed = ~np.isnan(array)
+        changed[changed] = array[changed] != 0
+
+        rows, cols = np.nonzero(changed)
+
+        self.rows.append((rows + block.row).astype(np.int32))
+        self.cols.append((cols + block.col).astype(np.int32))
+        self.values.append(array[changed].astype(np.float32))
+
+    def close(self):
+
+        rows = np.concatenate(self.rows + [np.zeros(0, dtype=np.int32)])
+        cols = np.concatenate(self.cols + [np.zeros(0, dtype=np.int32)])
+        values = np.concatenate(self.values + [np.zeros(0, dtype=np.float32)])
+
+        # Sort the cells by row and then column
+        order = np.lexsort((cols, rows))
+        rows = rows[order]
+        cols = cols[order]
+        values = values[order]
+
+        rowPtr = np.searchsorted(rows, np.arange(self.grid.nRows + 1)).astype(np.int64)
+
+        spatialRef = ''
+        try:
+            if self.grid.spatialRef is not None:
+                spatialRef = self.grid.spatialRef.exportToString()
+        except Exception:
+            pass
+
+        gridValues = np.array([self.grid.xMin, self.grid.yMax, self.grid.cellSize, self.grid.nRows, self.grid.nCols])
+
+        with open(self.outputFile, 'wb') as f:
+            np.savez_compressed(f, rowPtr=rowPtr, cols=cols, values=values, grid=gridValues,
+                                spatialRef=np.array(spatialRef))
+
+        self.rows = []
+        self.cols = []
+        self.values = []
+
+        return self.outputFile
+
+
+class SparseRaster(object):
+
+    ''' Reads a sparse raster written by SparseBlockWriter '''
+
+    def __init__(self, sparseFile):
+
+        self.sparseFile = sparseFile
+
+        with np.load(sparseFile, allow_pickle=False) as data:
+            self.rowPtr = data['rowPtr']
+            self.cols = data['cols']
+            self.values = data['values']
+            gridValues = data['grid']
+            self.spatialRef = str(data['spatialRef'])
+
+        self.grid = raster_blocks.Grid(gridValues[0], gridValues[1], gridValues[2], gridValues[3], gridValues[4])
+
+    def count(self):
+
+        ''' Number of changed cells '''
+
+        return len(self.values)
+
+    def iterChunks(self, chunkRows=None):
+
+        ''' Yields the (rows, cols, values) of the changed cells in bands of chunkRows rows (default: the tile size) '''
+
+        if chunkRows is None:
+            chunkRows = raster_blocks.getTileSize()
+
+        for startRow in range(0, self.grid.nRows, chunkRows):
+            endRow = min(startRow + chunkRows, self.grid.nRows)
+            start = self.rowPtr[startRow]
+            end = self.rowPtr[endRow]
+
+            if end == start:
+                continue
+
+            rows = np.repeat(np.arange(startRow, endRow, dtype=np.int32), np.diff(self.rowPtr[startRow:endRow + 1]))
+
+            yield rows, self.cols[start:end], self.values[start:end].astype(np.float64)
+
+    def totals(self):
+
+        ''' Number of changed cells, and the sum of the positive (gain), negative (loss) and all (net) values '''
+
+        totals = {'count': 0, 'gain': 0.0, 'loss': 0.0, 'net': 0.0}
+
+        for rows, cols, values in self.iterChunks():
+            totals['count'] += len(values)
+            totals['gain'] += float(values[values > 0].sum())
+            totals['loss'] += float(values[values < 0].sum())
+
+        totals['net'] = totals['gain'] + totals['loss']
+
+        return totals
+
+    def classSums(self, classRaster, tileSize=None):
+
+        '''
+        Sum and count of the changed cell values in each class of a categorical raster on the same grid.
+        Only the tiles of the class raster which contain changed cells are read.
+        Returns arrays of the classes, sums and counts.
+        '''
+
+        sums = {}
+        counts = {}
+
+        for block in raster_blocks.iterBlocks(self.grid, tileSize):
+            rows, cols, values = self.blockCells(block)
+
+            if len(values) == 0:
+                continue
+
+            classBlock = raster_blocks.readBlock(classRaster, self.grid, block)
+            classes = classBlock[rows - block.row, cols - block.col]
+
+            valid = ~np.isnan(classes)
+            blockClasses, inverse = np.unique(classes[valid], return_inverse=True)
+            blockSums = np.bincount(inverse, weights=values[valid], minlength=len(blockClasses))
+            blockCounts = np.bincount(inverse, minlength=len(blockClasses))
+
+            for value, total, count in zip(blockClasses.tolist(), blockSums.tolist(), blockCounts.tolist()):
+                sums[value] = sums.get(value, 0.0) + total
+                counts[value] = counts.get(value, 0) + count
+
+        classes = sorted(sums)
+
+        return np.array(classes), np.array([sums[value] for value in classes]), np.array([counts[value] for value in classes], dtype=np.int64)
+
+    def histogram(self, bins=50, valueRange=None):
+
+        '''
+        Histogram of the changed cell values, accumulated chunk by chunk.
+        bins is the number of bins or an array of bin edges. Returns the counts and the bin edges.
+        '''
+
+        if np.ndim(bins) == 0:
+            if valueRange is None:
+                if self.count() > 0:
+                    valueRange = (float(self.values.min()), float(self.values.max()))
+                else:
+                    valueRange = (0.0, 1.0)
+
+            edges = np.linspace(valueRange[0], valueRange[1], int(bins) + 1)
+        else:
+            edges = np.asarray(bins, dtype=np.float64)
+
+        counts = np.zeros(len(edges) - 1, dtype=np.int64)
+        for rows, cols, values in self.iterChunks():
+            counts += np.histogram(values, bins=edges)[0]
+
+        return counts, edges
+
+    def blockCells(self, block):
+
+        ''' Returns the (rows, cols, values) of the changed cells within a block '''
+
+        start = self.rowPtr[block.row]
+        end = self.rowPtr[block.row + block.nRows]
+
+        rows = np.repeat(np.arange(block.row, block.row + block.nRows, dtype=np.int32),
+                         np.diff(self.rowPtr[block.row:block.row + block.nRows + 1]))
+        cols = self.cols[start:end]
+        values = self.values[start:end].astype(np.float64)
+
+        inBlock = (cols >= block.col) & (cols < block.col + block.nCols)
+
+        return rows[inBlock], cols[inBlock], values[inBlock]
+
+    def toBlock(self, block):
+
+        ''' Dense array of a block, with unchanged cells as NoData (NaN) '''
+
+        array = np.full((block.nRows, block.nCols), np.nan)
+
+        rows, cols, values = self.blockCells(block)
+        array[rows - block.row, cols - block.col] = values
+
+        return array
+
+    def toDense(self, outputRaster, grid=None):
+
+        '''
+        Exports the sparse raster to a dense raster (e.g. for display), written block by block.
+        grid defaults to the grid stored with the sparse raster. For ArcGIS outputs, the grid should include the
+        spatial reference, which is otherwise recreated from the stored spatial reference string.
+        '''
+
+        if grid is None:
+            grid = self.grid
+
+            if self.spatialRef and not raster_blocks.isNumpySource(outputRaster):
+                import arcpy
+
+                grid.spatialRef = arcpy.SpatialReference()
+                grid.spatialRef.loadFromString(self.spatialRef)
+
+        writer = raster_blocks.createWriter(outputRaster, grid)
+
+        for block in raster_blocks.iterBlocks(grid):
+            writer.write(block, self.toBlock(block))
+
+        return writer.close()
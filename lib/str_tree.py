@@ -0,0 +1,144 @@
+'''
+Packed STR-tree (Sort-Tile-Recursive, Leutenegger et al., 1997) bounding box index, on NumPy arrays.
+
+Items are packed into leaves of a fixed number of boxes: the boxes are sorted into vertical slices by the x of their
+centres, and each slice by the y of their centres. Each level above packs runs of consecutive nodes of the level
+below, which are already close together, so the children of a node are always a contiguous run of the level below
+and the tree is held as one array of boxes per level. Queries go down the tree one level at a time, for many query
+boxes at once.
+
+The index can be saved to a .npz file (e.g. next to the data set it indexes) and loaded again, so that it is only
+built once per data set.
+'''
+
+import numpy as np
+
+
+def packOrder(boxes, nodeCapacity):
+
+    ''' Order of the boxes (xMin, yMin, xMax, yMax rows) which packs them into nodes of nodeCapacity boxes '''
+
+    nBoxes = len(boxes)
+    nNodes = int(np.ceil(nBoxes / float(nodeCapacity)))
+    nSlices = int(np.ceil(np.sqrt(nNodes)))
+    sliceSize = nSlices * nodeCapacity
+
+    xCentres = (boxes[:, 0] + boxes[:, 2]) / 2.0
+    yCentres = (boxes[:, 1] + boxes[:, 3]) / 2.0
+
+    byX = np.argsort(xCentres, kind='mergesort')
+    slices = np.empty(nBoxes, dtype=np.int64)
+    slices[byX] = np.arange(nBoxes) // sliceSize
+
+    return np.lexsort((yCentres, slices))
+
+
+def nodeBoxes(boxes, nodeCapacity):
+
+    ''' Bounding box of each run of nodeCapacity boxes '''
+
+    starts = np.arange(0, len(boxes), nodeCapacity)
+
+    return np.column_stack([np.minimum.reduceat(boxes[:, 0], starts), np.minimum.reduceat(boxes[:, 1], starts),
+                            np.maximum.reduceat(boxes[:, 2], starts), np.maximum.reduceat(boxes[:, 3], starts)])
+
+
+def overlaps(boxesA, boxesB):
+
+    ''' Whether each box of boxesA overlaps (or touches) the matching box of boxesB '''
+
+    return ((boxesA[:, 0] <= boxesB[:, 2]) & (boxesB[:, 0] <= boxesA[:, 2])
+            & (boxesA[:, 1] <= boxesB[:, 3]) & (boxesB[:, 1] <= boxesA[:, 3]))
+
+
+class STRTree(object):
+
+    '''
+    Packed STR-tree of item bounding boxes (an array of xMin, yMin, xMax, yMax rows), with optional item ids
+    (e.g. object IDs, by default the index of each box). signature is an optional string identifying the version of
+    the data which was indexed, saved with the index.
+    '''
+
+    def __init__(self, boxes, ids=None, nodeCapacity=16, signature=''):
+
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+        if ids is None:
+            ids = np.arange(len(boxes))
+
+        self.nodeCapacity = nodeCapacity
+        self.signature = signature
+
+        # Levels from the leaves (the items themselves) up to the root
+        order = packOrder(boxes, nodeCapacity)
+        self.ids = np.asarray(ids)[order]
+        self.levels = [boxes[order]]
+
+        while len(self.levels[-1]) > 1:
+            self.levels.append(nodeBoxes(self.levels[-1], nodeCapacity))
+
+    @property
+    def size(self):
+
+        return len(self.ids)
+
+    def query(self, queryBoxes):
+
+        '''
+        Items whose boxes overlap each of the query boxes. Returns the index of the query box and the id of the item
+        for each overlapping pair.
+        '''
+
+        queryBoxes = np.asarray(queryBoxes, dtype=np.float64).reshape(-1, 4)
+
+        if self.size == 0 or len(queryBoxes) == 0:
+            return np.zeros(0, dtype=np.int64), self.ids[:0]
+
+        # Start from every query box paired with the root
+        queries = np.arange(len(queryBoxes))
+        nodes = np.zeros(len(queryBoxes), dtype=np.int64)
+
+        for level in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[level]
+
+            keep = overlaps(queryBoxes[queries], boxes[nodes])
+            queries = queries[keep]
+            nodes = nodes[keep]
+
+            if level > 0:
+                # Pair each query with every child of its nodes
+                nChildren = len(self.levels[level - 1])
+                children = nodes[:, np.newaxis] * self.nodeCapacity + np.arange(self.nodeCapacity)
+                queries = np.repeat(queries, self.nodeCapacity)
+                children = children.ravel()
+
+                valid = children < nChildren
+                queries = queries[valid]
+                nodes = children[valid]
+
+        return queries, self.ids[nodes]
+
+    def save(self, indexFile):
+
+        ''' Saves the index to a .npz file '''
+
+        levels = dict([('level' + str(level), boxes) for level, boxes in enumerate(self.levels)])
+
+        np.savez(indexFile, ids=self.ids, nodeCapacity=self.nodeCapacity, signature=np.array(self.signature),
+                 **levels)
+
+    @classmethod
+    def load(cls, indexFile):
+
+        ''' Loads an index saved with save '''
+
+        with np.load(indexFile) as data:
+            tree = cls.__new__(cls)
+            tree.ids = data['ids']
+            tree.nodeCapacity = int(data['nodeCapacity'])
+            tree.signature = str(data['signature'])
+
+            nLevels = len([name for name in data.files if name.startswith('level')])
+            tree.levels = [data['level' + str(level)] for level in range(nLevels)]
+
+        return tree
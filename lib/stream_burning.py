@@ -0,0 +1,64 @@
+'''
+Stream burning (AGREE-style reconditioning) of DEMs on NumPy tiles.
+
+Cells within a buffer distance of the stream network are dropped smoothly towards the streams, by up to the smooth
+drop at the stream, and stream cells are dropped sharply by a further stream drop. The distance to the streams is
+found with an exact Euclidean distance transform limited to the buffer, on each tile read with a halo as wide as the
+buffer, and both drops are applied in the same pass. Tiles with no streams within the buffer are copied unchanged.
+'''
+
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.distance_transform as distance_transform
+
+
+def burnBlock(block, grid, dem, streamRaster, smoothDropBuffer, smoothDrop, streamDrop):
+
+    '''
+    Returns the reconditioned DEM for a tile. The stream raster is read with a halo as wide as the buffer (in cells).
+    Defined at module level so that tiles can be processed in worker processes.
+    '''
+
+    demBlock = raster_blocks.readBlock(dem, grid, raster_blocks.Block(block.row, block.col, block.nRows, block.nCols))
+
+    streams = ~np.isnan(raster_blocks.readBlock(streamRaster, grid, block))
+    if not streams.any():
+        return demBlock
+
+    bufferCells = smoothDropBuffer / grid.cellSize
+    distance = block.inner(distance_transform.distanceTransform(streams, bufferCells)) * grid.cellSize
+
+    # Only cells within the buffer are dropped
+    band = np.isfinite(distance)
+    demBlock[band] -= (smoothDrop / smoothDropBuffer) * (smoothDropBuffer - distance[band])
+    demBlock[block.inner(streams)] -= streamDrop
+
+    return demBlock
+
+
+def burnStreams(dem, streamRaster, outputRaster, smoothDropBuffer, smoothDrop, streamDrop, grid=None, tileSize=None,
+                workers=1):
+
+    '''
+    Burns the streams of a stream raster (stream cells have data) into the DEM tile by tile, and writes the
+    reconditioned DEM to outputRaster. The buffer distance is in map units, and the drops in DEM units.
+    Returns the output raster.
+    '''
+
+    if grid is None:
+        grid = raster_blocks.getGrid(dem)
+
+    smoothDropBuffer = float(smoothDropBuffer)
+    halo = int(np.ceil(smoothDropBuffer / grid.cellSize))
+
+    writer = raster_blocks.createWriter(outputRaster, grid)
+
+    blocks = raster_blocks.iterBlocks(grid, tileSize, halo)
+    for block, burned in raster_blocks.processBlocks(burnBlock, blocks,
+                                                     (grid, dem, streamRaster, smoothDropBuffer, float(smoothDrop),
+                                                      float(streamDrop)),
+                                                     workers):
+        writer.write(block, burned)
+
+    return writer.close()
@@ -0,0 +1,254 @@
+'''
+Stream networks traced from a D8 flow direction grid, with Strahler stream order.
+
+Only the stream cells are kept: they are collected tile by tile with the cell each flows to, giving a graph of the
+stream network. Stream links run from a source or a confluence (a cell with no inflow, or with more than one inflow,
+from other stream cells) down to the next confluence. The cells of each link are found with pointer jumping up the
+network to the head of the link, and the Strahler order of each link is found in one topological sweep of the links,
+from the sources down: a link takes the highest order flowing into it, plus one if two or more inflows have that order.
+
+Each link is traced once as a polyline through its cell centres, ending at the first cell of the link downstream (as
+with arcpy.sa.StreamToFeature), and the same polylines are written to any number of line feature classes.
+'''
+
+import numpy as np
+
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.flow_accumulation as flow_accumulation
+
+
+class StreamLink(object):
+
+    ''' A stream link: its id, the ids of its start and end nodes, its Strahler order and its vertices (x, y) '''
+
+    def __init__(self, arcId, fromNode, toNode, strahler, points):
+
+        self.arcId = arcId
+        self.fromNode = fromNode
+        self.toNode = toNode
+        self.strahler = strahler
+        self.points = points
+
+
+def streamCells(block, grid, fdrRaster, streamRaster):
+
+    '''
+    Global flat indices of the stream cells (cells with data in the stream raster) of a tile read with a halo of
+    one cell, and of the cell each flows to (-1 if none).
+    Defined at module level so that tiles can be processed in worker processes.
+    '''
+
+    localDown, outCell, weights, noData = flow_accumulation.readTile(block, grid, fdrRaster, [])
+
+    innerBlock = raster_blocks.Block(block.row, block.col, block.nRows, block.nCols)
+    streams = np.flatnonzero(~np.isnan(raster_blocks.readBlock(streamRaster, grid, innerBlock).ravel()) & ~noData)
+
+    def toGlobal(cells):
+        return (block.row + cells // block.nCols).astype(np.int64) * grid.nCols + block.col + cells % block.nCols
+
+    down = outCell[streams]
+    inside = localDown[streams] >= 0
+    down[inside] = toGlobal(localDown[streams][inside])
+
+    return toGlobal(streams), down
+
+
+def jumpToHeads(head, parent):
+
+    '''
+    Pointer jumping from each cell up to the head of its link. Returns the head of each cell and its distance from
+    the head (in cells). Cells on loops with no head have a head of -1.
+    '''
+
+    nCells = len(head)
+
+    ptr = np.where(head, np.arange(nCells), parent)
+    distance = np.where(head, 0, 1)
+
+    for _ in range(int(np.ceil(np.log2(max(nCells, 2)))) + 1):
+        distance = distance + np.where(head[ptr], 0, distance[ptr])
+        ptr = ptr[ptr]
+
+    return np.where(head[ptr], ptr, -1), distance
+
+
+def strahlerOrder(downLink):
+
+    ''' Strahler order of each link of a network of links, given the downstream link of each link (-1 if none) '''
+
+    nLinks = len(downLink)
+
+    flows = np.flatnonzero(downLink >= 0)
+    upstream = flows[np.argsort(downLink[flows], kind='mergesort')]
+    counts = np.bincount(downLink[flows], minlength=nLinks)
+    starts = np.concatenate([[0], np.cumsum(counts)])
+
+    order = np.zeros(nLinks, dtype=np.int64)
+    remaining = counts.copy()
+    frontier = np.flatnonzero(remaining == 0)
+
+    while len(frontier) > 0:
+
+        # Orders of the links flowing into each link of the frontier
+        frontierCounts = counts[frontier]
+        group = np.repeat(np.arange(len(frontier)), frontierCounts)
+        offsets = np.arange(len(group)) - np.repeat(np.cumsum(frontierCounts) - frontierCounts, frontierCounts)
+        inflowOrders = order[upstream[starts[frontier][group] + offsets]]
+
+        highest = np.zeros(len(frontier), dtype=np.int64)
+        np.maximum.at(highest, group, inflowOrders)
+        nHighest = np.bincount(group[inflowOrders == highest[group]], minlength=len(frontier))
+
+        order[frontier] = np.where(frontierCounts == 0, 1, np.where(nHighest >= 2, highest + 1, highest))
+
+        targets = downLink[frontier]
+        targets = targets[targets >= 0]
+        np.subtract.at(remaining, targets, 1)
+
+        targets = np.unique(targets)
+        frontier = targets[remaining[targets] == 0]
+
+    return order
+
+
+def traceStreams(fdrRaster, streamRaster, grid=None, tileSize=None, workers=1):
+
+    '''
+    Traces the stream links of a stream raster (stream cells have data) along a flow direction raster. Returns a list
+    of StreamLink objects, with vertices at cell centres in map units.
+    '''
+
+    if grid is None:
+        grid = raster_blocks.getGrid(fdrRaster)
+
+    blocks = raster_blocks.iterBlocks(grid, tileSize, halo=1)
+    results = [result for block, result in raster_blocks.processBlocks(streamCells, blocks,
+                                                                       (grid, fdrRaster, streamRaster), workers)]
+
+    cells = np.concatenate([np.zeros(0, dtype=np.int64)] + [result[0] for result in results])
+    down = np.concatenate([np.zeros(0, dtype=np.int64)] + [result[1] for result in results])
+    del results
+
+    order = np.argsort(cells)
+    cells = cells[order]
+    down = down[order]
+    nCells = len(cells)
+
+    if nCells == 0:
+        return []
+
+    # Downstream stream cell of each stream cell (-1 if the flow leaves the stream network)
+    downIndex = np.minimum(np.searchsorted(cells, down), nCells - 1)
+    downIndex = np.where((down >= 0) & (cells[downIndex] == down), downIndex, -1)
+
+    flows = np.flatnonzero(downIndex >= 0)
+    inDegree = np.bincount(downIndex[flows], minlength=nCells)
+
+    # Links start at sources and confluences. Other cells have a single upstream cell.
+    head = inDegree != 1
+
+    parent = np.full(nCells, -1, dtype=np.int64)
+    single = inDegree[downIndex[flows]] == 1
+    parent[downIndex[flows][single]] = flows[single]
+
+    heads, distance = jumpToHeads(head, np.maximum(parent, 0))
+
+    onLink = heads >= 0
+    linkOfHead = np.cumsum(head) - 1
+    link = np.where(onLink, linkOfHead[np.maximum(heads, 0)], -1)
+    nLinks = int(head.sum())
+
+    # Cells of each link from the head down
+    linkCells = np.flatnonzero(onLink)
+    linkCells = linkCells[np.lexsort((distance[linkCells], link[linkCells]))]
+    linkStarts = np.searchsorted(link[linkCells], np.arange(nLinks + 1))
+
+    lastCells = linkCells[linkStarts[1:] - 1]
+    junctions = downIndex[lastCells]
+    downLink = np.where(junctions >= 0, link[np.maximum(junctions, 0)], -1)
+
+    strahler = strahlerOrder(downLink)
+
+    # Cell centres in map units
+    x = grid.xMin + (cells % grid.nCols + 0.5) * grid.cellSize
+    y = grid.yMax - (cells // grid.nCols + 0.5) * grid.cellSize
+
+    # Nodes are numbered by the link which starts at them, then the outlets of the network
+    outlets = np.cumsum(downLink < 0)
+
+    links = []
+    for i in range(nLinks):
+        vertices = linkCells[linkStarts[i]:linkStarts[i + 1]]
+
+        if downLink[i] >= 0:
+            vertices = np.append(vertices, junctions[i])
+            toNode = int(downLink[i]) + 1
+        else:
+            toNode = nLinks + int(outlets[i])
+
+        points = np.column_stack([x[vertices], y[vertices]])
+
+        # A link of a single cell which flows out of the network is extended half a cell towards the cell it flows
+        # to, so that it is a line
+        if len(vertices) == 1 and down[vertices[0]] >= 0:
+            target = down[vertices[0]]
+            targetPoint = [grid.xMin + (target % grid.nCols + 0.5) * grid.cellSize,
+                           grid.yMax - (target // grid.nCols + 0.5) * grid.cellSize]
+            points = np.vstack([points, (points[0] + targetPoint) / 2.0])
+
+        links.append(StreamLink(i + 1, i + 1, toNode, int(strahler[i]), points))
+
+    return links
+
+
+def simplifyLine(points):
+
+    ''' Removes the vertices of a line where it does not change direction '''
+
+    if len(points) < 3:
+        return points
+
+    steps = np.diff(points, axis=0)
+    turns = np.any(steps[1:] != steps[:-1], axis=1)
+
+    return points[np.concatenate([[True], turns, [True]])]
+
+
+def writeStreamLines(links, outputFC, spatialRef=None, simplify=False):
+
+    '''
+    Writes stream links to a new line feature class with the arcid, from_node, to_node and Strahler fields. If
+    simplify, vertices where the line does not change direction are left out. Links with a single vertex (a single
+    cell flowing out of the DEM) are not lines, and are left out.
+    '''
+
+    import os
+    import arcpy
+    import LUCI_SEEA.lib.log as log
+
+    arcpy.CreateFeatureclass_management(os.path.dirname(outputFC), os.path.basename(outputFC), "POLYLINE",
+                                        spatial_reference=spatialRef)
+
+    for field in ["arcid", "from_node", "to_node", "Strahler"]:
+        arcpy.AddField_management(outputFC, field, "LONG")
+
+    skipped = 0
+    with arcpy.da.InsertCursor(outputFC, ["SHAPE@", "arcid", "from_node", "to_node", "Strahler"]) as cursor:
+        for link in links:
+
+            points = link.points
+            if len(points) < 2:
+                skipped += 1
+                continue
+
+            if simplify:
+                points = simplifyLine(points)
+
+            line = arcpy.Polyline(arcpy.Array([arcpy.Point(px, py) for px, py in points.tolist()]), spatialRef)
+            cursor.insertRow([line, link.arcId, link.fromNode, link.toNode, link.strahler])
+
+    if skipped > 0:
+        log.warning(str(skipped) + ' stream link(s) of a single cell flowing out of the DEM were not written to ' +
+                    str(outputFC))
+
+    return outputFC
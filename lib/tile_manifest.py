@@ -0,0 +1,102 @@
+'''
+Manifests of the inputs used to calculate each tile of a block-wise output raster.
+
+A manifest is written next to the output raster. It holds a digest of the inputs shared by all tiles (e.g. the
+preprocessed DEM data, options and code version) and a digest of the inputs read for each tile (e.g. land cover and
+support practice blocks). A later run with the same shared inputs can then find the tiles whose inputs have not
+changed, and copy them from the previous output rather than recalculating them.
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+
+manifestFormat = 1 # Increase if the layout of the manifest changes
+
+
+def manifestFile(raster):
+
+    return raster + '.tiles.json'
+
+
+def readManifest(raster):
+
+    ''' Returns the manifest of an output raster, or None if it has no manifest or the raster no longer exists '''
+
+    try:
+        if not os.path.exists(raster) or not os.path.exists(manifestFile(raster)):
+            return None
+
+        with open(manifestFile(raster), 'r') as f:
+            manifest = json.load(f)
+
+        if manifest.get('format') != manifestFormat:
+            return None
+
+        return manifest
+
+    except Exception:
+        return None # If the manifest cannot be read, all tiles are recalculated
+
+
+def writeManifest(raster, sharedDigest, tiles):
+
+    '''
+    Writes the manifest of an output raster. tiles is a dictionary of (digest, metadata) pairs keyed on the block key.
+    Only rasters on disk (e.g. ESRI grids, .tif or .npy files) have manifests.
+    '''
+
+    if not os.path.exists(raster):
+        return
+
+    manifest = {'format': manifestFormat, 'shared': sharedDigest, 'tiles': tiles}
+
+    try:
+        with open(manifestFile(raster), 'w') as f:
+            json.dump(manifest, f)
+
+    except Exception:
+        pass # The manifest is only an optimisation, so ignore errors
+
+
+def removeManifest(raster):
+
+    ''' Removes the manifest of a raster, e.g. before the raster is overwritten '''
+
+    try:
+        if os.path.exists(manifestFile(raster)):
+            os.remove(manifestFile(raster))
+
+    except Exception:
+        pass
+
+
+def sharedDigest(values):
+
+    ''' Digest of the inputs shared by all tiles: a list of strings and numbers '''
+
+    digest = hashlib.sha1()
+    for value in values:
+        digest.update(repr(value).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def tileDigest(names, arrays):
+
+    ''' Digest of the named input blocks of a tile. Missing inputs are None. '''
+
+    digest = hashlib.sha1()
+
+    for name, array in zip(names, arrays):
+        digest.update(str(name).encode('utf-8'))
+
+        if array is None:
+            digest.update(b'None')
+        else:
+            array = np.ascontiguousarray(array)
+            digest.update(str(array.shape).encode('utf-8'))
+            digest.update(array.tobytes())
+
+    return digest.hexdigest()
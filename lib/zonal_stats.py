@@ -0,0 +1,268 @@
+'''
+Zonal statistics accumulated block by block, so that statistics for all zones are found in a single read of the
+value raster. Zones are identified by non-negative integer ids.
+
+For integer value rasters, the number of cells of each value in each zone can also be kept, giving the variety,
+majority, minority and median of each zone (as with ZonalStatisticsAsTable "ALL").
+'''
+
+import sys
+import numpy as np
+
+
+class ZonalAccumulator(object):
+
+    '''
+    Accumulates the count, sum, sum of squares, minimum and maximum of the values in each zone. If integerValues is
+    True, the number of cells of each value in each zone is also kept.
+    '''
+
+    def __init__(self, integerValues=False):
+
+        self.integerValues = integerValues
+        self.pairZones = np.zeros(0, dtype=np.int64)
+        self.pairValues = np.zeros(0, dtype=np.int64)
+        self.pairCounts = np.zeros(0, dtype=np.int64)
+
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros(0)
+        self.sumSq = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+
+    def grow(self, size):
+
+        ''' Extends the statistics arrays so that they hold at least size zones '''
+
+        extra = size - len(self.count)
+        if extra <= 0:
+            return
+
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        self.sum = np.concatenate([self.sum, np.zeros(extra)])
+        self.sumSq = np.concatenate([self.sumSq, np.zeros(extra)])
+        self.min = np.concatenate([self.min, np.full(extra, np.inf)])
+        self.max = np.concatenate([self.max, np.full(extra, -np.inf)])
+
+    def add(self, zones, values):
+
+        ''' Adds a block of values. Cells where either the zone or the value is NoData (NaN) are ignored. '''
+
+        valid = ~(np.isnan(zones) | np.isnan(values))
+        zoneIds = zones[valid].astype(np.int64)
+        values = values[valid]
+
+        if zoneIds.size == 0:
+            return
+
+        size = int(zoneIds.max()) + 1
+        self.grow(size)
+
+        self.count[:size] += np.bincount(zoneIds, minlength=size)
+        self.sum[:size] += np.bincount(zoneIds, weights=values, minlength=size)
+        self.sumSq[:size] += np.bincount(zoneIds, weights=values * values, minlength=size)
+        np.minimum.at(self.min, zoneIds, values)
+        np.maximum.at(self.max, zoneIds, values)
+
+        if self.integerValues:
+            self.addPairs(zoneIds, np.round(values).astype(np.int64), np.ones(len(zoneIds), dtype=np.int64))
+
+    def addPairs(self, zoneIds, values, counts):
+
+        ''' Adds cell counts of (zone, value) pairs, summing the counts of repeated pairs '''
+
+        zoneIds = np.concatenate([self.pairZones, zoneIds])
+        values = np.concatenate([self.pairValues, values])
+        counts = np.concatenate([self.pairCounts, counts])
+
+        order = np.lexsort((values, zoneIds))
+        zoneIds = zoneIds[order]
+        values = values[order]
+
+        starts = np.flatnonzero(np.concatenate([[True], (np.diff(zoneIds) != 0) | (np.diff(values) != 0)]))
+
+        self.pairZones = zoneIds[starts]
+        self.pairValues = values[starts]
+        self.pairCounts = np.add.reduceat(counts[order], starts) if len(starts) > 0 else counts[:0]
+
+    def merge(self, other):
+
+        ''' Adds the statistics of another accumulator, e.g. one filled from a single block in a worker process '''
+
+        self.grow(len(other.count))
+        size = len(other.count)
+
+        self.count[:size] += other.count
+        self.sum[:size] += other.sum
+        self.sumSq[:size] += other.sumSq
+        self.min[:size] = np.minimum(self.min[:size], other.min)
+        self.max[:size] = np.maximum(self.max[:size], other.max)
+
+        if self.integerValues:
+            self.addPairs(other.pairZones, other.pairValues, other.pairCounts)
+
+    def zoneIds(self):
+
+        ''' Ids of the zones which contain at least one value '''
+
+        return np.nonzero(self.count)[0]
+
+    def mean(self):
+
+        ''' Mean per zone (NaN for zones without values) '''
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / self.count
+
+    def std(self):
+
+        ''' Population standard deviation per zone (NaN for zones without values) '''
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / self.count
+            variance = self.sumSq / self.count - mean * mean
+
+        return np.sqrt(np.maximum(variance, 0.0))
+
+    def valueStatistics(self):
+
+        '''
+        Variety (number of distinct values), majority (most frequent value), minority (least frequent value) and
+        median of each zone, from the value counts kept for integer values. Ties go to the lowest value, and the median
+        of an even number of cells is the lower of the two middle values. Zones without values have a variety of 0 and
+        NaN for the others.
+        '''
+
+        size = len(self.count)
+        variety = np.bincount(self.pairZones, minlength=size)
+        majority = np.full(size, np.nan)
+        minority = np.full(size, np.nan)
+        median = np.full(size, np.nan)
+
+        if len(self.pairZones) == 0:
+            return variety, majority, minority, median
+
+        # Pairs are sorted by zone then value, so the first pair of each zone with the highest (lowest) count is the
+        # lowest value with that count
+        starts = np.flatnonzero(np.concatenate([[True], np.diff(self.pairZones) != 0]))
+        zones = self.pairZones[starts]
+
+        for result, counts in [(majority, -self.pairCounts), (minority, self.pairCounts)]:
+            order = np.lexsort((self.pairValues, counts, self.pairZones))
+            result[zones] = self.pairValues[order[starts]]
+
+        # Median: the first value of each zone at which the cumulative count reaches the middle cell
+        cumulative = np.cumsum(self.pairCounts)
+        before = np.concatenate([[0], cumulative[:-1]])[starts]
+        middle = before + (self.count[zones] - 1) // 2 + 1
+        median[zones] = self.pairValues[np.searchsorted(cumulative, middle)]
+
+        return variety, majority, minority, median
+
+
+def prepareZones(aggregationZones, aggregationColumn, referenceRaster, prefix):
+
+    '''
+    Converts aggregation zones to a raster of zone ids on the grid of the reference raster.
+
+    Polygon zones are dissolved on the aggregation column and converted using the object ID of each dissolved zone.
+    Raster zones are resampled to the grid, and their values (which should be non-negative integers) are the zone ids.
+    Returns the zone raster and a dictionary of the aggregation column value of each zone id (None for raster zones).
+    '''
+
+    import arcpy
+    import LUCI_SEEA.lib.log as log
+    import LUCI_SEEA.lib.raster_blocks as raster_blocks
+
+    zones = prefix + "aggZones"
+    zoneRas = prefix + "zoneRas"
+
+    grid = raster_blocks.getGrid(referenceRaster)
+
+    isRaster = arcpy.Describe(aggregationZones).dataType in ['RasterDataset', 'RasterLayer']
+
+    if not isRaster:
+        # Check if the aggregation column exists
+        zoneFound = False
+        for field in arcpy.ListFields(aggregationZones):
+            if str(field.name) == str(aggregationColumn):
+                zoneFound = True
+
+        if zoneFound == False:
+            log.error('Aggregation column (' + str(aggregationColumn) + ') not found in zone shapefile')
+            log.error('Please ensure this field is present')
+            sys.exit()
+
+    # Convert the zones on the grid of the reference raster, then restore the previous settings
+    envSettings = [arcpy.env.extent, arcpy.env.snapRaster]
+
+    try:
+        arcpy.env.snapRaster = referenceRaster
+        arcpy.env.extent = referenceRaster
+
+        if isRaster:
+            resampledTemp = arcpy.sa.ApplyEnvironment(aggregationZones)
+            resampledTemp.save(zoneRas)
+
+            return zoneRas, None
+
+        # Dissolve aggregation zone based on aggregation column
+        arcpy.Dissolve_management(aggregationZones, zones, aggregationColumn)
+        log.info("Dissolved aggregation zones based on: " + str(aggregationColumn))
+
+        # Convert the zones to a raster on the grid of the reference raster, using the OID of each dissolved zone
+        OIDField = arcpy.Describe(zones).OIDFieldName
+        arcpy.PolygonToRaster_conversion(zones, OIDField, zoneRas, "CELL_CENTER", "", grid.cellSize)
+
+        zoneValues = {}
+        with arcpy.da.SearchCursor(zones, [OIDField, aggregationColumn]) as cursor:
+            for row in cursor:
+                zoneValues[row[0]] = row[1]
+
+        return zoneRas, zoneValues
+
+    finally:
+        arcpy.env.extent, arcpy.env.snapRaster = envSettings
+
+
+def statsTable(stats, zoneValues, zoneColumn, cellArea, sumScales=None):
+
+    '''
+    Table of the statistics of each zone which contains values, as a record array for arcpy.da.NumPyArrayToTable.
+    zoneValues maps zone ids to the values of the zone column (if None, the zone ids are used).
+    sumScales is an optional list of (column name, factor) pairs of extra columns holding the sum multiplied by a
+    factor, e.g. to convert a sum of rates per hectare into a total.
+    If the accumulator kept the value counts (integer values), the VARIETY, MAJORITY, MINORITY and MEDIAN columns are
+    included, as in the table of ZonalStatisticsAsTable "ALL".
+    '''
+
+    zoneIds = stats.zoneIds()
+
+    if zoneValues is None:
+        zones = zoneIds
+    else:
+        zones = np.array([zoneValues[zoneId] for zoneId in zoneIds])
+
+    columns = [zones,
+               stats.count[zoneIds],
+               stats.count[zoneIds] * cellArea,
+               stats.min[zoneIds],
+               stats.max[zoneIds],
+               stats.max[zoneIds] - stats.min[zoneIds],
+               stats.mean()[zoneIds],
+               stats.std()[zoneIds],
+               stats.sum[zoneIds]]
+
+    names = [str(zoneColumn), 'COUNT', 'AREA', 'MIN', 'MAX', 'RANGE', 'MEAN', 'STD', 'SUM']
+
+    if stats.integerValues:
+        for name, values in zip(['VARIETY', 'MAJORITY', 'MINORITY', 'MEDIAN'], stats.valueStatistics()):
+            columns.append(values[zoneIds])
+            names.append(name)
+
+    if sumScales is not None:
+        for name, factor in sumScales:
+            columns.append(stats.sum[zoneIds] * factor)
+            names.append(name)
+
+    return np.rec.fromarrays(columns, names=names)
@@ -7,16 +7,53 @@ import os
 import configuration
 import numpy as np
 import arcpy
-from arcpy.sa import Reclassify, RemapRange, RemapValue, Raster, Slope, Con, IsNull, Float, Power, Sin, SetNull, Lookup
+from arcpy.sa import Raster
 import LUCI_SEEA.lib.log as log
 import LUCI_SEEA.lib.progress as progress
 import LUCI_SEEA.lib.common as common
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.rusle_engine as rusle_engine
+import LUCI_SEEA.lib.factor_lookup as factor_lookup
+import LUCI_SEEA.lib.factor_cache as factor_cache
+import LUCI_SEEA.lib.coverage as coverage
+import LUCI_SEEA.lib.zonal_stats as zonal_stats
 from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules([log, common])
+refresh_modules([log, common, raster_blocks, rusle_engine, factor_lookup, factor_cache, coverage, zonal_stats])
 
-def function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soilCode, lcOption, landCoverData, landCoverCode, rData, saveFactors, supportData, rerun=False):
+def reportUnmatched(unmatched, outputFolder):
+
+    ''' Warns about any codes which were not found in the K- and C-factor lookup tables '''
+
+    lookupNames = {'K': 'soil codes not found in the K-factor table',
+                   'C': 'land cover codes not found in the C-factor table'}
+
+    for factor in unmatched:
+        if len(unmatched[factor]) > 0:
+            warning = factor + '-factor: ' + lookupNames[factor] + ': ' + ', '.join([str(code) for code in sorted(unmatched[factor])])
+            log.warning(warning)
+            log.warning('Soil loss is NoData where these codes occur')
+            common.logWarnings(outputFolder, warning)
+
+def writeZoneTable(zoneStats, zoneValues, zoneColumn, grid, outTable):
+
+    ''' Writes the soil loss statistics of each aggregation zone, including the total soil loss in tonnes per year '''
+
+    if zoneColumn is None:
+        zoneColumn = 'ZONE'
+
+    cellArea = grid.cellSize * grid.cellSize
+    tableArray = zonal_stats.statsTable(zoneStats, zoneValues, zoneColumn, cellArea, [('TONNES', cellArea / 10000.0)])
+
+    if arcpy.Exists(outTable):
+        arcpy.Delete_management(outTable)
+
+    arcpy.da.NumPyArrayToTable(tableArray, outTable)
+
+    log.info('Soil loss zone table created: ' + str(outTable))
+
+def function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soilCode, lcOption, landCoverData, landCoverCode, rData, saveFactors, supportData, rerun=False, workers=1, lsExponents=None, zones=None, zoneColumn=None):
 
     try:
         # Set temporary variables
@@ -31,17 +68,6 @@ def function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soi
         landCoverClip = prefix + "landCoverClip"
         rainClip = prefix + "rainClip"
         supportClip = prefix + "supportClip"
-        DEMSlopeCut = prefix + "DEMSlopeCut"
-        DEMSlopeRad = prefix + "DEMSlopeRad"
-        upslopeArea = prefix + "upslopeArea"
-        soilJoin = prefix + "soilJoin"
-        lcJoin = prefix + "lcJoin"
-        rFactor = prefix + "rFactor"
-        lsFactor = prefix + "lsFactor"
-        kFactor = prefix + "kFactor"
-        cFactor = prefix + "cFactor"
-        pFactor = prefix + "pFactor"
-        soilLossInt = prefix + "soilLossInt"
         landCoverRas = prefix + "landCoverRas"
         soilRas = prefix + "soilRas"
         dataMask = prefix + "dataMask"
@@ -53,6 +79,7 @@ def function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soi
         inputSoil = files.soil_ras
         DEMSlopePerc = files.slopeRawPer
         DEMSlope = files.slopeHydDeg
+        DEMSlopeSin = files.slopeHydSin
         hydFAC = files.hydFAC
         rawDEM = files.rawDEM
         streamInvRas = files.streamInvRas
@@ -60,10 +87,10 @@ def function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soi
         # Set output filenames
         files = common.getFilenames('rusle', outputFolder)
         soilLoss = files.soilloss
+        soilLossZones = files.soillossZones
 
+        # RUSLE factor layers (only written if they are to be saved)
         if saveFactors:
-            # if RUSLE factor layers are to be saved
-
             rFactor = files.rFactor
             lsFactor = files.lsFactor
             kFactor = files.kFactor
@@ -201,24 +228,11 @@ def function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soi
                 if arcpy.Exists(data):
                     inputs.append(data)
 
-            for data in inputs:
-                dataMask = common.extractRasterMask(data)
-                common.checkCoverage(dataMask, studyMask, data)
-                del dataMask
-
-            progress.logProgress(codeBlock, outputFolder)
-
-        ####################################
-        ### Rainfall factor calculations ###
-        ####################################
-
-        codeBlock = 'Produce R-factor layer'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+            # Rasterise the study area mask once on the DEM grid, then compare each input with it
+            studyCoverage = coverage.CoverageMask(studyMask, rawDEM)
 
-            # Copy resampled raster
-            arcpy.CopyRaster_management(rainClip, rFactor)
-
-            log.info("R-factor layer produced")
+            for data in inputs:
+                studyCoverage.check(data, data)
 
             progress.logProgress(codeBlock, outputFolder)
 
@@ -226,164 +240,178 @@ def function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soi
         ### Slope length and steepness factor calculations ###
         ######################################################
 
-        codeBlock = 'Produce LS-factor layer'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+        if lsOption == 'UpslopeArea' and reconOpt == 'false':
+            log.error('Cannot calculate LS-factor including upslope contributing area on unreconditioned DEM')
+            log.error('Rerun the preprocessing tool to recondition the DEM')
+            sys.exit()
 
-            cutoffPercent = 50.0 # Hardcoded for now (approx 45 degrees)
-            cutoffAngle = 45.0
+        elif lsOption not in ['SlopeLength', 'UpslopeArea']:
+            log.error('Invalid LS-factor option')
+            sys.exit()
 
-            if lsOption == 'SlopeLength':
+        # Exponents (m, n) of the LS-factor equations
+        if lsExponents is None:
+            lsExponents = rusle_engine.defaultExponents
 
-                log.info("Calculating LS-factor based on slope length and steepness only")
+        log.info('LS-factor exponents: m = ' + str(lsExponents[0]) + ', n = ' + str(lsExponents[1]))
 
-                # Produce slope cutoff raster
-                DEMSlopeCutTemp = Con(Raster(DEMSlopePerc) > float(cutoffPercent), float(cutoffPercent), Raster(DEMSlopePerc))
-                DEMSlopeCutTemp.save(DEMSlopeCut)
+        ################################
+        ### Soil factor calculations ###
+        ################################
 
-                # Calculate the parts of the LS-factor equation separately
-                lsCalcA = (cellsizedem / 22.0) ** 0.5
-                lsCalcB = 0.065 + (0.045 * Raster(DEMSlopeCut)) + (0.0065 * Power(Raster(DEMSlopeCut), 2.0))
+        # K- and C-factors from the preprocessed soil and land cover are looked up block by block
+        lookups = {}
 
-                # Calculate the LS-factor
-                lsOrigTemp = lsCalcA * lsCalcB
-                lsOrigTemp.save(lsFactor)
+        if soilOption == 'PreprocessSoil':
 
-                log.info("LS-factor layer produced")
+            # Use the soil from the preprocessFolder
+            kSource = inputSoil
 
-            elif lsOption == 'UpslopeArea':                
+            kTable = os.path.join(configuration.tablesPath, "rusle_hwsd.dbf")
+            lookups['K'] = factor_lookup.loadLookup(kTable, "MU_GLOBAL", "K_Stewart")
 
-                if reconOpt == 'false':
-                    log.error('Cannot calculate LS-factor including upslope contributing area on unreconditioned DEM')
-                    log.error('Rerun the preprocessing tool to recondition the DEM')
-                    sys.exit()
+        elif soilOption == 'LocalSoil':
+
+            # User input is their own K-factor dataset
+            kSource = soilClip
 
-                log.info("Calculating LS-factor including upslope contributing area")
+        else:
+            log.error('Invalid soil erodibility option')
+            sys.exit()
 
-                # Produce slope cutoff raster
-                DEMSlopeCutTemp = Con(Raster(DEMSlope) > float(cutoffAngle), float(cutoffAngle), Raster(DEMSlope))
-                DEMSlopeCutTemp.save(DEMSlopeCut)
+        #################################
+        ### Cover factor calculations ###
+        #################################
 
-                # Convert from degrees to radian
-                DEMSlopeRadTemp = Raster(DEMSlopeCut) * 0.01745
-                DEMSlopeRadTemp.save(DEMSlopeRad)
+        if lcOption == 'PrerocessLC':
 
-                # Currently hardcoded, but should have them as options in future
-                m = 0.5
-                n = 1.2
+            # Use LC from the preprocess folder
+            cSource = inputLC
 
-                upslopeAreaTemp = Raster(hydFAC) * float(cellsizedem)
-                upslopeAreaTemp.save(upslopeArea)
+            cTable = os.path.join(configuration.tablesPath, "rusle_esacci.dbf")
+            lookups['C'] = factor_lookup.loadLookup(cTable, "LC_CODE", "CFACTOR")
 
-                lsFactorTemp = (m + 1) * Power(Raster(upslopeArea) / 22.1, float(m)) * Power(Sin(Raster(DEMSlopeRad)) / 0.09, float(n))
-                lsFactorTemp.save(lsFactor)
+        elif lcOption == 'LocalCfactor':
 
-                log.info("LS-factor layer produced")
+            # User input is their own C-factor dataset
+            cSource = landCoverClip
 
-            progress.logProgress(codeBlock, outputFolder)
+        else:
+            log.error('Invalid C-factor option')
+            sys.exit()
 
-        ################################
-        ### Soil factor calculations ###
-        ################################
+        ##############################
+        ### Soil loss calculations ###
+        ##############################
 
-        codeBlock = 'Produce K-factor layer'
+        codeBlock = 'Produce soil loss layer'
         if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
-        
-            if soilOption == 'PreprocessSoil':
 
-                # Use the soil from the preprocessFolder
-                arcpy.CopyRaster_management(inputSoil, soilClip)
+            # The R, LS, K, C and P factors are calculated block by block and multiplied together in memory.
+            # Only the soil loss raster (and the factor layers, if they are to be saved) are written out.
 
-                kTable = os.path.join(configuration.tablesPath, "rusle_hwsd.dbf")
-                arcpy.JoinField_management(soilClip, "VALUE", kTable, "MU_GLOBAL")
-                arcpy.CopyRaster_management(soilClip, soilJoin)
+            grid = raster_blocks.getGrid(rawDEM)
 
-                kOrigTemp = Lookup(soilJoin, "K_Stewart")
-                kOrigTemp.save(kFactor)
+            soilLossWriter = raster_blocks.createWriter(soilLoss, grid)
 
-            elif soilOption == 'LocalSoil':
+            factorWriters = {}
+            if saveFactors:
+                factorWriters['R'] = raster_blocks.createWriter(rFactor, grid)
+                factorWriters['LS'] = raster_blocks.createWriter(lsFactor, grid)
+                factorWriters['K'] = raster_blocks.createWriter(kFactor, grid)
+                factorWriters['C'] = raster_blocks.createWriter(cFactor, grid)
 
-                # User input is their own K-factor dataset
+                if supportData is not None:
+                    factorWriters['P'] = raster_blocks.createWriter(pFactor, grid)
 
-                kOrigTemp = Raster(soilClip)
-                kOrigTemp.save(kFactor)
+            sources = {'R': rainClip, 'K': kSource, 'C': cSource}
 
-            else:
-                log.error('Invalid soil erodibility option')
-                sys.exit()
-            
-            log.info("K-factor layer produced")
+            if lsOption == 'SlopeLength':
+                sources['slope'] = DEMSlopePerc
 
-            progress.logProgress(codeBlock, outputFolder)
+            elif lsOption == 'UpslopeArea':
+                sources['slope'] = DEMSlope
 
-        #################################
-        ### Cover factor calculations ###
-        #################################
+                # The sine term is only saved by newer versions of the preprocessing tool
+                if arcpy.Exists(DEMSlopeSin):
+                    sources['slopeSin'] = DEMSlopeSin
 
-        codeBlock = 'Produce C-factor layer'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+                sources['flowAcc'] = hydFAC
+                sources['streamInv'] = streamInvRas
 
-            if lcOption == 'PrerocessLC':
+            if supportData is not None:
+                sources['P'] = supportClip
 
-                # Use LC from the preprocess folder
+            unmatched = {}
+            for factor in lookups:
+                unmatched[factor] = set()
 
-                arcpy.CopyRaster_management(inputLC, landCoverClip)
+            # Reuse the LS- and K-factors from previous runs on the same preprocessed data if they are cached.
+            # Factors which are not cached yet are written to the cache during this run.
+            cache = factor_cache.openCache()
+            cacheWriters = {}
 
-                cTable = os.path.join(configuration.tablesPath, "rusle_esacci.dbf")
+            if cache is not None:
+                sources, lookups, cacheMisses, cachedUnmatched = factor_cache.cachedFactors(cache, sources, lookups,
+                                                                                            lsOption, soilOption,
+                                                                                            cellsizedem, grid,
+                                                                                            lsExponents)
+                for factor, codes in cachedUnmatched.items():
+                    unmatched[factor].update(codes.tolist())
 
-                arcpy.JoinField_management(landCoverClip, "VALUE", cTable, "LC_CODE")
-                arcpy.CopyRaster_management(landCoverClip, lcJoin)
+                for factor, key in cacheMisses.items():
+                    cacheWriters[factor] = raster_blocks.createWriter(cache.tempFile(key), grid)
 
-                cOrigTemp = Lookup(lcJoin, "CFACTOR")
-                cOrigTemp.save(cFactor)
+            returnFactors = list(set(factorWriters) | set(cacheWriters))
 
-            elif lcOption == 'LocalCfactor':
+            # Soil loss statistics for each aggregation zone are accumulated while the soil loss blocks are in memory
+            zoneRas = None
+            if zones is not None:
+                zoneRas, zoneValues = zonal_stats.prepareZones(zones, zoneColumn, rawDEM, prefix)
+                zoneStats = zonal_stats.ZonalAccumulator()
 
-                # User input is their own C-factor dataset
+            if workers != 1:
+                log.info("Calculating soil loss in parallel worker processes")
 
-                cOrigTemp = Raster(landCoverClip)
-                cOrigTemp.save(cFactor)
+            blocks = raster_blocks.iterBlocks(grid)
+            for block, results in raster_blocks.processBlocks(rusle_engine.soilLossBlock, blocks,
+                                                              (grid, sources, lsOption, cellsizedem, returnFactors, lookups,
+                                                               lsExponents, zoneRas),
+                                                              workers):
 
-            else:
-                log.error('Invalid C-factor option')
-                sys.exit()
+                for factor, writer in factorWriters.items():
+                    writer.write(block, results[factor])
 
-            log.info("C-factor layer produced")
+                for factor, writer in cacheWriters.items():
+                    writer.write(block, results[factor])
 
-            progress.logProgress(codeBlock, outputFolder)
+                soilLossWriter.write(block, results['soilLoss'])
 
-        #####################################
-        ### Support practice calculations ###
-        #####################################
+                if zoneRas is not None:
+                    zoneStats.merge(results['zoneStats'])
 
-        codeBlock = 'Produce P-factor layer'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+                for factor, codes in results['unmatched'].items():
+                    unmatched[factor].update(codes.tolist())
 
-            if supportData is not None:
-                arcpy.CopyRaster_management(supportClip, pFactor)
-                log.info("P-factor layer produced")
+            for writer in factorWriters.values():
+                writer.close()
 
-            progress.logProgress(codeBlock, outputFolder)
+            soilLossWriter.close()
 
-        ##############################
-        ### Soil loss calculations ###
-        ##############################
+            if zoneRas is not None:
+                writeZoneTable(zoneStats, zoneValues, zoneColumn, grid, soilLossZones)
 
-        codeBlock = 'Produce soil loss layer'
-        if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
+            if cache is not None:
+                for factor, writer in cacheWriters.items():
+                    factor_cache.storeFactor(cache, cacheMisses[factor], writer, unmatched.get(factor))
 
-            if supportData is not None:
-                soilLossTemp = Raster(rFactor) * Raster(lsFactor) * Raster(kFactor) * Raster(cFactor) * Raster(pFactor)
+                factor_cache.logReport(cache)
 
-            else:
-                soilLossTemp = Raster(rFactor) * Raster(lsFactor) * Raster(kFactor) * Raster(cFactor)
+            reportUnmatched(unmatched, outputFolder)
 
-            if lsOption == 'UpslopeArea':
-                soilLossTemp = soilLossTemp * Raster(streamInvRas)
-                soilLossTemp.save(soilLoss)
+            if saveFactors:
+                log.info("RUSLE factor layers produced")
 
-            else:           
-                soilLossTemp.save(soilLoss)
-            
             log.info("RUSLE function completed successfully")
 
             progress.logProgress(codeBlock, outputFolder)
@@ -5,105 +5,105 @@ LUCI RUSLE accounts function
 import sys
 import os
 import configuration
-import numpy as np
 import arcpy
-from arcpy.sa import *
 import LUCI_SEEA.lib.log as log
 import LUCI_SEEA.lib.common as common
 from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
-import LUCI_SEEA.solo.RUSLE as RUSLE
+import LUCI_SEEA.solo.RUSLE_scenarios as RUSLE_scenarios
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules([log, common, RUSLE])
+refresh_modules([log, common, RUSLE_scenarios])
 
-def function(outputFolder, yearAFolder, yearBFolder, lsOption, rData, soilData, soilCode, YearALCData, YearALCCode, YearBLCData, YearBLCCode, YearAPData, YearBPData, saveFactors):
+def epochDiffPairs(outputFolder, nEpochs):
 
-    try:
-        # Set temporary variables
-        prefix = os.path.join(arcpy.env.scratchGDB, "rusleAcc_")
+    '''
+    Soil loss differences reported by the accounts: between each pair of consecutive epochs, and between the opening
+    and closing epochs. Returns (i, j, outputRaster) tuples as used by RUSLE_scenarios.function.
+    '''
 
-        clipA = prefix + "clipA"
-        clipB = prefix + "clipB"
-        lossA = prefix + "lossA"
-        lossB = prefix + "lossB"
-        diffLoss = prefix + "diffLoss"
-        diffNullZero = prefix + "diffNullZero"
+    diffPairs = []
+    for i in range(nEpochs - 1):
+        diffPairs.append((i, i + 1, os.path.join(outputFolder, "slDiffE" + str(i + 1) + "_E" + str(i + 2))))
 
-        # Set output filenames
-        soilLossA = os.path.join(outputFolder, "soillossA")
-        soilLossB = os.path.join(outputFolder, "soillossB")
-        soilLossDiff = os.path.join(outputFolder, "soillossDiff")
+    # With two epochs the opening to closing difference is the same as the consecutive difference
+    if nEpochs > 2:
+        diffPairs.append((0, nEpochs - 1, os.path.join(outputFolder, "slDiffOpenCl")))
 
-        # Set soil option for both years
-        soilOption = 'LocalSoil'
+    return diffPairs
 
-        # Set LC option for both years
-        lcOption = 'LocalCfactor'
-        
-        ################################
-        ### Running RUSLE for Year A ###
-        ################################
+def multiEpoch(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soilCode, epochs, workers=1, incremental=False,
+               denseDiffs=True, zones=None, zoneColumn=None):
 
-        log.info('*****************************')
-        log.info('Running RUSLE tool for Year A')
-        log.info('*****************************')
+    '''
+    Soil loss accounts for an ordered list of epochs (e.g. one per year), given as RUSLE_scenarios.Scenario objects.
 
-        filesA = common.getFilenames('preprocess', yearAFolder)
-        studyMaskA = filesA.studyareamask
+    Soil loss for every epoch, the differences between consecutive epochs and the difference between the opening
+    and closing epochs are all calculated in a single pass over the tiles, with no intermediate raster copies.
+    If incremental is True, only the tiles whose inputs have changed since the previous run are recalculated.
+    Differences are always written in sparse form. The dense difference rasters are only written if denseDiffs is True.
+    If zones are given, a table of the soil loss in each aggregation zone is written for each epoch.
+    Returns the soil loss rasters, the dense difference rasters and the sparse difference files (consecutive
+    differences first).
+    '''
 
-        # Call RUSLE function for Year A        
-        soilLoss = RUSLE.function(outputFolder, yearAFolder, lsOption,
-                                  soilOption, soilData, soilCode,
-                                  lcOption, YearALCData, YearALCCode,
-                                  rData, saveFactors, YearAPData)
-        
-        arcpy.CopyRaster_management(soilLoss, soilLossA)
+    try:
+        if len(epochs) < 2:
+            log.error('At least two epochs are needed for soil loss accounts')
+            sys.exit()
 
-        # Delete intermediate files
-        arcpy.Delete_management(soilLoss)
+        for i, epoch in enumerate(epochs):
+            if epoch.soilLoss is None:
+                epoch.soilLoss = os.path.join(outputFolder, "soillossE" + str(i + 1))
 
-        ################################
-        ### Running RUSLE for Year B ###
-        ################################
+        log.info('Running RUSLE for ' + str(len(epochs)) + ' epochs: ' + ', '.join([str(epoch.name) for epoch in epochs]))
 
-        log.info('*****************************')
-        log.info('Running RUSLE tool for Year B')
-        log.info('*****************************')
+        soilLossRasters, diffRasters, sparseDiffs = RUSLE_scenarios.function(outputFolder, preprocessFolder, lsOption,
+                                                                             soilOption, soilData, soilCode, epochs,
+                                                                             epochDiffPairs(outputFolder, len(epochs)),
+                                                                             workers, incremental, denseDiffs,
+                                                                             zones, zoneColumn)
 
-        filesB = common.getFilenames('preprocess', yearBFolder)
-        studyMaskB = filesB.studyareamask
+        log.info("RUSLE multi-epoch accounts completed successfully")
 
-        # Call RUSLE function for Year B
-        soilLoss = RUSLE.function(outputFolder, yearBFolder, lsOption,
-                                  soilOption, soilData, soilCode,
-                                  lcOption, YearBLCData, YearBLCCode,
-                                  rData, saveFactors, YearBPData)
+        return soilLossRasters, diffRasters, sparseDiffs
 
-        arcpy.CopyRaster_management(soilLoss, soilLossB)
+    except Exception:
+        arcpy.AddError("RUSLE multi-epoch accounts failed")
+        raise
 
-        # Delete intermediate files
-        arcpy.Delete_management(soilLoss)
+def function(outputFolder, yearAFolder, yearBFolder, lsOption, rData, soilData, soilCode, YearALCData, YearALCCode, YearBLCData, YearBLCCode, YearAPData, YearBPData, saveFactors, incremental=False, zones=None, zoneColumn=None):
 
-        #######################################################
-        ### Calculate differences between Year A and Year B ###
-        #######################################################
+    try:
+        # Set output filenames
+        soilLossA = os.path.join(outputFolder, "soillossA")
+        soilLossB = os.path.join(outputFolder, "soillossB")
+        soilLossDiff = os.path.join(outputFolder, "soillossDiff")
 
-        log.info('*************************************************')
-        log.info('Calculating differences between Year A and Year B')
-        log.info('*************************************************')
+        # Set soil option for both years
+        soilOption = 'LocalSoil'
 
-        # Copy soil loss layers to temporary files
-        arcpy.CopyRaster_management(soilLossA, lossA)
-        arcpy.CopyRaster_management(soilLossB, lossB)
+        # Set LC option for both years
+        lcOption = 'LocalCfactor'
+
+        ###########################################
+        ### Running RUSLE for Year A and Year B ###
+        ###########################################
 
-        diffTemp = Raster(lossB) - Raster(lossA)
-        diffTemp.save(diffLoss)
+        # Both years are calculated in a single pass, with the difference between them.
+        # Factors shared by the two years (e.g. R and K) are only calculated once.
+
+        log.info('*************************************************')
+        log.info('Running RUSLE for Year A and Year B')
+        log.info('*************************************************')
 
-        log.info('Removing the areas of zero difference')
-        diffNullTemp = SetNull(diffLoss, diffLoss, "VALUE = 0")
-        diffNullTemp.save(diffNullZero)
+        scenarios = [RUSLE_scenarios.Scenario('Year A', rData, lcOption, YearALCData, YearALCCode, YearAPData,
+                                              yearAFolder, soilLossA),
+                     RUSLE_scenarios.Scenario('Year B', rData, lcOption, YearBLCData, YearBLCCode, YearBPData,
+                                              yearBFolder, soilLossB)]
 
-        arcpy.CopyRaster_management(diffNullZero, soilLossDiff)
+        RUSLE_scenarios.function(outputFolder, yearAFolder, lsOption, soilOption, soilData, soilCode,
+                                 scenarios, [(0, 1, soilLossDiff)], incremental=incremental, zones=zones,
+                                 zoneColumn=zoneColumn)
 
         log.info("RUSLE accounts function completed successfully")
 
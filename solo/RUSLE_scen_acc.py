@@ -5,37 +5,23 @@ LUCI RUSLE accounts function
 import sys
 import os
 import configuration
-import numpy as np
 import arcpy
-from arcpy.sa import *
 import LUCI_SEEA.lib.log as log
 import LUCI_SEEA.lib.common as common
 from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
-import LUCI_SEEA.solo.RUSLE as RUSLE
+import LUCI_SEEA.solo.RUSLE_scenarios as RUSLE_scenarios
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules([log, common, RUSLE])
+refresh_modules([log, common, RUSLE_scenarios])
 
-def function(outputFolder, yearAFolder, yearBFolder, lsOption, yearARain, yearBRain, yearASupport, yearBSupport):
+def function(outputFolder, yearAFolder, yearBFolder, lsOption, yearARain, yearBRain, yearASupport, yearBSupport, incremental=False):
 
     try:
-        # Set temporary variables
-        prefix = os.path.join(arcpy.env.scratchGDB, "rusleAcc_")
-
-        clipA = prefix + "clipA"
-        clipB = prefix + "clipB"
-        lossA = prefix + "lossA"
-        lossB = prefix + "lossB"
-        diffLoss = prefix + "diffLoss"
-        diffNullZero = prefix + "diffNullZero"
-
         # Set output filenames
         soilLossA = os.path.join(outputFolder, "soillossA")
         soilLossB = os.path.join(outputFolder, "soillossB")
         soilLossDiff = os.path.join(outputFolder, "soillossDiff")
 
-        saveFactors = False
-        
         # Set the factor options for both years
         soilOption = 'PreprocessSoil'
         lcOption = 'PrerocessLC'
@@ -43,71 +29,25 @@ def function(outputFolder, yearAFolder, yearBFolder, lsOption, yearARain, yearBR
         # Set options that are None for both years
         soilData = None
         soilCode = ''
-        landCoverData = None
-        landCoverCode = ''
-
-        ################################
-        ### Running RUSLE for Year A ###
-        ################################
-
-        log.info('*****************************')
-        log.info('Running RUSLE tool for Year A')
-        log.info('*****************************')
-
-        filesA = common.getFilenames('preprocess', yearAFolder)
-        studyMaskA = filesA.studyareamask
-
-        # Call RUSLE function for Year A        
-        soilLoss = RUSLE.function(outputFolder, yearAFolder, lsOption, soilOption,
-                                  soilData, soilCode, lcOption, landCoverData,
-                                  landCoverCode, yearARain, saveFactors, yearASupport)
-
-        arcpy.CopyRaster_management(soilLoss, soilLossA)
-
-        # Delete intermediate files
-        arcpy.Delete_management(soilLoss)
 
-        ################################
-        ### Running RUSLE for Year B ###
-        ################################
+        ###########################################
+        ### Running RUSLE for Year A and Year B ###
+        ###########################################
 
-        log.info('*****************************')
-        log.info('Running RUSLE tool for Year B')
-        log.info('*****************************')
-
-        filesB = common.getFilenames('preprocess', yearBFolder)
-        studyMaskB = filesB.studyareamask
-
-        # Call RUSLE function for Year B
-        soilLoss = RUSLE.function(outputFolder, yearBFolder, lsOption, soilOption,
-                                  soilData, soilCode, lcOption, landCoverData,
-                                  landCoverCode, yearBRain, saveFactors, yearBSupport)
-
-        arcpy.CopyRaster_management(soilLoss, soilLossB)
-
-        # Delete intermediate files
-        arcpy.Delete_management(soilLoss)
-
-        #######################################################
-        ### Calculate differences between Year A and Year B ###
-        #######################################################
+        # Both years are calculated in a single pass, with the difference between them.
+        # Factors shared by the two years (e.g. LS and K from the same DEM and soil) are only calculated once.
 
         log.info('*************************************************')
-        log.info('Calculating differences between Year A and Year B')
+        log.info('Running RUSLE for Year A and Year B')
         log.info('*************************************************')
 
-        # Copy soil loss layers to temporary files
-        arcpy.CopyRaster_management(soilLossA, lossA)
-        arcpy.CopyRaster_management(soilLossB, lossB)
-
-        diffTemp = Raster(lossB) - Raster(lossA)
-        diffTemp.save(diffLoss)
-
-        log.info('Removing the areas of zero difference')
-        diffNullTemp = SetNull(diffLoss, diffLoss, "VALUE = 0")
-        diffNullTemp.save(diffNullZero)
+        scenarios = [RUSLE_scenarios.Scenario('Year A', yearARain, lcOption, supportData=yearASupport,
+                                              preprocessFolder=yearAFolder, soilLoss=soilLossA),
+                     RUSLE_scenarios.Scenario('Year B', yearBRain, lcOption, supportData=yearBSupport,
+                                              preprocessFolder=yearBFolder, soilLoss=soilLossB)]
 
-        arcpy.CopyRaster_management(diffNullZero, soilLossDiff)
+        RUSLE_scenarios.function(outputFolder, yearAFolder, lsOption, soilOption, soilData, soilCode,
+                                 scenarios, [(0, 1, soilLossDiff)], incremental=incremental)
 
         log.info("RUSLE accounts function completed successfully")
 
@@ -0,0 +1,542 @@
+'''
+LUCI RUSLE scenario batch function
+
+Calculates soil loss for a batch of scenarios which differ in their rainfall, land cover and support practice inputs.
+All scenarios are evaluated tile by tile in a single pass, so the factors they share (e.g. LS and K from the same
+preprocessing folder, or R from the same rainfall data) are only read and calculated once per tile.
+'''
+
+import sys
+import os
+import configuration
+import arcpy
+from arcpy.sa import Raster
+import LUCI_SEEA.lib.log as log
+import LUCI_SEEA.lib.common as common
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.rusle_engine as rusle_engine
+import LUCI_SEEA.lib.factor_lookup as factor_lookup
+import LUCI_SEEA.lib.factor_cache as factor_cache
+import LUCI_SEEA.lib.tile_manifest as tile_manifest
+import LUCI_SEEA.lib.sparse_raster as sparse_raster
+import LUCI_SEEA.lib.coverage as coverage
+import LUCI_SEEA.lib.zonal_stats as zonal_stats
+import LUCI_SEEA.solo.RUSLE as RUSLE
+from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
+
+from LUCI_SEEA.lib.refresh_modules import refresh_modules
+refresh_modules([log, common, raster_blocks, rusle_engine, factor_lookup, factor_cache, tile_manifest, sparse_raster, coverage, zonal_stats, RUSLE])
+
+
+class Scenario(object):
+
+    '''
+    Inputs of a single RUSLE scenario.
+
+    lcOption is 'PrerocessLC' (C-factor looked up from the land cover in the preprocessing folder) or 'LocalCfactor'
+    (landCoverData is a C-factor dataset). preprocessFolder defaults to the preprocessing folder of the batch, and
+    soilLoss to a raster named after the position of the scenario in the batch.
+    lsExponents is the (m, n) pair of the LS-factor equations. Scenarios which only differ in their exponents can be
+    used for calibration sweeps, as the LS-factor variants are all calculated from one read of the slope data.
+    prior is the soil loss raster of a previous run, from which tiles whose inputs have not changed are copied.
+    '''
+
+    def __init__(self, name, rData, lcOption, landCoverData=None, landCoverCode='', supportData=None,
+                 preprocessFolder=None, soilLoss=None, lsExponents=None, prior=None):
+
+        self.name = name
+        self.rData = rData
+        self.lcOption = lcOption
+        self.landCoverData = landCoverData
+        self.landCoverCode = landCoverCode
+        self.supportData = supportData
+        self.preprocessFolder = preprocessFolder
+        self.soilLoss = soilLoss
+        self.lsExponents = lsExponents
+        self.prior = prior
+
+
+def coverageMask(studyMask, referenceRaster, coverageMasks):
+
+    ''' Returns the coverage mask of a study area, rasterised once per batch on the grid of the reference raster '''
+
+    if studyMask not in coverageMasks:
+        coverageMasks[studyMask] = coverage.CoverageMask(studyMask, referenceRaster)
+
+    return coverageMasks[studyMask]
+
+
+def prepareInput(data, code, name, cellSize, studyMask, prepared, coverageMasks, referenceRaster):
+
+    '''
+    Converts an input dataset to raster (if it is a vector), resamples it to the DEM cell size and clips it to the
+    study area. Inputs already prepared for another scenario are reused, so that the scenarios share the same raster.
+    The coverage of the input is checked against the study area mask, rasterised on the grid of the reference raster.
+    '''
+
+    key = (data, code, studyMask)
+    if key in prepared:
+        return prepared[key]
+
+    prefix = os.path.join(arcpy.env.scratchGDB, "rusleScen_" + name)
+    inputRas = prefix + "Ras"
+    inputResample = prefix + "Resample"
+    inputClip = prefix + "Clip"
+
+    dataFormat = arcpy.Describe(data).dataType
+
+    if dataFormat in ['ShapeFile', 'FeatureClass']:
+        arcpy.PolygonToRaster_conversion(data, code, inputRas, "CELL_CENTER", "", cellSize)
+    else:
+        arcpy.CopyRaster_management(data, inputRas)
+
+    resampledTemp = arcpy.sa.ApplyEnvironment(inputRas)
+    resampledTemp.save(inputResample)
+
+    arcpy.Clip_management(inputResample, "#", inputClip, studyMask, clipping_geometry="ClippingGeometry")
+
+    coverageMask(studyMask, referenceRaster, coverageMasks).check(inputClip, data)
+
+    prepared[key] = inputClip
+
+    return inputClip
+
+
+def tileInputs(digests, sources, lookups, lsOption, lsExponents, cellSize, grid, tileSize):
+
+    '''
+    Splits the inputs of a scenario into those compared as whole files between runs (e.g. the preprocessed DEM data)
+    and those compared tile by tile (e.g. the land cover and support practice data prepared in the scratch
+    geodatabase). Returns the names of the tile by tile inputs and a digest of everything else the tiles depend on.
+    digests is a factor_cache.SourceDigests (or the factor cache, which memoises file digests between runs).
+    '''
+
+    tileNames = []
+    values = [digests.codeVersion, lsOption, tuple(lsExponents), cellSize, tileSize,
+              grid.xMin, grid.yMax, grid.cellSize, grid.nRows, grid.nCols]
+
+    for name in sorted(sources):
+        digest = digests.sourceDigest(sources[name])
+
+        if digest is None:
+            tileNames.append(name)
+        else:
+            values.append((name, digest))
+
+    for factor in sorted(lookups):
+        values.append((factor, factor_cache.lookupDigest(lookups[factor])))
+
+    values.append(tuple(tileNames))
+
+    return tileNames, tile_manifest.sharedDigest(values)
+
+
+def sparseFile(raster):
+
+    ''' Sparse (.npz) version of a difference raster '''
+
+    if raster.lower().endswith('.tif'):
+        raster = raster[:-4]
+
+    return raster + '.npz'
+
+
+def zoneTableFile(raster):
+
+    ''' Table of the soil loss statistics of each aggregation zone, written next to a soil loss raster '''
+
+    return os.path.splitext(raster)[0] + 'Zones.dbf'
+
+
+def function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soilCode, scenarios, diffPairs=None, workers=1,
+             incremental=False, denseDiffs=True, zones=None, zoneColumn=None):
+
+    '''
+    Calculates soil loss for each scenario, and the change in soil loss between pairs of scenarios.
+
+    soilOption, soilData and soilCode are as for the RUSLE tool and apply to every scenario.
+    diffPairs is a list of (i, j) or (i, j, outputRaster) tuples of scenario indices. Each gives the change in soil
+    loss from scenario i to scenario j, with cells of no change set to NoData. By default each scenario is compared
+    with the first (baseline) scenario. Differences are written as sparse rasters (.npz files next to the difference
+    rasters), which only store the changed cells. The dense difference rasters are only written if denseDiffs is True.
+
+    A manifest of the inputs of each tile is written next to each soil loss raster. If incremental is True, tiles
+    whose inputs are unchanged since the previous run are copied from its output (or from the scenario's prior
+    soil loss raster, if it has one) rather than recalculated.
+
+    zones is an optional polygon feature class (dissolved on zoneColumn) or raster of aggregation zones. The soil loss
+    statistics of each zone are accumulated as the tiles are calculated and written to a table next to each soil loss
+    raster (see zoneTableFile).
+
+    Returns the soil loss rasters, the dense difference rasters (None if not written) and the sparse difference files.
+    '''
+
+    try:
+        if len(scenarios) == 0:
+            log.error('No RUSLE scenarios given')
+            sys.exit()
+
+        if diffPairs is None:
+            diffPairs = [(0, i) for i in range(1, len(scenarios))]
+
+        # Set output filenames
+        soilLossRasters = []
+        for i, scenario in enumerate(scenarios):
+            if scenario.soilLoss is not None:
+                soilLossRasters.append(scenario.soilLoss)
+            else:
+                soilLossRasters.append(os.path.join(outputFolder, "soilloss" + str(i + 1)))
+
+        pairs = []
+        diffRasters = []
+        for pair in diffPairs:
+            i, j = pair[0], pair[1]
+
+            if i not in range(len(scenarios)) or j not in range(len(scenarios)):
+                log.error('Invalid scenario pair for soil loss difference: ' + str(pair))
+                sys.exit()
+
+            pairs.append((i, j))
+
+            if len(pair) > 2:
+                diffRasters.append(pair[2])
+            else:
+                diffRasters.append(os.path.join(outputFolder, "sldiff" + str(i + 1) + "_" + str(j + 1)))
+
+        ####################
+        ### Check inputs ###
+        ####################
+
+        if lsOption not in ['SlopeLength', 'UpslopeArea']:
+            log.error('Invalid LS-factor option')
+            sys.exit()
+
+        inputs = []
+        if soilData is not None:
+            inputs.append(soilData)
+
+        for scenario in scenarios:
+            for data in [scenario.rData, scenario.landCoverData, scenario.supportData]:
+                if data is not None and data not in inputs:
+                    inputs.append(data)
+
+        for data in inputs:
+            spatialRef = arcpy.Describe(data).spatialReference
+
+            if spatialRef.Type == "Geographic":
+                # If any of the inputs are not in a projected coordinate system, the tool exits with a warning
+                log.error('Data: ' + str(data))
+                log.error('This data has a Geographic Coordinate System. It must have a Projected Coordinate System.')
+                sys.exit()
+
+        log.info('All new inputs are in a projected coordinate system, proceeding.')
+
+        folders = []
+        for scenario in scenarios:
+            if scenario.preprocessFolder is None:
+                scenario.preprocessFolder = preprocessFolder
+
+            if scenario.preprocessFolder not in folders:
+                folders.append(scenario.preprocessFolder)
+
+        if lsOption == 'UpslopeArea':
+            for folder in folders:
+                if common.getInputValue(folder, 'Recondition_DEM') == 'false':
+                    log.error('Cannot calculate LS-factor including upslope contributing area on unreconditioned DEM')
+                    log.error('Rerun the preprocessing tool to recondition the DEM: ' + str(folder))
+                    sys.exit()
+
+        try:
+            # Set environment and extents to the DEM of the batch preprocessing folder
+            files = common.getFilenames('preprocess', preprocessFolder)
+            rawDEM = files.rawDEM
+            studyMask = files.studyareamask
+
+            RawDEM = Raster(rawDEM)
+
+            arcpy.env.extent = RawDEM
+            arcpy.env.mask = RawDEM
+            arcpy.env.cellSize = RawDEM
+            arcpy.env.compression = "None"
+
+            cellsizedem = float(arcpy.GetRasterProperties_management(rawDEM, "CELLSIZEX").getOutput(0))
+
+            log.info("Calculation extent set to DEM data extent")
+
+        except Exception:
+            log.error("Environment and extent conditions not set correctly")
+            raise
+
+        ###########################################
+        ### Prepare the inputs of each scenario ###
+        ###########################################
+
+        prepared = {}
+        coverageMasks = {}
+
+        kLookup = None
+        if soilOption == 'PreprocessSoil':
+            kTable = os.path.join(configuration.tablesPath, "rusle_hwsd.dbf")
+            kLookup = factor_lookup.loadLookup(kTable, "MU_GLOBAL", "K_Stewart")
+
+        elif soilOption == 'LocalSoil':
+            log.info('Preparing soil erodibility data')
+            soilClip = prepareInput(soilData, soilCode, "soil", cellsizedem, studyMask, prepared, coverageMasks, rawDEM)
+
+        else:
+            log.error('Invalid soil erodibility option')
+            sys.exit()
+
+        cLookup = None
+        if any([scenario.lcOption == 'PrerocessLC' for scenario in scenarios]):
+            cTable = os.path.join(configuration.tablesPath, "rusle_esacci.dbf")
+            cLookup = factor_lookup.loadLookup(cTable, "LC_CODE", "CFACTOR")
+
+        scenarioInputs = []
+        for i, scenario in enumerate(scenarios):
+
+            log.info('Preparing inputs for scenario: ' + str(scenario.name))
+
+            files = common.getFilenames('preprocess', scenario.preprocessFolder)
+            scenarioMask = files.studyareamask
+            name = str(i + 1)
+
+            lookups = {}
+            sources = {'R': prepareInput(scenario.rData, '', "r" + name, cellsizedem, scenarioMask, prepared,
+                                        coverageMasks, rawDEM)}
+
+            if lsOption == 'SlopeLength':
+                sources['slope'] = files.slopeRawPer
+
+            elif lsOption == 'UpslopeArea':
+                sources['slope'] = files.slopeHydDeg
+
+                # The sine term is only saved by newer versions of the preprocessing tool
+                if arcpy.Exists(files.slopeHydSin):
+                    sources['slopeSin'] = files.slopeHydSin
+
+                sources['flowAcc'] = files.hydFAC
+                sources['streamInv'] = files.streamInvRas
+
+            if soilOption == 'PreprocessSoil':
+                sources['K'] = files.soil_ras
+                lookups['K'] = kLookup
+            else:
+                sources['K'] = soilClip
+
+            if scenario.lcOption == 'PrerocessLC':
+                sources['C'] = files.lc_ras
+                lookups['C'] = cLookup
+
+            elif scenario.lcOption == 'LocalCfactor':
+                sources['C'] = prepareInput(scenario.landCoverData, scenario.landCoverCode, "c" + name, cellsizedem,
+                                            scenarioMask, prepared, coverageMasks, rawDEM)
+
+            else:
+                log.error('Invalid C-factor option for scenario: ' + str(scenario.name))
+                sys.exit()
+
+            if scenario.supportData is not None:
+                sources['P'] = prepareInput(scenario.supportData, '', "p" + name, cellsizedem, scenarioMask, prepared,
+                                            coverageMasks, rawDEM)
+
+            lsExponents = scenario.lsExponents
+            if lsExponents is None:
+                lsExponents = rusle_engine.defaultExponents
+
+            scenarioInputs.append((sources, lookups, tuple(lsExponents)))
+
+        log.info('Inputs prepared for ' + str(len(scenarios)) + ' scenarios')
+
+        ##############################
+        ### Soil loss calculations ###
+        ##############################
+
+        grid = raster_blocks.getGrid(rawDEM)
+
+        unmatched = {}
+
+        # The inputs before any are replaced by cached factors, which the tile manifests describe
+        manifestInputs = list(scenarioInputs)
+
+        # Reuse the LS- and K-factors from previous runs on the same preprocessed data if they are cached.
+        # Factors which are not cached yet are written to the cache once, however many scenarios share them.
+        cache = factor_cache.openCache()
+        cacheWriters = []
+        returnFactors = []
+
+        if cache is not None:
+            checked = {}
+            cacheKeys = []
+
+            for i, (sources, lookups, lsExponents) in enumerate(scenarioInputs):
+                sources, lookups, cacheMisses, cachedUnmatched = factor_cache.cachedFactors(cache, sources, lookups,
+                                                                                            lsOption, soilOption,
+                                                                                            cellsizedem, grid,
+                                                                                            lsExponents, checked)
+                scenarioInputs[i] = (sources, lookups, lsExponents)
+
+                for factor, codes in cachedUnmatched.items():
+                    unmatched.setdefault(factor, set()).update(codes.tolist())
+
+                for factor, key in cacheMisses.items():
+                    if key not in cacheKeys:
+                        cacheKeys.append(key)
+                        cacheWriters.append((key, raster_blocks.createWriter(cache.tempFile(key), grid), set()))
+                        returnFactors.append((i, factor))
+
+        # Tile manifests of the inputs of each scenario, so that later runs can reuse the tiles which have not changed.
+        # They describe the inputs themselves rather than any cached factors, so that they are the same whether or
+        # not the factors were cached. The factor cache is only used to memoise the file digests between runs.
+        # Inputs hashed tile by tile are never replaced by cached factors (as they cannot be hashed as whole files).
+        tileSize = raster_blocks.getTileSize()
+        incrementalInputs = []
+        sharedDigests = []
+        priorFiles = []
+
+        digests = cache
+        if digests is None:
+            digests = factor_cache.SourceDigests()
+
+        for i, (sources, lookups, lsExponents) in enumerate(manifestInputs):
+            tileNames, sharedDigest = tileInputs(digests, sources, lookups, lsOption, lsExponents, cellsizedem,
+                                                 grid, tileSize)
+            sharedDigests.append(sharedDigest)
+
+            prior = scenarios[i].prior
+            if prior is None and incremental:
+                prior = soilLossRasters[i]
+
+            priorTiles = None
+            if prior is not None:
+                manifest = tile_manifest.readManifest(prior)
+
+                if manifest is not None and manifest['shared'] == sharedDigest:
+                    priorTiles = manifest['tiles']
+                else:
+                    log.info('Soil loss for scenario ' + str(scenarios[i].name) + ' cannot be reused from ' +
+                             str(prior) + ' as its shared inputs or options have changed')
+
+            # A previous .npy output is moved aside, as the writer for the new output overwrites it
+            if priorTiles is not None and prior == soilLossRasters[i] and raster_blocks.isNumpySource(prior):
+                priorFile = os.path.splitext(prior)[0] + '_prior.npy'
+                os.rename(prior, priorFile)
+                prior = priorFile
+                priorFiles.append(priorFile)
+
+            tile_manifest.removeManifest(soilLossRasters[i])
+
+            incrementalInputs.append((tileNames, prior, priorTiles))
+
+        newTiles = [{} for scenario in scenarios]
+        reusedTiles = [0] * len(scenarios)
+        nTiles = 0
+
+        sparseDiffs = [sparseFile(raster) for raster in diffRasters]
+
+        # Soil loss statistics for each aggregation zone are accumulated while the soil loss tiles are in memory
+        zoneRas = None
+        if zones is not None:
+            zoneRas, zoneValues = zonal_stats.prepareZones(zones, zoneColumn, rawDEM,
+                                                           os.path.join(arcpy.env.scratchGDB, "rusleScen_"))
+            zoneStats = [zonal_stats.ZonalAccumulator() for scenario in scenarios]
+
+        lossWriters = [raster_blocks.createWriter(raster, grid) for raster in soilLossRasters]
+        sparseWriters = [raster_blocks.createWriter(sparseDiff, grid) for sparseDiff in sparseDiffs]
+
+        diffWriters = []
+        if denseDiffs:
+            diffWriters = [raster_blocks.createWriter(raster, grid) for raster in diffRasters]
+        else:
+            diffRasters = [None] * len(diffRasters)
+
+        if workers != 1:
+            log.info("Calculating soil loss in parallel worker processes")
+
+        blocks = raster_blocks.iterBlocks(grid, tileSize)
+        for block, results in raster_blocks.processBlocks(rusle_engine.scenarioLossBlock, blocks,
+                                                          (grid, scenarioInputs, lsOption, cellsizedem, pairs,
+                                                           returnFactors, incrementalInputs, zoneRas),
+                                                          workers):
+            nTiles += 1
+
+            for i, tile in enumerate(results['tiles']):
+                if tile is not None:
+                    newTiles[i][block.key()] = tile
+
+                if results['reused'][i]:
+                    reusedTiles[i] += 1
+
+            for writer, loss in zip(lossWriters, results['soilLoss']):
+                writer.write(block, loss)
+
+            if zoneRas is not None:
+                for stats, blockStats in zip(zoneStats, results['zoneStats']):
+                    stats.merge(blockStats)
+
+            for writer, difference in zip(sparseWriters, results['difference']):
+                writer.write(block, difference)
+
+            for writer, difference in zip(diffWriters, results['difference']):
+                writer.write(block, difference)
+
+            for (i, factor), (key, writer, keyUnmatched), factorBlock in zip(returnFactors, cacheWriters, results['factors']):
+                writer.write(block, factorBlock)
+
+                if factor in results['unmatched'][i]:
+                    keyUnmatched.update(results['unmatched'][i][factor].tolist())
+
+            for scenarioUnmatched in results['unmatched']:
+                for factor, codes in scenarioUnmatched.items():
+                    unmatched.setdefault(factor, set()).update(codes.tolist())
+
+        for writer in lossWriters + sparseWriters + diffWriters:
+            writer.close()
+
+        if zoneRas is not None:
+            for stats, raster in zip(zoneStats, soilLossRasters):
+                RUSLE.writeZoneTable(stats, zoneValues, zoneColumn, grid, zoneTableFile(raster))
+
+        # Report the change in soil loss for each pair of scenarios from the sparse differences
+        for (i, j), sparseDiff in zip(pairs, sparseDiffs):
+            totals = sparse_raster.SparseRaster(sparseDiff).totals()
+
+            log.info('Change in soil loss from ' + str(scenarios[i].name) + ' to ' + str(scenarios[j].name) + ': ' +
+                     str(totals['count']) + ' cells changed, increase ' + str(round(totals['gain'], 2)) +
+                     ', decrease ' + str(round(totals['loss'], 2)) + ', net ' + str(round(totals['net'], 2)) +
+                     ' (sum of cell values)')
+
+        for i, raster in enumerate(soilLossRasters):
+            tile_manifest.writeManifest(raster, sharedDigests[i], newTiles[i])
+
+            if incrementalInputs[i][2] is not None:
+                log.info('Scenario ' + str(scenarios[i].name) + ': soil loss reused for ' + str(reusedTiles[i]) +
+                         ' of ' + str(nTiles) + ' tiles')
+
+        for priorFile in priorFiles:
+            os.remove(priorFile)
+
+        if cache is not None:
+            for (i, factor), (key, writer, keyUnmatched) in zip(returnFactors, cacheWriters):
+                factor_cache.storeFactor(cache, key, writer, keyUnmatched if factor == 'K' else None)
+
+            factor_cache.logReport(cache)
+
+        RUSLE.reportUnmatched(unmatched, outputFolder)
+
+        log.info("RUSLE scenario function completed successfully")
+
+        return soilLossRasters, diffRasters, sparseDiffs
+
+    except Exception:
+        arcpy.AddError("RUSLE scenario function failed")
+        raise
+
+    finally:
+        # Remove feature layers from memory
+        try:
+            for lyr in common.listFeatureLayers(locals()):
+                arcpy.Delete_management(locals()[lyr])
+                exec(lyr + ' = None') in locals()
+        except Exception:
+            pass
@@ -6,12 +6,14 @@ import os
 import configuration
 import arcpy
 import csv
+import numpy as np
 import LUCI_SEEA.lib.log as log
 import LUCI_SEEA.lib.common as common
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
 from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules([log, common])
+refresh_modules([log, common, raster_blocks])
 
 def function(outputFolder, inputData, aggregationColumn):
 
@@ -20,7 +22,6 @@ def function(outputFolder, inputData, aggregationColumn):
         prefix = os.path.join(arcpy.env.scratchGDB, "extent_")
         zones = prefix + "aggZones"
         outZonal = prefix + "outZonal"
-        rasData = prefix + "rasData"
 
         # Define field names
         extentName = "area_km2"
@@ -138,18 +139,6 @@ def function(outputFolder, inputData, aggregationColumn):
                 log.error('Please ensure input raster is integer type')
                 sys.exit()
 
-            # Check if COUNT column exists
-            inputFields = arcpy.ListFields(inputData)
-            countFound = False
-            for field in inputFields:
-                if field.name == 'COUNT':
-                    countFound = True
-
-            if countFound == False:
-                log.error('COUNT column not found')
-                log.error('Please ensure your raster has a COUNT column')
-                sys.exit()
-
             # Get cell size of the raster
             cellSize = float(arcpy.GetRasterProperties_management(inputData, "CELLSIZEX").getOutput(0))
             
@@ -159,65 +148,66 @@ def function(outputFolder, inputData, aggregationColumn):
                 log.error('Please use a spatial reference that is in metres')
                 sys.exit()
 
-            # Copy raster to temporary file
-            arcpy.CopyRaster_management(inputData, rasData)
+            # Count the cells of each raster value block by block
+            grid = raster_blocks.getGrid(inputData)
+            valueCounts = {}
 
-            # Copy raster table to scratch GDB
-            arcpy.TableToTable_conversion(inputData, arcpy.env.scratchGDB, "extent_table")
-            dbfTable = os.path.join(arcpy.env.scratchGDB, "extent_table")
-            
-            # Add new fields to the dbfTable
-            arcpy.AddField_management(dbfTable, extentName, "FLOAT")
-            arcpy.AddField_management(dbfTable, percName, "FLOAT")
+            for block in raster_blocks.iterBlocks(grid):
+                dataBlock = raster_blocks.readBlock(inputData, grid, block)
+                values, counts = np.unique(dataBlock[~np.isnan(dataBlock)], return_counts=True)
 
-            # Calculate total area and area of each class
-            totalArea = 0.0
-            fields = [str(aggregationColumn), 'COUNT', extentName]
-            with arcpy.da.UpdateCursor(dbfTable, fields) as updateCursor:
-                for row in updateCursor:
-                    name = row[0]
-                    count = row[1]
+                for value, count in zip(values, counts):
+                    valueCounts[int(value)] = valueCounts.get(int(value), 0) + int(count)
 
-                    # Calculate area in km2
-                    area = float(count) * float(cellSize) * float(cellSize) / 1000000.0
-                    row[2] = area
+            # Find the class of each raster value from the raster attribute table
+            classNames = {}
+            if str(aggregationColumn).upper() == 'VALUE':
+                for value in valueCounts:
+                    classNames[value] = value
 
-                    totalArea += area
+            else:
+                # Check if the aggregation column exists
+                inputFields = arcpy.ListFields(inputData)
+                columnFound = False
+                for field in inputFields:
+                    if field.name == str(aggregationColumn):
+                        columnFound = True
+
+                if columnFound == False:
+                    log.error('Aggregation column (' + str(aggregationColumn) + ') not found in raster attribute table')
+                    log.error('Please ensure this field is present')
+                    sys.exit()
+
+                with arcpy.da.SearchCursor(inputData, ['VALUE', str(aggregationColumn)]) as cursor:
+                    for row in cursor:
+                        classNames[int(row[0])] = row[1]
 
-                    # Update row with area
-                    try:
-                        updateCursor.updateRow(row)
-                    except Exception:
-                        pass
+            # Calculate area of each class in km2 and the total area
+            outRows = []
+            totalArea = 0.0
+            for value in sorted(valueCounts):
 
-            # Calculate percent coverage of each class
-            fieldsPerc = [str(extentName), str(percName)]
-            with arcpy.da.UpdateCursor(dbfTable, fieldsPerc) as updateCursor:
-                for row in updateCursor:
+                area = float(valueCounts[value]) * float(cellSize) * float(cellSize) / 1000000.0
+                totalArea += area
 
-                    area = row[0]
-                    percentCoverage = (float(area) / float(totalArea)) * 100.0
-                    row[1] = percentCoverage
+                outRows.append([classNames.get(value, value), area])
 
-                    # Update row with percent coverage
-                    try:
-                        updateCursor.updateRow(row)
-                    except Exception:
-                        pass
+            # Calculate percent coverage of each class
+            for outRow in outRows:
+                percentCoverage = (float(outRow[1]) / float(totalArea)) * 100.0
+                outRow.append(percentCoverage)
 
             log.info('Percent coverage calculated for each class')
 
             # Write output to CSV file
-            outFields = [aggregationColumn, extentName, percName]
             outLabels = ['Classes', 'Area (sq km)', 'Area (percent)']
 
             with open(outTable, 'wb') as csv_file:
                 writer = csv.writer(csv_file)
                 writer.writerow(outLabels)
 
-                with arcpy.da.SearchCursor(dbfTable, outFields) as cursor:
-                    for row in cursor:
-                        writer.writerow(row)
+                for outRow in outRows:
+                    writer.writerow(outRow)
 
                 log.info('Extent csv table created')
 
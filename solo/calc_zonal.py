@@ -5,14 +5,16 @@ import sys
 import os
 import configuration
 import arcpy
-from arcpy.sa import ZonalStatisticsAsTable
+import numpy as np
 import csv
 import LUCI_SEEA.lib.log as log
 import LUCI_SEEA.lib.common as common
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.zonal_stats as zonal_stats
 from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules([log, common])
+refresh_modules([log, common, raster_blocks, zonal_stats])
 
 def function(outputFolder, inputRaster, aggregationZones, aggregationColumn):
 
@@ -20,42 +22,51 @@ def function(outputFolder, inputRaster, aggregationZones, aggregationColumn):
         # Set temporary variables
         prefix = os.path.join(arcpy.env.scratchGDB, "zonal_")
 
-        zones = prefix + "aggZones"
-        outZonal = prefix + "outZonal"
-
         # Define output files
         outRaster = os.path.join(outputFolder, 'statRaster')
         outTable = os.path.join(outputFolder, 'statTable.dbf')
 
-        # Check if the aggregation column exists
-        zoneFields = arcpy.ListFields(aggregationZones)
-        zoneFound = False
-        for field in zoneFields:
-            fieldName = str(field.name)
+        grid = raster_blocks.getGrid(inputRaster)
+        zoneRas, zoneValues = zonal_stats.prepareZones(aggregationZones, aggregationColumn, inputRaster, prefix)
+
+        # Accumulate the statistics of each zone block by block. For integer rasters, the value counts of each zone
+        # are also kept for the variety, majority, minority and median.
+        stats = zonal_stats.ZonalAccumulator(arcpy.Raster(inputRaster).isInteger)
+        maxZone = -1
+
+        for block in raster_blocks.iterBlocks(grid):
+            zoneBlock = raster_blocks.readBlock(zoneRas, grid, block)
+            valueBlock = raster_blocks.readBlock(inputRaster, grid, block)
+            stats.add(zoneBlock, valueBlock)
 
-            if fieldName == str(aggregationColumn):             
-                zoneFound = True
+            if not np.isnan(zoneBlock).all():
+                maxZone = max(maxZone, int(np.nanmax(zoneBlock)))
 
-        if zoneFound == False:
-            log.error('Aggregation column (' + str(aggregationColumn) + ') not found in zone shapefile')
-            log.error('Please ensure this field is present')
-            sys.exit()
+        # Make sure every zone id on the zone raster has an entry, even zones which contain no values
+        stats.grow(maxZone + 1)
+        zoneMeans = stats.mean()
 
-        # Dissolve aggregation zone based on aggregation column
-        arcpy.Dissolve_management(aggregationZones, zones, aggregationColumn)
-        log.info("Dissolved aggregation zones based on: " + str(aggregationColumn))
+        # Calculate zonal statistics raster (mean of each zone)
+        writer = raster_blocks.createWriter(outRaster, grid)
 
-        # Check out the ArcGIS Spatial Analyst extension license
-        arcpy.CheckOutExtension("Spatial")
+        for block in raster_blocks.iterBlocks(grid):
+            zoneBlock = raster_blocks.readBlock(zoneRas, grid, block)
 
-        # Calculate zonal statistics raster
-        outZonal = arcpy.sa.ZonalStatistics(zones, aggregationColumn, inputRaster, "MEAN", "DATA")
-        outZonal.save(outRaster)
+            meanBlock = np.full(zoneBlock.shape, np.nan)
+            inZone = ~np.isnan(zoneBlock)
+            meanBlock[inZone] = zoneMeans[zoneBlock[inZone].astype(np.int64)]
+
+            writer.write(block, meanBlock)
+
+        writer.close()
         arcpy.CalculateStatistics_management(outRaster)
-        log.info("Mean zonal statistics calculated")        
+        log.info("Mean zonal statistics calculated")
 
         # Calculate zonal statistics table
-        outZSTable = ZonalStatisticsAsTable(zones, aggregationColumn, inputRaster, outTable, "DATA", "ALL")
+        cellArea = grid.cellSize * grid.cellSize
+        tableArray = zonal_stats.statsTable(stats, zoneValues, aggregationColumn, cellArea)
+
+        arcpy.da.NumPyArrayToTable(tableArray, outTable)
 
         log.info("Zonal statistics function completed successfully")
 
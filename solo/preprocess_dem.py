@@ -3,27 +3,34 @@ Preprocessing tool for LUCI. Generates hydrographical and topographical files
 for use in other LUCI functions.
 '''
 import arcpy
-from arcpy.sa import Con, Int, IsNull, Reclassify, RemapRange, RemapValue, Raster, Fill, Float, Hillshade, BooleanXOr
-from arcpy.sa import FlowAccumulation, FlowDirection, ApplyEnvironment, Sink, SnapPourPoint, SetNull, StreamOrder, Slope
+from arcpy.sa import Con, Int, IsNull, Reclassify, RemapRange, RemapValue, Raster, Float, Hillshade, BooleanXOr
+from arcpy.sa import ApplyEnvironment, Sink, SnapPourPoint, SetNull
 import os
 import traceback
 import stat
 import math
 import configuration
 import sys
+import numpy as np
 
 import LUCI_SEEA.lib.progress as progress
 import LUCI_SEEA.lib.log as log
 import LUCI_SEEA.lib.common as common
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.fill_sinks as fill_sinks
+import LUCI_SEEA.lib.flow_direction as flow_direction
+import LUCI_SEEA.lib.flow_accumulation as flow_accumulation
+import LUCI_SEEA.lib.slope as slope
+import LUCI_SEEA.lib.stream_network as stream_network
 import LUCI_SEEA.solo.reconditionDEM as reconditionDEM
 import LUCI_SEEA.lib.baseline as baseline
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules([log, common, reconditionDEM, baseline])
+refresh_modules([log, common, raster_blocks, fill_sinks, flow_direction, flow_accumulation, slope, stream_network, reconditionDEM, baseline])
 
 
 def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAccThresh,
-             smoothDropBuffer, smoothDrop, streamDrop, reconDEM, rerun=False):
+             smoothDropBuffer, smoothDrop, streamDrop, reconDEM, rerun=False, workers=1):
 
     try:
         # Set environment variables
@@ -52,6 +59,7 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
         slopeRawPer = files.slopeRawPer
         slopeHydDeg = files.slopeHydDeg
         slopeHydPer = files.slopeHydPer
+        slopeHydSin = files.slopeHydSin
 
         ###############################
         ### Set temporary variables ###
@@ -62,7 +70,6 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
         cellSizeDEM = float(arcpy.env.cellSize)
 
         burnedDEM = prefix + "burnedDEM"
-        streamAccHaFile = prefix + "streamAccHa"
         rawFDR = prefix + "rawFDR"        
         allPolygonSinks = prefix + "allPolygonSinks"
         DEMTemp = prefix + "DEMTemp"
@@ -100,20 +107,23 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
         codeBlock = 'Create multiplier raster'
         if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
-            Reclassify(rawDEM, "Value", RemapRange([[-999999.9, 999999.9, 1]]), "NODATA").save(multRaster)
+            # Multiplier is 1 wherever the DEM has data
+            grid = raster_blocks.getGrid(rawDEM)
+            multWriter = raster_blocks.createWriter(multRaster, grid, "8_BIT_UNSIGNED")
+
+            for block in raster_blocks.iterBlocks(grid):
+                DEMBlock = raster_blocks.readBlock(rawDEM, grid, block)
+                multWriter.write(block, np.where(np.isnan(DEMBlock), np.nan, 1.0))
+
+            multWriter.close()
+
             progress.logProgress(codeBlock, outputFolder)
 
         codeBlock = 'Calculate slope'
         if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
-            
-            intSlopeRawDeg = Slope(rawDEM, "DEGREE")
-            intSlopeRawDeg.save(slopeRawDeg)
-            del intSlopeRawDeg
-
-            intSlopeRawPer = Slope(rawDEM, "PERCENT_RISE")
-            intSlopeRawPer.save(slopeRawPer)
-            del intSlopeRawPer
+            # Degrees and percent rise from the same pass over the DEM
+            slope.calculateSlope(rawDEM, {'degrees': slopeRawDeg, 'percent': slopeRawPer}, workers=workers)
 
             log.info('Slope calculated')
 
@@ -130,7 +140,7 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
 
                 # Recondition DEM (burning stream network in using AGREE method)
                 log.info("Burning streams into DEM.")
-                reconditionDEM.function(rawDEM, streamInput, smoothDropBuffer, smoothDrop, streamDrop, burnedDEM)
+                reconditionDEM.function(rawDEM, streamInput, smoothDropBuffer, smoothDrop, streamDrop, burnedDEM, workers)
                 log.info("Completed stream network burn in to DEM")
 
                 progress.logProgress(codeBlock, outputFolder)
@@ -142,7 +152,8 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
             codeBlock = 'Fill sinks'
             if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
-                Fill(burnedDEM).save(hydDEM)
+                # Priority-flood fill, tile by tile so that large DEMs fit in memory
+                fill_sinks.fillSinksTiled(burnedDEM, hydDEM)
 
                 log.info("Sinks in DEM filled")
                 progress.logProgress(codeBlock, outputFolder)
@@ -154,22 +165,11 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
             codeBlock = 'Flow direction'
             if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
-                FlowDirection(hydDEM, "NORMAL").save(hydFDR)
+                # D8 flow direction as ESRI codes, and in degrees (for display purposes), from the same pass
+                flow_direction.flowDirection(hydDEM, hydFDR, hydFDRDegrees, workers=workers)
                 log.info("Flow Direction calculated")
                 progress.logProgress(codeBlock, outputFolder)
 
-            #################################
-            ### Flow direction in degrees ###
-            #################################
-
-            codeBlock = 'Flow direction in degrees'
-            if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
-
-                # Save flow direction raster in degrees (for display purposes)
-                degreeValues = RemapValue([[1, 90], [2, 135], [4, 180], [8, 225], [16, 270], [32, 315], [64, 0], [128, 45]])
-                Reclassify(hydFDR, "Value", degreeValues, "NODATA").save(hydFDRDegrees)
-                progress.logProgress(codeBlock, outputFolder)
-
             #########################
             ### Flow accumulation ###
             #########################
@@ -177,9 +177,14 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
             codeBlock = 'Flow accumulation'
             if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
-                hydFACTemp = FlowAccumulation(hydFDR, "", "FLOAT")
-                hydFACTemp.save(hydFAC)
-                arcpy.sa.Int(Raster(hydFAC)).save(hydFACInt) # integer version
+                # Accumulate tile by tile, then write the integer version from the float version
+                grid = raster_blocks.getGrid(hydFDR)
+                flow_accumulation.flowAccumulationTiled(hydFDR, [hydFAC], grid=grid, workers=workers)
+
+                hydFACIntWriter = raster_blocks.createWriter(hydFACInt, grid, "32_BIT_SIGNED")
+                for block in raster_blocks.iterBlocks(grid):
+                    hydFACIntWriter.write(block, np.floor(raster_blocks.readBlock(hydFAC, grid, block)))
+                hydFACIntWriter.close()
                 log.info("Flow Accumulation calculated")
 
                 progress.logProgress(codeBlock, outputFolder)
@@ -192,13 +197,9 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
             codeBlock = 'Calculate slope on burned DEM'
             if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
-                intSlopeHydDeg = Slope(hydDEM, "DEGREE")
-                intSlopeHydDeg.save(slopeHydDeg)
-                del intSlopeHydDeg
-
-                intSlopeHydPer = Slope(hydDEM, "PERCENT_RISE")
-                intSlopeHydPer.save(slopeHydPer)
-                del intSlopeHydPer
+                # Degrees, percent rise and the sine term of the LS-factor from the same pass over the DEM
+                slope.calculateSlope(hydDEM, {'degrees': slopeHydDeg, 'percent': slopeHydPer, 'lsSine': slopeHydSin},
+                                     workers=workers)
 
                 log.info('Slope calculated')
 
@@ -211,58 +212,57 @@ def function(outputFolder, DEM, studyAreaMask, streamInput, minAccThresh, majAcc
             codeBlock = 'Create stream file'
             if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
                 
-                # Create accumulation in metres
-                streamAccHaFileInt = hydFACTemp * cellSizeDEM * cellSizeDEM / 10000.0
-                streamAccHaFileInt.save(streamAccHaFile)
-                del streamAccHaFileInt
+                # Create accumulation in hectares, then the inverse stream raster (1 for no stream, 0 for stream)
+                # and the stream raster for display (1 for minor streams, 2 for major rivers) in the same pass
+                grid = raster_blocks.getGrid(hydFAC)
+                streamInvWriter = raster_blocks.createWriter(streamInvRas, grid, "8_BIT_UNSIGNED")
+                streamsWriter = raster_blocks.createWriter(streamsRasterFile, grid, "8_BIT_UNSIGNED")
 
-                # Check stream initiation threshold reached
-                streamYes = float(arcpy.GetRasterProperties_management(streamAccHaFile, "MAXIMUM").getOutput(0))
+                streamYes = None
+                for block in raster_blocks.iterBlocks(grid):
 
-                if streamYes > float(minAccThresh):
+                    streamAccHa = raster_blocks.readBlock(hydFAC, grid, block) * cellSizeDEM * cellSizeDEM / 10000.0
+                    noData = np.isnan(streamAccHa)
 
-                    reclassifyRanges = RemapRange([[-1000000, float(minAccThresh), 1],
-                                                   [float(minAccThresh), 9999999999, 0]])
+                    if not noData.all():
+                        blockMax = np.max(streamAccHa[~noData])
+                        if streamYes is None or blockMax > streamYes:
+                            streamYes = blockMax
 
-                    outLUCIstream = Reclassify(streamAccHaFile, "VALUE", reclassifyRanges)
-                    outLUCIstream.save(streamInvRas)
-                    del outLUCIstream
-                    log.info("Stream raster for input to LUCI created")
+                    streamInv = np.where(streamAccHa > float(minAccThresh), 0.0, 1.0)
+                    streamInv[noData] = np.nan
+                    streamInvWriter.write(block, streamInv)
 
-                    # Create stream file for display
-                    reclassifyRanges = RemapRange([[0, float(minAccThresh), "NODATA"],
-                                        [float(minAccThresh), float(majAccThresh), 1],
-                                        [float(majAccThresh), 99999999999999, 2]])
+                    streamsBlock = np.where(streamAccHa > float(majAccThresh), 2.0, 1.0)
+                    streamsBlock[~(streamAccHa > float(minAccThresh))] = np.nan
+                    streamsWriter.write(block, streamsBlock)
 
-                    streamsRaster = Reclassify(streamAccHaFile, "Value", reclassifyRanges, "NODATA")
-                    streamOrderRaster = StreamOrder(streamsRaster, hydFDR, "STRAHLER")
-                    streamsRaster.save(streamsRasterFile)
+                streamInvWriter.close()
+                streamsWriter.close()
 
-                    # Create two streams feature classes - one for analysis and one for display
-                    arcpy.sa.StreamToFeature(streamOrderRaster, hydFDR, streams, 'NO_SIMPLIFY')
-                    arcpy.sa.StreamToFeature(streamOrderRaster, hydFDR, streamDisplay, 'SIMPLIFY')
+                # Check stream initiation threshold reached
+                if streamYes is not None and streamYes > float(minAccThresh):
+
+                    log.info("Stream raster for input to LUCI created")
 
-                    # Rename grid_code column to 'Strahler'
-                    for streamFC in [streams, streamDisplay]:
+                    # Trace the stream links and their Strahler order once, then write two streams feature classes
+                    # from the same lines - one for analysis and one (simplified) for display
+                    streamLinks = stream_network.traceStreams(hydFDR, streamsRasterFile, grid=grid, workers=workers)
 
-                        arcpy.AddField_management(streamFC, "Strahler", "LONG")
-                        arcpy.CalculateField_management(streamFC, "Strahler", "!GRID_CODE!", "PYTHON_9.3")
-                        arcpy.DeleteField_management(streamFC, "GRID_CODE")
+                    stream_network.writeStreamLines(streamLinks, streams, grid.spatialRef)
+                    stream_network.writeStreamLines(streamLinks, streamDisplay, grid.spatialRef, simplify=True)
 
-                    del streamsRaster
-                    del streamOrderRaster
+                    del streamLinks
 
                     log.info("Stream files created")
 
                 else:
 
+                    # The inverse stream raster has a value of 1 (no stream) for all cells
                     warning = 'No streams initiated'
                     log.warning(warning)
                     common.logWarnings(outputFolder, warning)
 
-                    # Create LUCIStream file from multiplier raster (i.e. all cells have value of 1 = no stream)
-                    arcpy.CopyRaster_management(multRaster, streamInvRas)
-
                 progress.logProgress(codeBlock, outputFolder)
 
         codeBlock = 'Clip data, build pyramids and generate statistics'
@@ -1,17 +1,18 @@
 import arcpy
-from arcpy.sa import EucDistance, Con, IsNull, Raster
 
 import LUCI_SEEA.lib.log as log
+import LUCI_SEEA.lib.stream_burning as stream_burning
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules([log])
+refresh_modules([log, stream_burning])
 
-def function(DEM, streamNetwork, smoothDropBuffer, smoothDrop, streamDrop, outputReconDEM):
+def function(DEM, streamNetwork, smoothDropBuffer, smoothDrop, streamDrop, outputReconDEM, workers=1):
 
     try:
         # Set environment variables
         arcpy.env.extent = DEM
         arcpy.env.mask = DEM
         arcpy.env.cellSize = DEM
+        arcpy.env.snapRaster = DEM
 
         # Set temporary variables
         prefix = "recon_"
@@ -23,23 +24,12 @@ def function(DEM, streamNetwork, smoothDropBuffer, smoothDrop, streamDrop, outpu
 
         # Convert stream network to raster
         arcpy.PolylineToRaster_conversion(streamNetwork, OIDField, streamRaster, "", "", size)
+        streamRaster = arcpy.Describe(streamRaster).catalogPath # Full path, for worker processes
 
-        # Work out distance of cells from stream
-        distanceFromStream = EucDistance(streamRaster, "", size)
-
-        # Elements within a buffer distance of the stream are smoothly dropped
-        intSmoothDrop = Con(distanceFromStream > float(smoothDropBuffer), 0,
-                            (float(smoothDrop) / float(smoothDropBuffer)) * (float(smoothDropBuffer) - distanceFromStream))
-        del distanceFromStream
-
-        # Burn this smooth drop into DEM. Cells in stream are sharply dropped by the value of "streamDrop"
-        binaryStream = Con(IsNull(Raster(streamRaster)), 0, 1)
-        reconDEMTemp = Raster(DEM) - intSmoothDrop - (float(streamDrop) * binaryStream)
-        del intSmoothDrop
-        del binaryStream
-        
-        reconDEMTemp.save(outputReconDEM)
-        del reconDEMTemp
+        # Cells within a buffer distance of the stream are smoothly dropped, and cells in the stream are sharply
+        # dropped by the value of "streamDrop", in one pass over the DEM
+        stream_burning.burnStreams(DEM, streamRaster, outputReconDEM, smoothDropBuffer, smoothDrop, streamDrop,
+                                   workers=workers)
 
         log.info("Reconditioned DEM generated")
 
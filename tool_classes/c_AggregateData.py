@@ -30,6 +30,19 @@ class AggregateData(object):
             refresh_modules(input_validation)
             
             input_validation.checkFilePaths(self)
+
+            # Feature class data needs a classification column. Raster data is classified by its cell values.
+            dataParam = self.params[7]
+            columnParam = self.params[8]
+
+            if dataParam.value is not None and not columnParam.valueAsText:
+                try:
+                    isRaster = arcpy.Describe(dataParam.valueAsText).dataType in ['RasterDataset', 'RasterLayer']
+                except Exception:
+                    isRaster = False
+
+                if not isRaster:
+                    columnParam.setErrorMessage('A classification column is required for feature class data')
     
     def __init__(self):
         self.label = u'Calculate aggregate habitat statistics'
@@ -114,14 +127,14 @@ class AggregateData(object):
         param.displayName = u'Data to aggregate'
         param.parameterType = 'Required'
         param.direction = 'Input'
-        param.datatype = u'Feature Class'
+        param.datatype = [u'Feature Class', u'Raster Layer']
         params.append(param)
 
         # 8 Classification_column
         param = arcpy.Parameter()
         param.name = u'Classification_column'
-        param.displayName = u'Classification column'
-        param.parameterType = 'Required'
+        param.displayName = u'Classification column (not needed for raster data)'
+        param.parameterType = 'Optional'
         param.direction = 'Input'
         param.datatype = u'String'
         params.append(param)
@@ -145,6 +158,16 @@ class AggregateData(object):
         param.value = u'False'
         params.append(param)
 
+        # 11 Number_of_workers
+        param = arcpy.Parameter()
+        param.name = u'Number_of_workers'
+        param.displayName = u'Number of worker processes (0 to use all processors)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Long'
+        param.value = 1
+        params.append(param)
+
         return params
 
     def isLicensed(self):
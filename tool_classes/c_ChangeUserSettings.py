@@ -3,9 +3,11 @@ import os
 
 import configuration
 import LUCI_SEEA.lib.common as common
+import LUCI_SEEA.lib.raster_blocks as raster_blocks
+import LUCI_SEEA.lib.factor_cache as factor_cache
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
-refresh_modules(common)
+refresh_modules([common, raster_blocks, factor_cache])
 
 class ChangeUserSettings(object):
 
@@ -40,10 +42,24 @@ class ChangeUserSettings(object):
                         if common.readXML(userSettings, 'developerMode') == 'Yes':
                             self.params[2].value = u'True'
 
+                    # Tile size
+                    if not self.params[3].altered:
+                        tileSize = common.readXML(userSettings, 'tileSize')
+                        if tileSize:
+                            self.params[3].value = int(tileSize)
+
+                    # Factor cache size
+                    if not self.params[4].altered:
+                        factorCacheSize = common.readXML(userSettings, 'factorCacheSize')
+                        if factorCacheSize:
+                            self.params[4].value = float(factorCacheSize)
+
                 # If the values have not been read from the configuration file, populate the values with defaults
                 defaults = {
                     'scratchPath': configuration.scratchPath,
-                    'developerMode': u'False'
+                    'developerMode': u'False',
+                    'tileSize': raster_blocks.defaultTileSize,
+                    'factorCacheSize': factor_cache.defaultMaxSizeGb
                 }
 
                 # Scratch path
@@ -59,13 +75,23 @@ class ChangeUserSettings(object):
                 if self.params[2].value is None:
                     self.params[2].value = defaults['developerMode']
 
+                # Tile size
+                if self.params[3].value is None:
+                    self.params[3].value = defaults['tileSize']
+
+                # Factor cache size
+                if self.params[4].value is None:
+                    self.params[4].value = defaults['factorCacheSize']
+
             except Exception:
                 pass
 
-            if self.params[3].valueAsText.lower() == 'true':
+            if self.params[5].valueAsText.lower() == 'true':
 
                 self.params[1].value = defaults['scratchPath']
                 self.params[2].value = defaults['developerMode']
+                self.params[3].value = defaults['tileSize']
+                self.params[4].value = defaults['factorCacheSize']
     
         def updateMessages(self):
             """Modify the messages created by internal validation for each tool parameter.
@@ -113,7 +139,25 @@ class ChangeUserSettings(object):
         # param.value = u'False'
         params.append(param)
 
-        # 3 Reset_all_settings
+        # 3 Tile_size
+        param = arcpy.Parameter()
+        param.name = u'Tile_size'
+        param.displayName = u'Tile size (number of rows and columns of each block processed in memory)'
+        param.parameterType = 'Required'
+        param.direction = 'Input'
+        param.datatype = u'Long'
+        params.append(param)
+
+        # 4 Factor_cache_size
+        param = arcpy.Parameter()
+        param.name = u'Factor_cache_size'
+        param.displayName = u'Maximum size of the RUSLE factor cache (Gb)'
+        param.parameterType = 'Required'
+        param.direction = 'Input'
+        param.datatype = u'Double'
+        params.append(param)
+
+        # 5 Reset_all_settings
         param = arcpy.Parameter()
         param.name = u'Reset_all_settings'
         param.displayName = u'Reset all settings to their default values'
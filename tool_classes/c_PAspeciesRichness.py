@@ -20,35 +20,7 @@ class PAspeciesRichness(object):
         def updateParameters(self):
             """Modify the values and properties of parameters before internal validation is performed.
             This method is called whenever a parameter has been changed."""
-
-            for i in range(0, len(self.params)):
-
-                if self.params[i].name == 'Cell_size':
-                    cellSizeParamNo = i
-                if self.params[i].name == 'Proportion_cell_area':
-                    proportionCellAreaParamNo = i
-                if self.params[i].name == 'Grid_coverage':
-                    gridCoverageParamNo = i
-                if self.params[i].name == 'Grid_boundary_cells_percent':
-                    gridBoundaryCellsPercentParamNo = i
-
-            # Only enable 'Proportion_cell_area' parameter if cell size parameter is set to zero
-            if cellSizeParamNo is not None and proportionCellAreaParamNo is not None:
-
-                if self.params[cellSizeParamNo].valueAsText == '0':
-                    self.params[proportionCellAreaParamNo].enabled = True
-                else:
-                    self.params[proportionCellAreaParamNo].enabled = False
-                    self.params[proportionCellAreaParamNo].value = u'0'
-
-            # Only enable 'Grid_boundary_cells_percent' parameter if grid coverage is set to be bounded by feature class
-            if gridCoverageParamNo is not None and gridBoundaryCellsPercentParamNo is not None:
-
-                if self.params[gridCoverageParamNo].valueAsText == 'Grid covers area bounded by boundary feature class only':
-                    self.params[gridBoundaryCellsPercentParamNo].enabled = True
-                else:
-                    self.params[gridBoundaryCellsPercentParamNo].enabled = False
-                    self.params[gridBoundaryCellsPercentParamNo].value = u'100'
+            return
     
         def updateMessages(self):
             """Modify the messages created by internal validation for each tool parameter.
@@ -60,8 +32,8 @@ class PAspeciesRichness(object):
             input_validation.checkFilePaths(self)
     
     def __init__(self):
-        self.label = u'Create data aggregation grid'
-        self.description = u'Creates a grid over the input data with its size defined by the user. The grid will typically be used as input to the aggregation tools.'
+        self.label = u'Calculate rare species richness'
+        self.description = u'Calculates the number of species (richness) and the diversity of the IUCN red list species ranges in each aggregation unit, or over the study area.'
         self.canRunInBackground = False
         self.category = "2 Aggregation tools"
 
@@ -88,86 +60,60 @@ class PAspeciesRichness(object):
         param.value = u'True'
         params.append(param)
 
-        # 3 Output_speciesrichness
+        # 2 Output_folder
         param = arcpy.Parameter()
-        param.name = u'Rare species richness'
-        param.displayName = u'Rare species richness'
-        param.parameterType = 'Derived'
-        param.direction = 'Output'
-        param.datatype = u'Feature Layer'
-        param.symbology = os.path.join(configuration.displayPath, "rarespeciesrichness.lyr")
-        params.append(param)
-
-        # 3 Input_extent_feature_class
-        param = arcpy.Parameter()
-        param.name = u'Input_extent_feature_class'
-        param.displayName = u'Boundary feature class'
+        param.name = u'Output_folder'
+        param.displayName = u'Output folder'
         param.parameterType = 'Required'
         param.direction = 'Input'
-        param.datatype = u'Feature Layer'
+        param.datatype = u'Folder'
         params.append(param)
 
-        # 4 Output_grid_feature_class
+        # 3 Output_speciesrichness
         param = arcpy.Parameter()
-        param.name = u'Output_grid_feature_class'
-        param.displayName = u'Output grid feature class'
-        param.parameterType = 'Required'
+        param.name = u'Output_Layer_Species_Richness'
+        param.displayName = u'Rare species richness'
+        param.parameterType = 'Derived'
         param.direction = 'Output'
         param.datatype = u'Feature Layer'
+        param.symbology = os.path.join(configuration.displayPath, "rarespeciesrichness.lyr")
         params.append(param)
 
-        # 5 Cell_size
-        param = arcpy.Parameter()
-        param.name = u'Cell_size'
-        param.displayName = u'Cell size in projection units'
-        param.parameterType = 'Optional'
-        param.direction = 'Input'
-        param.datatype = u'Double'
-        param.value = u'100'
-        params.append(param)
-
- 
-        # 8 Grid_boundary_cells_percent
+        # 4 IUCN_red_list_data
         param = arcpy.Parameter()
-        param.name = u'Grid_boundary_cells_percent'
-        param.displayName = u'Percentage of underlying land cover area for grid cells on boundary'
+        param.name = u'IUCN_red_list_data'
+        param.displayName = u'IUCN red list species ranges'
         param.parameterType = 'Required'
         param.direction = 'Input'
-        param.datatype = u'Double'
-        param.value = u'100'
+        param.datatype = u'Feature Class'
         params.append(param)
 
-        # 9 Buffer_radius__projection_units
+        # 5 Study_area_mask
         param = arcpy.Parameter()
-        param.name = u'Buffer_radius__projection_units'
-        param.displayName = u'Buffer radius (in projection units)'
-        param.parameterType = 'Optional'
+        param.name = u'Study_area_mask'
+        param.displayName = u'Study area mask'
+        param.parameterType = 'Required'
         param.direction = 'Input'
-        param.datatype = u'Double'
-        param.value = u'100'
-        param.category = u'Extent parameters'
+        param.datatype = u'Feature Class'
         params.append(param)
 
-        # 10 Align_to_grid
+        # 6 Species_column
         param = arcpy.Parameter()
-        param.name = u'Align_to_grid'
-        param.displayName = u'Align to grid'
+        param.name = u'Species_column'
+        param.displayName = u'Column identifying the species (e.g. binomial)'
         param.parameterType = 'Required'
         param.direction = 'Input'
-        param.datatype = u'Boolean'
-        param.value = u'true'
-        param.category = u'Extent parameters'
+        param.datatype = u'String'
+        param.value = u'binomial'
         params.append(param)
 
-        # 11 Significant_figures
+        # 7 Aggregation_units
         param = arcpy.Parameter()
-        param.name = u'Significant_figures'
-        param.displayName = u'Significant figures'
+        param.name = u'Aggregation_units'
+        param.displayName = u'Aggregation units (optional, the study area is used if not given)'
         param.parameterType = 'Optional'
         param.direction = 'Input'
-        param.datatype = u'Long'
-        param.value = u'3'
-        param.category = u'Extent parameters'
+        param.datatype = u'Feature Class'
         params.append(param)
 
         return params
@@ -192,6 +192,16 @@ class PreprocessDEM(object):
         param.value = u'False'
         params.append(param)
 
+        # 16 Number_of_workers
+        param = arcpy.Parameter()
+        param.name = u'Number_of_workers'
+        param.displayName = u'Number of worker processes for the tiled DEM operations (0 to use all processors)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Long'
+        param.value = 1
+        params.append(param)
+
         return params
 
     def isLicensed(self):
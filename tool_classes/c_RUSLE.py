@@ -194,6 +194,54 @@ class RUSLE(object):
         param.value = u'False'
         params.append(param)
 
+        # 16 Number_of_workers
+        param = arcpy.Parameter()
+        param.name = u'Number_of_workers'
+        param.displayName = u'Number of worker processes (0 to use all processors)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Long'
+        param.value = 1
+        params.append(param)
+
+        # 17 LS_exponent_m
+        param = arcpy.Parameter()
+        param.name = u'LS_exponent_m'
+        param.displayName = u'LS-factor: Slope length exponent (m)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Double'
+        param.value = 0.5
+        params.append(param)
+
+        # 18 LS_exponent_n
+        param = arcpy.Parameter()
+        param.name = u'LS_exponent_n'
+        param.displayName = u'LS-factor: Slope steepness exponent (n, only used when including upslope contributing area)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Double'
+        param.value = 1.2
+        params.append(param)
+
+        # 19 Aggregation_zones
+        param = arcpy.Parameter()
+        param.name = u'Aggregation_zones'
+        param.displayName = u'Aggregation zones for soil loss totals (e.g. catchments or administrative units)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = [u'Feature Class', u'Raster Layer']
+        params.append(param)
+
+        # 20 Aggregation_column
+        param = arcpy.Parameter()
+        param.name = u'Aggregation_column'
+        param.displayName = u'Aggregation zones: Zone column (only used for feature class zones)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'String'
+        params.append(param)
+
         return params
 
     def isLicensed(self):
@@ -163,6 +163,16 @@ class RUSLEAccScen(object):
         param.datatype = 'Raster Layer'
         params.append(param)
 
+        # 13 Incremental
+        param = arcpy.Parameter()
+        param.name = u'Incremental'
+        param.displayName = u'Only recalculate tiles whose inputs have changed since the previous run in this output folder?'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Boolean'
+        param.value = u'False'
+        params.append(param)
+
         return params
 
     def isLicensed(self):
@@ -208,6 +208,34 @@ class RUSLEAccounts(object):
         param.datatype = 'Raster Layer'
         params.append(param)
 
+        # 18 Incremental
+        param = arcpy.Parameter()
+        param.name = u'Incremental'
+        param.displayName = u'Only recalculate tiles whose inputs have changed since the previous run in this output folder?'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'Boolean'
+        param.value = u'False'
+        params.append(param)
+
+        # 19 Aggregation_zones
+        param = arcpy.Parameter()
+        param.name = u'Aggregation_zones'
+        param.displayName = u'Aggregation zones for soil loss totals (e.g. catchments or administrative units)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = [u'Feature Class', u'Raster Layer']
+        params.append(param)
+
+        # 20 Aggregation_column
+        param = arcpy.Parameter()
+        param.name = u'Aggregation_column'
+        param.displayName = u'Aggregation zones: Zone column (only used for feature class zones)'
+        param.parameterType = 'Optional'
+        param.direction = 'Input'
+        param.datatype = u'String'
+        params.append(param)
+
         return params
 
     def isLicensed(self):
@@ -10,6 +10,11 @@ refresh_modules([log, common, PAspeciesRichness])
 
 def function(params):
 
+    class DataToAggregate:
+        def __init__(self, dataSet, linkCode):
+            self.dataSet = dataSet
+            self.linkCode = linkCode
+
     try:
         pText = common.paramsAsText(params)
         
@@ -23,8 +28,16 @@ def function(params):
         
         IUCN_rl_data = pText[4]
         studymask = pText[5]
-        speciesdisplayname = pText[6]
-        #aggregateMask = pText[7] # will add optional mask if want to calculate over aggregrate spatial units
+        speciesColumn = pText[6]
+
+        # Optional aggregation units. If not given, the richness is calculated over the study area.
+        try:
+            aggregateMask = pText[7]
+        except IndexError:
+            aggregateMask = None
+
+        if aggregateMask is None:
+            aggregateMask = studymask
       
         # System checks and setup
         if runSystemChecks:
@@ -37,21 +50,22 @@ def function(params):
         # Set up logging output to file
         log.setupLogging(outputFolder)
 
+        # Initialise variables
+        dataSetsToAggregate = [DataToAggregate(IUCN_rl_data, speciesColumn)]
 
         # Call aggregation function
-        outputStats = PAspeciesRIchness.function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSAM, dataToAggregate)
+        outputStats = PAspeciesRichness.function(outputFolder, dataSetsToAggregate, aggregateMask, False, studymask)
 
         # Set up filenames for display purposes
         RareSpeciesRichness = os.path.join(outputFolder, "RareSpeciesRichness.shp")
         arcpy.CopyFeatures_management(outputStats[0], RareSpeciesRichness)
 
-        arcpy.SetParameter(3,SpeciesRichness)
- 
-
-        return outputStats[0], PAspeciesRIchness
+        arcpy.SetParameter(3, RareSpeciesRichness)
 
         log.info("Rare species richness operations completed successfully")
 
+        return outputStats[0], RareSpeciesRichness
+
     except Exception:
         log.exception("Rare species richness tool failed")
         raise
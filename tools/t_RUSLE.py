@@ -48,6 +48,26 @@ def function(params):
         except Exception:
             raise
 
+        # Number of worker processes used to calculate soil loss. If not present, use a single process.
+        try:
+            workers = int(pText[16])
+        except (IndexError, TypeError):
+            workers = 1
+
+        # Exponents of the LS-factor equations. If not present, use the default values.
+        try:
+            lsExponents = (float(pText[17]), float(pText[18]))
+        except (IndexError, TypeError, ValueError):
+            lsExponents = None
+
+        # Aggregation zones for soil loss totals. If not present, no zone table is written.
+        try:
+            zones = pText[19]
+            zoneColumn = pText[20]
+        except IndexError:
+            zones = None
+            zoneColumn = None
+
         # Create output folder
         if not os.path.exists(outputFolder):
             os.mkdir(outputFolder)
@@ -101,7 +121,7 @@ def function(params):
         # Call RUSLE function
         soilLoss = RUSLE.function(outputFolder, preprocessFolder, lsOption, soilOption, soilData, soilCode,
                                   lcOption, landCoverData, landCoverCode, rData, saveFactors, supportData,
-                                  rerun)
+                                  rerun, workers, lsExponents, zones, zoneColumn)
 
         # Set up filenames for display purposes
         soilLoss = os.path.join(outputFolder, "soilloss")
@@ -37,6 +37,20 @@ def function(params):
         
         saveFactors = False
 
+        # Incremental parameter may not be present when tool run as part of a batch run tool. If it is not, recalculate all tiles.
+        try:
+            incremental = common.strToBool(pText[18])
+        except (IndexError, ValueError):
+            incremental = False
+
+        # Aggregation zones for soil loss totals. If not present, no zone tables are written.
+        try:
+            zones = pText[19]
+            zoneColumn = pText[20]
+        except IndexError:
+            zones = None
+            zoneColumn = None
+
         # Set option for LS-factor
         if slopeOption == 'Calculate based on slope and length only':
             lsOption = 'SlopeLength'
@@ -64,7 +78,7 @@ def function(params):
         RUSLE_accounts.function(outputFolder, yearAFolder, yearBFolder,
                                 lsOption, rData, soilData, soilCode,
                                 YearALCData, YearALCCode, YearBLCData, YearBLCCode,
-                                YearAPData, YearBPData, saveFactors)
+                                YearAPData, YearBPData, saveFactors, incremental, zones, zoneColumn)
 
         # Set up filenames for display purposes
         soilLossA = os.path.join(outputFolder, "soillossA")
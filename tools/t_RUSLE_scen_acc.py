@@ -25,6 +25,12 @@ def function(params):
         yearASupport = pText[11]
         yearBSupport = pText[12]
 
+        # Incremental parameter may not be present when tool run as part of a batch run tool. If it is not, recalculate all tiles.
+        try:
+            incremental = common.strToBool(pText[13])
+        except (IndexError, ValueError):
+            incremental = False
+
         # Set option for LS-factor
         if slopeOption == 'Calculate based on slope and length only':
             lsOption = 'SlopeLength'
@@ -49,7 +55,7 @@ def function(params):
         
         # Call RUSLE_scen_acc function
         RUSLE_scen_acc.function(outputFolder, yearAFolder, yearBFolder, lsOption,
-                                yearARain, yearBRain, yearASupport, yearBSupport)
+                                yearARain, yearBRain, yearASupport, yearBSupport, incremental)
 
         # Set up filenames for display purposes
         soilLossA = os.path.join(outputFolder, "soillossA")
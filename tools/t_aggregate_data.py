@@ -32,6 +32,12 @@ def function(params):
         aggregateMask = pText[9]
         maskFullyWithinSAM = common.strToBool(pText[10])
 
+        # Number of worker processes used for the aggregation. If not present, use a single process.
+        try:
+            workers = int(pText[11])
+        except (IndexError, TypeError):
+            workers = 1
+
         # System checks and setup
         if runSystemChecks:
             common.runSystemChecks()
@@ -47,7 +53,8 @@ def function(params):
         dataSetsToAggregate = [DataToAggregate(dataToAggregate, classificationColumn)]
 
         # Call aggregation function
-        outputStats = aggregate_data.function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSAM, dataToAggregate)
+        outputStats = aggregate_data.function(outputFolder, dataSetsToAggregate, aggregateMask, maskFullyWithinSAM, dataToAggregate,
+                                              workers)
 
         # Set up filenames for display purposes
         InvSimpson = os.path.join(outputFolder, "InverseSimpsonIndex.shp")
@@ -20,6 +20,8 @@ def function(params):
     p = common.paramsAsText(params)
     scratchPath = p[1]
     developerMode = common.strToBool(p[2])
+    tileSize = p[3]
+    factorCacheSize = p[4]
 
     if developerMode == True:
         developerMode = 'Yes'
@@ -29,12 +31,16 @@ def function(params):
     # Override the default values from user settings file (if they exist in the file)
     try:
         configValues = [('scratchPath', scratchPath),
-                        ('developerMode', developerMode)]
+                        ('developerMode', developerMode),
+                        ('tileSize', tileSize),
+                        ('factorCacheSize', factorCacheSize)]
 
         common.writeXML(configuration.userSettingsFile, configValues)
 
         log.info('Scratch path updated: ' + scratchPath)
         log.info('Developer mode updated: ' + developerMode)
+        log.info('Tile size updated: ' + tileSize)
+        log.info('Factor cache size updated: ' + factorCacheSize + ' Gb')
 
     except Exception:
         raise
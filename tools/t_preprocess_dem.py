@@ -17,11 +17,12 @@ import LUCI_SEEA.lib.log as log
 import LUCI_SEEA.lib.progress as progress
 import LUCI_SEEA.lib.common as common
 import LUCI_SEEA.lib.baseline as baseline
+import LUCI_SEEA.lib.coverage as coverage
 import LUCI_SEEA.solo.preprocess_dem as preprocess_dem
 
 from LUCI_SEEA.lib.refresh_modules import refresh_modules
 from LUCI_SEEA.lib.external import six # Python 2/3 compatibility module
-refresh_modules([log, common, baseline, preprocess_dem])
+refresh_modules([log, common, baseline, coverage, preprocess_dem])
 
 def function(params):
 
@@ -48,6 +49,13 @@ def function(params):
         streamDrop = pText[14]
         rerun = common.strToBool(pText[15])
 
+        # Number of worker processes used for the tiled DEM operations (flow direction, flow accumulation, slope,
+        # stream burning and stream tracing). If not present, use a single process.
+        try:
+            workers = int(pText[16])
+        except (IndexError, TypeError):
+            workers = 1
+
         log.info('Inputs read in')
 
         ###########################
@@ -262,30 +270,29 @@ def function(params):
         if not progress.codeSuccessfullyRun(codeBlock, outputFolder, rerun):
 
             # Do coverage checks on land cover and soil and copy to outputFolder
+            # The buffered study area mask is rasterised once on the clipped DEM grid for all of the checks
+            studyCoverage = coverage.CoverageMask(studyAreaMaskBuff, clippedDEM)
+
             if lcFormat in ['RasterDataset', 'RasterLayer']:
 
-                lcMask = common.extractRasterMask(clippedLC)
-                common.checkCoverage(lcMask, studyAreaMaskBuff, inputLC)                
+                studyCoverage.check(clippedLC, inputLC)
 
                 arcpy.CopyRaster_management(clippedLC, outputLCras)
 
             elif lcFormat in ['ShapeFile', 'FeatureClass']:
-                lcMask = common.dissolvePolygon(clippedLC)
-                common.checkCoverage(lcMask, studyAreaMaskBuff, inputLC)
+                studyCoverage.check(clippedLC, inputLC)
 
                 arcpy.CopyFeatures_management(clippedLC, outputLCvec)
 
             if soilFormat in ['RasterDataset', 'RasterLayer']:
 
-                soilMask = common.extractRasterMask(clippedSoil)
-                common.checkCoverage(soilMask, studyAreaMaskBuff, inputLC)
+                studyCoverage.check(clippedSoil, inputSoil)
 
                 arcpy.CopyRaster_management(clippedSoil, outputSoilras)
 
             elif soilFormat in ['ShapeFile', 'FeatureClass']:
 
-                soilMask = common.dissolvePolygon(clippedSoil)
-                common.checkCoverage(soilMask, studyAreaMaskBuff, inputSoil)
+                studyCoverage.check(clippedSoil, inputSoil)
 
                 arcpy.CopyFeatures_management(clippedSoil, outputSoilvec)
 
@@ -325,7 +332,8 @@ def function(params):
                                 smoothDrop,
                                 streamDrop,
                                 reconDEM,
-                                rerun)
+                                rerun,
+                                workers)
 
     except Exception:
         arcpy.SetParameter(0, False)